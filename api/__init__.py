@@ -24,3 +24,16 @@ import api.group
 import api.user
 import api.resource
 import api.auth
+import api.acl
+import api.compression
+import api.encoding
+import api.etag
+import api.export
+import api.ingest
+import api.metrics
+import api.paging
+import api.rollup
+import api.streaming
+import api.summary
+import api.token
+import api.validation
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2019, Pim Witlox. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+import logging
+import threading
+from time import time
+
+from flask import g, has_request_context
+
+from db.handler import table_versions
+
+logger = logging.getLogger('api.acl')
+
+
+def current_versions():
+    """
+    the table versions, re-read from the database once per request so changes made by other processes are seen
+    :return: TableVersions
+    """
+    if has_request_context() and 'table_versions' not in g:
+        table_versions.refresh()
+        g.table_versions = True
+    return table_versions
+
+
+class ACLCache(object):
+    """
+    cross-request cache of permission data (group memberships per user, admins group, groups per resource)
+    entries expire after ttl seconds, writes that change permissions invalidate the affected entries and the cache is
+    cleared when the version of one of the permission tables changed, also by another process
+    """
+    tables = ('users', 'groups', 'members', 'resources', 'group_resources', 'services')
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._versions = None
+        self._lock = threading.Lock()
+
+    def _check_versions(self):
+        versions = current_versions()
+        current = tuple(versions.get(t) for t in self.tables)
+        if current != self._versions:
+            with self._lock:
+                if self._versions is not None:
+                    logger.debug("permission tables changed, clearing the acl cache")
+                self._entries.clear()
+                self._versions = current
+
+    def get(self, key, loader, *args):
+        """
+        get a cached entry, loading it on a miss
+        :param key: tuple of kind and identifier, e.g. ('user', dom_name)
+        :param loader: function to load the entry
+        :param args: arguments for the loader
+        :return: cached or loaded value
+        """
+        self._check_versions()
+        now = time()
+        entry = self._entries.get(key)
+        if entry and entry[0] > now:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = loader(*args)
+        if self.ttl > 0:
+            with self._lock:
+                self._entries[key] = (now + self.ttl, value)
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    ratio=float(self.hits) / total if total else 0.0,
+                    size=len(self._entries),
+                    ttl=self.ttl)
+
+
+acl = ACLCache()
+
+
+def init_acl(ttl):
+    """
+    reset the acl cache
+    :param ttl: time to live of entries in seconds, 0 disables caching
+    :return: acl cache
+    """
+    acl.ttl = ttl
+    acl.hits = acl.misses = 0
+    acl.clear()
+    return acl
@@ -24,9 +24,11 @@ import logging
 import random
 
 from connexion import NoContent
-from flask import session
+from flask import session, g
 from sqlalchemy.exc import SQLAlchemyError
 
+from api.acl import acl
+from api.paging import paginate, page_headers, page_size, stream_json_lines
 from db.group import Group, Member
 from db.handler import db_session
 from db.service import Service
@@ -36,22 +38,92 @@ logger = logging.getLogger('api.admin')
 allowed_chars = u'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
 
 
+class Principal(object):
+    """
+    user with its group memberships, the groups map group id to admin yes/no
+    principals are shared between requests through the acl cache, so they are read-only
+    """
+
+    def __init__(self, name=None, uid=None, admin=False, groups=None, group_names=None):
+        self.name = name
+        self.uid = uid
+        self.admin = admin
+        self.groups = groups or {}
+        self.group_names = group_names or {}
+
+    def is_member(self, group):
+        if not isinstance(group, int):
+            group = self.group_names.get(group)
+        return group in self.groups
+
+    def is_group_admin(self, group):
+        if not isinstance(group, int):
+            group = self.group_names.get(group)
+        return self.groups.get(group, False)
+
+
+def load_principal(name):
+    """
+    load a user and its group memberships in a single query
+    :param name: dom_name
+    :return: Principal
+    """
+    rows = db_session.query(User.id, Group.id, Group.name, Member.admin)\
+        .outerjoin(Member, Member.user_id == User.id)\
+        .outerjoin(Group, Group.id == Member.group_id)\
+        .filter(User.dom_name == name).all()
+    if not rows:
+        return Principal(name)
+    groups = dict((gid, bool(admin)) for (u, gid, gname, admin) in rows if gid is not None)
+    group_names = dict((gname, gid) for (u, gid, gname, admin) in rows if gid is not None)
+    return Principal(name, rows[0][0], 'admins' in group_names, groups, group_names)
+
+
+def cached_principal(name):
+    """
+    a user and its group memberships from the acl cache
+    :param name: dom_name
+    :return: Principal
+    """
+    return acl.get(('user', name), load_principal, name)
+
+
+def admins_group_id():
+    """
+    :return: id of the admins group (cached)
+    """
+    return acl.get(('admins',), lambda: db_session.query(Group.id).filter(Group.name == 'admins').scalar())
+
+
+def principal():
+    """
+    the authenticated user of the current request, resolved once per request
+    :return: Principal
+    """
+    if 'principal' not in g:
+        if 'admin' in session:
+            g.principal = Principal(session.get('username'), admin=True)
+        elif 'username' in session:
+            g.principal = cached_principal(session['username'])
+        else:
+            g.principal = Principal()
+    return g.principal
+
+
 def is_admin():
     """
     check if a user is an admin (excluding group admins)
     :return: admin yes/no
     """
-    if 'admin' in session:
-        return True
-    else:
-        if 'username' in session:
-            u = db_session.query(User)
-            user = u.filter(User.dom_name == session['username']).one_or_none()
-            if user:
-                group = db_session.query(Group).filter(Group.name == 'admins').one()
-                if db_session.query(Member).filter(Member.group == group and Member.user == user).one_or_none():
-                    return True
-        return False
+    return principal().admin
+
+
+def admins_only(*args, **kwargs):
+    """
+    authorization of handlers for admins only, see api.etag.conditional
+    :return: 401 for non admins, None otherwise
+    """
+    return None if is_admin() else 401
 
 
 def user_is_group_admin(user, group):
@@ -61,13 +133,10 @@ def user_is_group_admin(user, group):
     :param group: group name
     :return: admin yes/no
     """
-    user = db_session.query(User).filter(User.dom_name == user).one_or_none()
-    group = db_session.query(Group).filter(Group.name == group).one_or_none()
-    if not user or not group:
-        return False
-    if db_session.query(Member).filter(Member.group_id == group.id and Member.user_id == user.id and Member.admin).one_or_none():
-        return True
-    return False
+    p = principal()
+    if p.name != user:
+        p = cached_principal(user)
+    return p.is_group_admin(group)
 
 
 def is_group_admin(group):
@@ -76,18 +145,8 @@ def is_group_admin(group):
     :param group: name or id of the group to check, note that it's the database uid (- uid_init)
     :return: admin yes/no
     """
-    if is_admin():
-        return True
-    if 'username' in session:
-        user = db_session.query(User).filter(User.dom_name == session['username']).one_or_none()
-        if not user:
-            return False
-        if isinstance(group, int):
-            if db_session.query(Member).filter(Member.group_id == group and Member.user_id == user.id and Member.admin).one_or_none():
-                return True
-        else:
-            return user_is_group_admin(user.dom_name, group)
-    return False
+    p = principal()
+    return p.admin or p.is_group_admin(group)
 
 
 def get_admins():
@@ -97,11 +156,8 @@ def get_admins():
     """
     if not is_admin():
         return NoContent, 401
-    group = db_session.query(Group).filter(Group.name == 'admins').one()
-    users = []
-    for group_user in db_session.query(Member).filter(Member.group == group).all():
-        users.append(db_session.query(User).filter(User.id == group_user.user_id).one_or_none())
-    return [u.dump() for u in users]
+    users = db_session.query(User).join(Member, Member.user_id == User.id).filter(Member.group_id == admins_group_id())
+    return [u.dump() for u in users.all()]
 
 
 def add_admin(name):
@@ -115,10 +171,10 @@ def add_admin(name):
     user = db_session.query(User).filter(User.dom_name == name).one_or_none()
     if not user:
         return NoContent, 404
-    group = db_session.query(Group).filter(Group.name == 'admins').one()
     try:
-        db_session.add(Member(group=group, user=user, admin=True))
+        db_session.add(Member(group_id=admins_group_id(), user=user, admin=True))
         db_session.commit()
+        acl.invalidate(('user', name))
         return NoContent, 201
     except SQLAlchemyError:
         logger.exception("error while adding admin")
@@ -136,24 +192,31 @@ def remove_admin(name):
     user = db_session.query(User).filter(User.dom_name == name).one_or_none()
     if not user:
         return NoContent, 404
-    group = db_session.query(Group).filter(Group.name == 'admins').one()
     try:
-        db_session.query(Member).filter(Member.group == group and Member.user == user).delete()
+        db_session.query(Member).filter(Member.group_id == admins_group_id(), Member.user_id == user.id).delete()
         db_session.commit()
+        acl.invalidate(('user', name))
         return NoContent, 200
     except SQLAlchemyError:
         logger.exception("error while removing admin")
         return NoContent, 500
 
 
-def get_services():
+def get_services(limit=None, after=None, stream=False):
     """
     list all service accounts
-    :return: list of dict(name, access)
+    :param limit: page size
+    :param after: only services with an id larger than after
+    :param stream: stream as JSON lines
+    :return: list of dict(id, name, access)
     """
     if not is_admin():
         return NoContent, 401
-    return [dict(name=s.name, access=s.access) for s in db_session.query(Service).all()], 200
+    query = paginate(db_session.query(Service.id, Service.name, Service.access), Service.id, limit, after)
+    if stream:
+        return stream_json_lines(dict(id=i, name=n, access=a) for (i, n, a) in query.yield_per(page_size))
+    services = [dict(id=i, name=n, access=a) for (i, n, a) in query.all()]
+    return services, 200, page_headers(services, limit)
 
 
 def add_service(name):
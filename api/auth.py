@@ -25,10 +25,11 @@ import sys
 from time import time
 
 from connexion import NoContent
-from flask import session
+from flask import session, request
 from flask_ldap3_login import LDAP3LoginManager, AuthenticationResponseStatus
 from jose import JWTError, jwt, ExpiredSignatureError
 
+from api.token import ClaimsCache, MemoryTokenStore, create_store
 from app import config
 from db.handler import db_session
 from db.service import Service
@@ -36,83 +37,146 @@ from db.user import User
 
 logger = logging.getLogger('api.auth')
 ldap_manager = None
-tokens = {}
+tokens = MemoryTokenStore()
+claims_cache = ClaimsCache()
 
 
 def init_ldap():
-    if config.authentication().get('method') == 'ldap':
+    authentication = config.authentication()
+    if authentication.get('method') == 'ldap':
         auth_config = dict()
-        auth_config['LDAP_HOST'] = config.authentication().get('host')
-        auth_config['LDAP_PORT'] = int(config.authentication().get('port'))
-        auth_config['LDAP_USE_SSL'] = bool(config.authentication().get('ssl'))
-        auth_config['LDAP_BASE_DN'] = config.authentication().get('base_dn')
-        auth_config['LDAP_USER_RDN_ATTR'] = config.authentication().get('rdn_attr')
-        auth_config['LDAP_USER_LOGIN_ATTR'] = config.authentication().get('login_attr')
-        auth_config['LDAP_BIND_USER_DN'] = config.authentication().get('bind_user')
-        auth_config['LDAP_BIND_USER_PASSWORD'] = config.authentication().get('bind_pass')
+        auth_config['LDAP_HOST'] = authentication.host
+        auth_config['LDAP_PORT'] = authentication.port
+        auth_config['LDAP_USE_SSL'] = authentication.ssl
+        auth_config['LDAP_BASE_DN'] = authentication.base_dn
+        auth_config['LDAP_USER_RDN_ATTR'] = authentication.rdn_attr
+        auth_config['LDAP_USER_LOGIN_ATTR'] = authentication.login_attr
+        auth_config['LDAP_BIND_USER_DN'] = authentication.bind_user
+        auth_config['LDAP_BIND_USER_PASSWORD'] = authentication.bind_pass
         ldm = LDAP3LoginManager()
         ldm.init_config(auth_config)
         return ldm
     return None
 
 
-def generate_token(identifier):
+def init_tokens(engine=None):
+    """
+    (re)create the token store configured in the token section
+    :param engine: database engine, used by the database store
+    :return: token store
+    """
+    global tokens, claims_cache
+    tokens = create_store(config.token(), engine, token_secret())
+    claims_cache = ClaimsCache(config.token().cache_size)
+    return tokens
+
+
+def is_stateless():
+    """
+    stateless tokens are validated by their signature only, they are not kept in the token store
+    :return: stateless yes/no
+    """
+    return config.token().stateless
+
+
+def token_secret():
+    return config.token().secret or config.general().secret
+
+
+def generate_token(identifier, uid=None, role=None):
     """
     generate a JWT token
     :param identifier: name of user or service
+    :param uid: user id or service id, embedded as claim
+    :param role: admin, service or user, embedded as claim
     :return: JWT token
     """
+    token_config = config.token()
     timestamp = int(time())
     payload = {
-        "iss": config.token().get('issuer'),
-        "iat": int(timestamp),
-        "exp": int(timestamp + int(config.token().get('lifetime'))),
+        "iss": token_config.issuer,
+        "iat": timestamp,
+        "exp": timestamp + token_config.lifetime,
         "sub": str(identifier),
     }
-    secret = config.token().get('secret')
-    if not secret:
-        secret = config.general().get('secret')
-    return jwt.encode(payload, secret, algorithm=config.token().get('algorithm'))
+    if uid is not None:
+        payload['uid'] = uid
+    if role:
+        payload['role'] = role
+    return jwt.encode(payload, token_secret(), algorithm=token_config.algorithm)
 
 
-def user_by_token(token, required_scopes=None):
-    result = validate(token)
-    if result:
-        return dict(sub=next((name for name, t in tokens.items() if t == token), None), uid=result)
-    return None
+def issue_token(identifier, uid=None, role=None):
+    """
+    generate a JWT token and register it for the identifier (unless tokens are stateless)
+    :param identifier: name of user or service
+    :param uid: user id or service id
+    :param role: admin, service or user
+    :return: JWT token
+    """
+    token = generate_token(identifier, uid, role)
+    if not is_stateless():
+        tokens.add(str(identifier), token, jwt.get_unverified_claims(token).get('exp'))
+    return token
 
 
-def validate(token):
+def decode_token(token):
+    """
+    verify a JWT token, verified claims are cached until the token expires
+    :param token: JWT token
+    :return: claims
+    """
+    claims = claims_cache.get(token)
+    if claims is None:
+        claims = jwt.decode(token, token_secret(), algorithms=[config.token().algorithm])
+        claims_cache.put(token, claims)
+    return claims
+
+
+def user_by_token(token, required_scopes=None):
     """
     validate if token is valid and not expired
     :param token: JWT token
-    :return: user id, service id, or None if not valid or expired
+    :param required_scopes: unused
+    :return: dict(sub, uid) or None if not valid or expired
     """
-    if token not in tokens.values():
+    stateless = is_stateless()
+    if not stateless and not tokens.subject(token):
         logger.warning("invalid token supplied {0}".format(token))
         return None
-    name = next((name for name, t in tokens.items() if t == token), None)
-    if not name:
-        return None
-    logger.debug("token request for {0}".format(name))
     try:
-        secret = config.token().get('secret')
-        if not secret:
-            secret = config.general().get('secret')
-        jwt.decode(token, secret, algorithms=[config.token().get('algorithm')])
-        if 'admin' in session:
-            return session['admin']
-        if 'service' in session:
-            return session['service']
-        user = db_session.query(User).filter(User.dom_name == name).one_or_none()
-        if not user:
-            return None
-        return user.id
+        claims = decode_token(token)
     except ExpiredSignatureError:
-        logger.debug("token {0} for {1} expired, removing it".format(token, name))
-        tokens.pop(name, None)
+        logger.debug("token {0} expired, removing it".format(token))
+        if not stateless:
+            tokens.remove(token)
+        return None
     except JWTError:
         logger.exception("error decoding token")
+        return None
+    name = claims.get('sub')
+    logger.debug("token request for {0}".format(name))
+    if 'uid' in claims:
+        return dict(sub=name, uid=claims['uid'])
+    if 'admin' in session:
+        return dict(sub=name, uid=session['admin'])
+    if 'service' in session:
+        return dict(sub=name, uid=session['service'])
+    user = db_session.query(User).filter(User.dom_name == name).one_or_none()
+    if not user:
+        return None
+    return dict(sub=name, uid=user.id)
+
+
+def validate(token):
+    """
+    validate if token is valid and not expired
+    :param token: JWT token
+    :return: user id, service id, or None if not valid or expired
+    """
+    result = user_by_token(token)
+    if result:
+        return result['uid']
     return None
 
 
@@ -146,27 +210,23 @@ def login(username, password):
     """
     if 'username' in session:
         return "You are already logged in {0}".format(session['username']), 500
-    if username == config.admin().get('access') and hashlib.sha256(config.admin().get('secret').encode('utf-8')).hexdigest() == password:
+    admin = config.admin()
+    if username == admin.access and hashlib.sha256(admin.secret.encode('utf-8')).hexdigest() == password:
         session['username'] = 'admin'
         session['admin'] = sys.maxsize
-        token = generate_token('admin')
-        tokens['admin'] = token
-        return token, 200
+        return issue_token('admin', sys.maxsize, 'admin'), 200
     (service, sid) = access_secret_verify(username, password)
     if service:
         session['username'] = service
         session['service'] = sid
-        token = generate_token(service)
-        tokens[service] = token
-        return token, 200
+        return issue_token(service, sid, 'service'), 200
     if not ldap_manager:
         init_ldap()
     if ldap_manager:
         if AuthenticationResponseStatus.success == ldap_manager.authenticate(username, password):
             session['username'] = username
-            token = generate_token(username)
-            tokens[username] = token
-            return token, 200
+            user = db_session.query(User).filter(User.dom_name == username).one_or_none()
+            return issue_token(username, user.id if user else None, 'user'), 200
     return NoContent, 401
 
 
@@ -175,14 +235,17 @@ def logout():
     logout user or service
     :return: 200
     """
+    token = request.headers.get('X-TOKEN')
+    if token:
+        claims_cache.remove(token)
+        tokens.remove(token)
+    elif 'username' in session:
+        tokens.remove_subject(session['username'])
     if 'username' in session:
-        tokens.pop(session['username'], None)
         del(session['username'])
     if 'admin' in session:
-        tokens.pop(session['admin'], None)
         del(session['admin'])
     if 'service' in session:
-        tokens.pop(session['service'], None)
         del(session['service'])
     if 'token' in session:
         del(session['token'])
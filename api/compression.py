@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2019, Pim Witlox. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+
+import logging
+import zlib
+
+from flask import request
+
+logger = logging.getLogger('api.compression')
+
+compressible = ('application/json', 'application/x-ndjson', 'text/csv', 'text/plain')
+
+
+class ResponseCompressor(object):
+    """
+    after request hook compressing responses with gzip, or brotli (br) when installed, as negotiated by
+    Accept-Encoding, streamed responses are compressed while they are sent
+    """
+
+    def __init__(self, level=6, min_size=1024):
+        self.level = level
+        self.min_size = min_size
+        self.encodings = ['gzip']
+        try:
+            import brotli
+            self.brotli = brotli
+            self.encodings.insert(0, 'br')
+        except ImportError:
+            self.brotli = None
+
+    def _compressor(self, encoding):
+        if encoding == 'br':
+            compressor = self.brotli.Compressor(quality=min(self.level, 11))
+            return compressor.process, compressor.finish
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress, compressor.flush
+
+    def _stream(self, chunks, encoding):
+        compress, finish = self._compressor(encoding)
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compress(chunk)
+            if data:
+                yield data
+        yield finish()
+
+    def __call__(self, response):
+        if response.status_code != 200 or response.direct_passthrough or 'Content-Encoding' in response.headers \
+                or response.mimetype not in compressible:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(self.encodings)
+        if not encoding:
+            return response
+        if response.is_streamed:
+            response.response = self._stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            compress, finish = self._compressor(encoding)
+            response.set_data(compress(data) + finish())
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+
+def init_compression(app, general_config):
+    """
+    compress responses of a connexion app
+    :param app: connexion app
+    :param general_config: general section of the configuration
+    """
+    if not general_config.get('compression', True):
+        return None
+    compressor = ResponseCompressor(general_config.get('compression_level', 6),
+                                    general_config.get('compression_min_size', 1024))
+    app.app.after_request(compressor)
+    logger.info("compressing responses with {0}".format(', '.join(compressor.encodings)))
+    return compressor
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2019, Pim Witlox. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+
+import json
+import logging
+from datetime import date, datetime
+from decimal import Decimal
+
+logger = logging.getLogger('api.encoding')
+
+
+def _default(o):
+    # same representation as the connexion encoder: naive datetimes are UTC
+    if isinstance(o, datetime):
+        if o.tzinfo:
+            return o.isoformat('T')
+        return o.isoformat('T') + 'Z'
+    if isinstance(o, date):
+        return o.isoformat()
+    if isinstance(o, Decimal):
+        return float(o)
+    raise TypeError("Object of type {0} is not JSON serializable".format(type(o).__name__))
+
+
+class StdlibJSON(object):
+    name = 'stdlib'
+
+    @staticmethod
+    def dumps(data, **kwargs):
+        return json.dumps(data, default=_default, separators=(',', ':'))
+
+    loads = staticmethod(json.loads)
+
+
+class OrJSON(object):
+    """
+    orjson serializes datetimes natively, naive ones are marked as UTC (Z)
+    """
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._dumps = orjson.dumps
+        self.loads = orjson.loads
+        self.option = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, data, **kwargs):
+        return self._dumps(data, default=_default, option=self.option).decode('utf-8')
+
+
+class UJSON(object):
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self._dumps = ujson.dumps
+        self.loads = ujson.loads
+
+    def dumps(self, data, **kwargs):
+        return self._dumps(data, default=_default, ensure_ascii=False)
+
+
+encoders = (('orjson', OrJSON), ('ujson', UJSON), ('stdlib', StdlibJSON))
+encoder = StdlibJSON()
+
+
+def create_encoder(name='auto'):
+    """
+    create a JSON encoder, auto picks the fastest installed one
+    :param name: auto, orjson, ujson or stdlib
+    :return: object with dumps and loads
+    """
+    for candidate, cls in encoders:
+        if name not in ('auto', candidate):
+            continue
+        try:
+            return cls()
+        except ImportError:
+            if name != 'auto':
+                logger.error("JSON encoder {0} is not installed, using stdlib".format(name))
+    return StdlibJSON()
+
+
+def init_encoder(api, name='auto'):
+    """
+    use a fast JSON encoder for the responses of connexion apis and the JSON lines streams
+    connexion serializes responses with the jsonifier of the api class, so this applies to all apis of that class
+    :param api: connexion api returned by add_api
+    :param name: auto, orjson, ujson or stdlib
+    """
+    from connexion.jsonifier import Jsonifier
+    global encoder
+    encoder = create_encoder(name)
+    type(api).jsonifier = Jsonifier(encoder)
+    logger.info("encoding JSON with {0}".format(encoder.name))
+
+
+def dumps(data):
+    return encoder.dumps(data)
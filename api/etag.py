@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2019, Pim Witlox. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+
+import functools
+import hashlib
+import logging
+
+from connexion import NoContent
+from flask import Response, request, session
+
+from api.acl import current_versions
+
+logger = logging.getLogger('api.etag')
+
+# tables deciding what the requester may see
+identity_tables = ('users', 'groups', 'members')
+
+
+def current_etag(tables):
+    """
+    tag of a request given the versions of the tables its response is read from
+    the requester and the full path (with query) are part of the tag, as they change the response
+    :param tables: table names
+    :return: tag
+    """
+    table_versions = current_versions()
+    versions = ','.join('{0}={1}'.format(t, table_versions.get(t)) for t in tables)
+    key = '{0}|{1}|{2}|{3}'.format(versions, session.get('username'), 'admin' in session, request.full_path)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _with_header(result, headers):
+    if isinstance(result, Response):
+        if result.status_code == 200:
+            result.headers.extend(headers)
+        return result
+    if not isinstance(result, tuple):
+        return result, 200, headers
+    if len(result) < 2 or result[1] != 200:
+        return result
+    if len(result) == 2:
+        return result[0], result[1], headers
+    return result[0], result[1], dict(result[2], **headers)
+
+
+def conditional(*tables, authorize=None):
+    """
+    decorator for GET handlers answering 304 when If-None-Match holds the current tag, the handler is not called then
+    successful responses get the (weak, the body may be compressed) tag in their ETag header
+    :param tables: tables the response is read from
+    :param authorize: called with the arguments of the handler before the tags are compared, returns an error status
+    or None, so a caller that may not see the response cannot probe its tag
+    """
+    tables = tuple(sorted(set(tables) | set(identity_tables)))
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            status = authorize(*args, **kwargs) if authorize else None
+            if status:
+                return NoContent, status
+            tag = current_etag(tables)
+            headers = {'ETag': 'W/"{0}"'.format(tag)}
+            if request.if_none_match.contains_weak(tag):
+                return NoContent, 304, headers
+            return _with_header(function(*args, **kwargs), headers)
+        return wrapper
+    return decorator
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2019, Pim Witlox. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+
+import csv
+import io
+import logging
+import struct
+from datetime import datetime
+
+from connexion import NoContent
+from flask import Response, stream_with_context
+from sqlalchemy import and_
+
+from api import encoding
+from api.paging import page_size
+from api.resource import authorize_usage, usage_window
+from db.handler import db_session
+from db.resource import metrics, usage_partitions
+
+logger = logging.getLogger('api.export')
+
+columns = ('resource', 'user', 'start', 'end') + metrics
+formats = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+    'columnar': 'application/octet-stream',
+}
+# columnar format: magic, then blocks of <row count> followed by the columns, a block of 0 rows ends the stream
+# strings are <lengths as uint32><utf-8 bytes>, timestamps int64 microseconds since the epoch, metrics float64 (NaN is null)
+columnar_magic = b'ACU1'
+_epoch = datetime(1970, 1, 1)
+_microsecond = datetime(1970, 1, 1, 0, 0, 0, 1) - _epoch
+
+
+def export_query(r=None, u=None, start=None, end=None):
+    """
+    usage of the partitions overlapping the window, ordered by start
+    :return: selectable
+    """
+    def where(table):
+        clauses = []
+        if r:
+            clauses.append(table.c.resource == r)
+        if u:
+            clauses.append(table.c.user == u)
+        if start:
+            clauses.append(table.c.start >= start)
+        if end:
+            clauses.append(table.c.end <= end)
+        return and_(*clauses)
+
+    return usage_partitions.select(db_session, lambda t: [t.c[c] for c in columns], start, end, where, order_by='start')
+
+
+def iter_batches(session, query, batch_size=page_size):
+    """
+    iterate a query in batches from a server side cursor, memory use is bounded by the batch size
+    :param session: database session
+    :param query: selectable
+    :param batch_size: rows per batch
+    :return: generator of lists of rows
+    """
+    result = session.execute(query.execution_options(stream_results=True))
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        result.close()
+
+
+def _metric(value):
+    return float(value) if value is not None else None
+
+
+def csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in batches:
+        for row in rows:
+            writer.writerow([row[0], row[1], row[2].isoformat(), row[3].isoformat()] +
+                            ['' if v is None else float(v) for v in row[4:]])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def jsonl_chunks(batches):
+    for rows in batches:
+        yield ''.join(encoding.dumps(dict(zip(columns, (row[0], row[1], row[2].isoformat(), row[3].isoformat()) +
+                                          tuple(_metric(v) for v in row[4:])))) + '\n' for row in rows)
+
+
+def _strings(values):
+    encoded = [v.encode('utf-8') for v in values]
+    return struct.pack('<{0}I'.format(len(encoded)), *[len(e) for e in encoded]) + b''.join(encoded)
+
+
+def _timestamps(values):
+    return struct.pack('<{0}q'.format(len(values)), *[(v - _epoch) // _microsecond for v in values])
+
+
+def _floats(values):
+    return struct.pack('<{0}d'.format(len(values)), *[float('nan') if v is None else float(v) for v in values])
+
+
+def columnar_chunks(batches):
+    yield columnar_magic
+    for rows in batches:
+        values = list(zip(*rows))
+        yield struct.pack('<I', len(rows)) + _strings(values[0]) + _strings(values[1]) + \
+            _timestamps(values[2]) + _timestamps(values[3]) + b''.join(_floats(v) for v in values[4:])
+    yield struct.pack('<I', 0)
+
+
+def read_columnar(stream):
+    """
+    decode the columnar export format
+    :param stream: binary file object
+    :return: generator of row dicts
+    """
+    if stream.read(4) != columnar_magic:
+        raise ValueError("not a columnar usage export")
+
+    def read(fmt, n):
+        fmt = '<{0}{1}'.format(n, fmt)
+        return struct.unpack(fmt, stream.read(struct.calcsize(fmt)))
+
+    def strings(n):
+        return [stream.read(length).decode('utf-8') for length in read('I', n)]
+
+    while True:
+        (n,) = read('I', 1)
+        if not n:
+            break
+        block = [strings(n), strings(n)]
+        block += [[_epoch + v * _microsecond for v in read('q', n)] for _ in range(2)]
+        block += [[None if v != v else v for v in read('d', n)] for _ in metrics]
+        for row in zip(*block):
+            yield dict(zip(columns, row))
+
+
+writers = {
+    'csv': csv_chunks,
+    'jsonl': jsonl_chunks,
+    'columnar': columnar_chunks,
+}
+
+
+def export_usage(session, query, fmt='csv', batch_size=page_size):
+    """
+    export usage incrementally
+    :param session: database session
+    :param query: selectable of the usage columns
+    :param fmt: csv, jsonl or columnar
+    :param batch_size: rows fetched and written at a time
+    :return: generator of str (csv, jsonl) or bytes (columnar) chunks
+    """
+    return writers[fmt](iter_batches(session, query, batch_size))
+
+
+def get_usage_export(r, u=None, start=None, end=None, format='csv'):
+    """
+    stream resource usage as csv, JSON lines or columnar binary
+    :param r: resource
+    :param u: user, all users if not given (admins and group admins)
+    :param start: only usage starting at or after start
+    :param end: only usage ending at or before end
+    :param format: csv, jsonl or columnar
+    :return: streaming response
+    """
+    _, u, status = authorize_usage(r, u)
+    if status:
+        return NoContent, status
+    try:
+        start, end = usage_window(start, end)
+    except ValueError:
+        return 'Invalid start or end', 400
+    query = export_query(r, u, start, end)
+    return Response(stream_with_context(export_usage(db_session, query, format)), mimetype=formats[format])
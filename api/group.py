@@ -25,27 +25,60 @@ from connexion import NoContent
 from flask import session
 from sqlalchemy.exc import SQLAlchemyError
 
-from api.admin import is_admin, is_group_admin
-from db.group import Member, Group
+from api.acl import acl
+from api.admin import admins_only, is_admin, is_group_admin, principal
+from api.etag import conditional
+from api.paging import paginate, page_headers, page_size, stream_json_lines
+from db.group import Member, Group, group_resources
 from db.handler import db_session
 from db.user import User
 
 logger = logging.getLogger('api.group')
 
 
-def get_groups(active=False):
+def filter_groups(query, active=False, owner=None, prefix=None, resource=None):
+    """
+    filter a query on Group in the database
+    :param query: query on Group
+    :param active: only active groups
+    :param owner: dom_name of the owner
+    :param prefix: start of the group name
+    :param resource: id of an associated resource
+    :return: filtered query
+    """
+    if active:
+        query = query.filter(Group.active.is_(True))
+    if owner:
+        query = query.join(User, User.id == Group.user_id).filter(User.dom_name == owner)
+    if prefix:
+        query = query.filter(Group.name.startswith(prefix, autoescape=True))
+    if resource is not None:
+        query = query.join(group_resources, group_resources.c.group_id == Group.id)\
+            .filter(group_resources.c.resource_id == resource)
+    return query
+
+
+@conditional('groups', 'users', 'group_resources', authorize=admins_only)
+def get_groups(active=False, owner=None, prefix=None, resource=None, limit=None, after=None, stream=False):
     """
     list all groups (admins only)
     :param active: only show active groups
+    :param owner: only groups owned by this user (dom_name)
+    :param prefix: only groups with a name starting with prefix
+    :param resource: only groups associated with this resource id
+    :param limit: page size
+    :param after: only groups with an id larger than after
+    :param stream: stream as JSON lines
     :return: list of group
     """
     if not is_admin():
         return NoContent, 401
-    if active:
-        groups = [g.dump() for g in db_session.query(Group).all() if g.active]
-    else:
-        groups = [g.dump() for g in db_session.query(Group).all()]
-    return groups, 200
+    query = filter_groups(db_session.query(Group), active, owner, prefix, resource)
+    query = paginate(query, Group.id, limit, after)
+    if stream:
+        return stream_json_lines(g.dump() for g in query.yield_per(page_size))
+    groups = [g.dump() for g in query.all()]
+    return groups, 200, page_headers(groups, limit)
 
 
 def add_group(g):
@@ -81,11 +114,14 @@ def update_group(gid, g):
     if not is_group_admin(gid):
         return NoContent, 401
     group = db_session.query(Group).filter(Group.id == gid).one_or_none()
-    group.pop('id', None)
+    if not group:
+        return NoContent, 404
+    g.pop('id', None)
     try:
         for k in g:
             setattr(group, k, g[k])
         db_session.commit()
+        acl.clear()
         return NoContent, 200
     except SQLAlchemyError:
         logger.exception("error while updating group")
@@ -98,13 +134,9 @@ def get_group_users(gid):
     :param gid: group id
     :return: list of user
     """
-    if not is_admin():
-        u = None
-        if 'username' in session:
-            u = db_session.query(User).filter(User.dom_name == session['username']).one_or_none()
-        if not u or not db_session.query(Member).filter(Member.group_id == gid and Member.user_id == u.id).one_or_none():
-            logger.warning("user {0} not found as part of group".format(session['username']))
-            return NoContent, 401
+    if not is_admin() and not principal().is_member(gid):
+        logger.warning("user {0} not found as part of group".format(session.get('username')))
+        return NoContent, 401
     users = []
     for group_user in db_session.query(Member).filter(Member.group_id == gid).all():
         gu = db_session.query(User).filter(User.id == group_user.user_id).one_or_none()
@@ -130,6 +162,7 @@ def add_group_user(gid, u, admin):
     try:
         db_session.add(Member(group=group, user=u, admin=admin))
         db_session.commit()
+        acl.invalidate(('user', u.dom_name))
         return NoContent, 201
     except SQLAlchemyError:
         logger.exception("error while updating group")
@@ -150,8 +183,9 @@ def remove_group_user(gid, u):
         return 'User does not exist', 404
     group = db_session.query(Group).filter(Group.id == gid).one()
     try:
-        db_session.query(Member).filter(Member.group == group and Member.user == u).delete()
+        db_session.query(Member).filter(Member.group_id == group.id, Member.user_id == u.id).delete()
         db_session.commit()
+        acl.invalidate(('user', u.dom_name))
         return NoContent, 200
     except SQLAlchemyError:
         logger.exception("error while updating group")
@@ -0,0 +1,502 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2019, Pim Witlox. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+import fcntl
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from os.path import expandvars, expanduser
+
+from dateutil import parser
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+
+from api import encoding
+from api.rollup import refresh_rollups, update_rollups
+from db.handler import db_session, engines, insert_statement
+from db.resource import UsageBatch, metrics, usage_partitions
+
+logger = logging.getLogger('api.ingest')
+
+chunk_size = 5000
+# C implemented ISO-8601 parser, python 3.7+
+_fromisoformat = getattr(datetime, 'fromisoformat', None)
+
+
+def parse_timestamp(value):
+    """
+    parse a timestamp to a naive UTC datetime
+    ISO-8601 timestamps (YYYY-MM-DD[T ]HH:MM:SS[.ffffff][Z|+HH:MM]) are sliced directly, other formats use dateutil
+    :param value: timestamp string or datetime
+    :return: datetime
+    :raises ValueError: unparsable timestamp
+    """
+    if not isinstance(value, datetime):
+        if len(value) >= 19 and value[4] == '-' and value[7] == '-' and value[10] in 'T ' and value[13] == ':' and value[16] == ':':
+            try:
+                if _fromisoformat:
+                    return _from_isoformat(value)
+                return _parse_iso(value)
+            except ValueError:
+                pass
+        value = parser.parse(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _from_isoformat(value):
+    try:
+        result = _fromisoformat(value[:-1] if value[-1] == 'Z' else value)
+    except ValueError:
+        return _parse_iso(value)
+    if result.tzinfo is not None:
+        result = (result - result.utcoffset()).replace(tzinfo=None)
+    return result
+
+
+def _parse_iso(value):
+    microsecond = 0
+    rest = value[19:]
+    if rest[:1] == '.':
+        end = 1
+        while end < len(rest) and rest[end].isdigit():
+            end += 1
+        microsecond = int((rest[1:end] + '000000')[:6])
+        rest = rest[end:]
+    result = datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                      int(value[11:13]), int(value[14:16]), int(value[17:19]), microsecond)
+    if not rest or rest == 'Z':
+        return result
+    if rest[0] in '+-' and len(rest) in (3, 5, 6):
+        offset = timedelta(hours=int(rest[1:3]), minutes=int(rest[-2:]) if len(rest) > 3 else 0)
+        return result + offset if rest[0] == '-' else result - offset
+    raise ValueError("invalid timezone in {0}".format(value))
+
+
+def prepare_usage(usage):
+    """
+    convert a ResourceUsage record of the API to a row of the resource_usage table
+    :param usage: dict with r, u, start, end, optional record id and optional metrics
+    :return: row dict
+    :raises ValueError: invalid record
+    """
+    row = dict(resource=usage['r'],
+               user=usage['u'],
+               start=parse_timestamp(usage['start']),
+               end=parse_timestamp(usage['end']),
+               record=usage.get('record') or '')
+    if row['end'] < row['start']:
+        raise ValueError("usage ends before it starts")
+    if not isinstance(row['record'], str) or len(row['record']) > 100:
+        raise ValueError("invalid record id")
+    for metric in metrics:
+        row[metric] = usage.get(metric)
+    return row
+
+
+def _key(row):
+    return row['resource'], row['user'], row['start'], row['end'], row['record']
+
+
+def unstored(table, rows):
+    """
+    rows that are not stored yet, with one query of the keys stored in the window of the rows, rows repeated within
+    the list are kept once
+    :param table: usage table
+    :param rows: list of row dicts
+    :return: list of row dicts
+    """
+    starts = [row['start'] for row in rows]
+    query = select([table.c.resource, table.c.user, table.c.start, table.c.end, table.c.record])\
+        .where(table.c.resource.in_(set(row['resource'] for row in rows)))\
+        .where(table.c.start.between(min(starts), max(starts)))
+    stored = set(tuple(key) for key in db_session.execute(query))
+    result = []
+    for row in rows:
+        key = _key(row)
+        if key not in stored:
+            stored.add(key)
+            result.append(row)
+    return result
+
+
+def insert_usages(rows):
+    """
+    insert usage rows into their partitions and add them to the rollups, rows already stored are skipped and rows of
+    archived periods rejected
+    :param rows: list of row dicts
+    :return: (number of rows inserted, number of rows rejected)
+    """
+    dialect = db_session.get_bind().dialect.name
+    inserted = 0
+    added = []
+    raced = []
+    routed = usage_partitions.route(db_session, rows)
+    archived = routed.pop(None, [])
+    if archived:
+        logger.warning("rejected {0} usage records of archived periods".format(len(archived)))
+    for table, partition in routed.items():
+        partition = unstored(table, partition)
+        if not partition:
+            continue
+        result = db_session.execute(insert_statement(table, dialect), partition)
+        if 0 <= result.rowcount < len(partition):
+            # another transaction stored some of the rows since they were looked up, which ones is unknown
+            inserted += result.rowcount
+            raced.extend(partition)
+        else:
+            # all of them, also for drivers without executemany row counts (-1)
+            inserted += len(partition)
+            added.extend(partition)
+    update_rollups(db_session, added)
+    if raced:
+        # rare, recompute the buckets these rows fall in from the raw usage
+        refresh_rollups(db_session, raced)
+    return inserted, len(archived)
+
+
+def insert_batch(usages):
+    """
+    validate and insert resource usage records without committing, rows are written with one executemany per chunk
+    and partition
+    :param usages: iterable of ResourceUsage records
+    :return: (accepted, rejected, duplicates)
+    """
+    accepted = 0
+    rejected = 0
+    valid = 0
+    chunk = []
+    for usage in usages:
+        try:
+            chunk.append(prepare_usage(usage))
+        except (KeyError, TypeError, ValueError, OverflowError) as e:
+            logger.debug("rejected usage record {0} ({1})".format(usage, e))
+            rejected += 1
+            continue
+        valid += 1
+        if len(chunk) >= chunk_size:
+            inserted, archived = insert_usages(chunk)
+            accepted += inserted
+            rejected += archived
+            valid -= archived
+            chunk = []
+    if chunk:
+        inserted, archived = insert_usages(chunk)
+        accepted += inserted
+        rejected += archived
+        valid -= archived
+    return accepted, rejected, valid - accepted
+
+
+def ingest_usages(usages):
+    """
+    validate and insert resource usage records in a single transaction
+    :param usages: iterable of ResourceUsage records
+    :return: (accepted, rejected, duplicates)
+    """
+    try:
+        result = insert_batch(usages)
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    return result
+
+
+class QueueFull(Exception):
+    pass
+
+
+class IngestQueue(object):
+    """
+    bounded queue of usage batches drained by a background writer thread
+    batches are written to a spool directory of this queue before they are acknowledged and removed once committed,
+    the directory is locked while the process lives
+    when the writer starts it takes over the batches of directories no longer locked, left by processes that ended,
+    and the batch files put in the spool itself, batches that fail are moved to the failed directory of the spool
+    queued batches are coalesced into transactions of up to batch_rows records
+    the status of the batches is stored in the database so every worker answers for every batch, the status of the
+    last history finished batches is kept
+    """
+
+    def __init__(self, size=100, spool=None, batch_rows=50000, history=10000):
+        self.queue = queue.Queue(size)
+        self.spool = expandvars(expanduser(spool)) if spool else None
+        self.directory = None
+        self.batch_rows = batch_rows
+        self.history = history
+        self._lockfile = None
+        self._thread = None
+        if self.spool:
+            self._claim()
+
+    def _claim(self):
+        # the directory is locked before it gets its name, so other processes never take over a directory in use
+        name = '{0}-{1}'.format(os.getpid(), uuid.uuid4().hex[:8])
+        os.makedirs(os.path.join(self.spool, '.' + name))
+        self._lockfile = open(os.path.join(self.spool, '.' + name, 'lock'), 'w')
+        fcntl.flock(self._lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.directory = os.path.join(self.spool, name)
+        os.rename(os.path.join(self.spool, '.' + name), self.directory)
+
+    def _release(self):
+        # the directory and the batches left in it are taken over by the next writer that starts
+        if self._lockfile:
+            self._lockfile.close()
+            self._lockfile = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='ingest-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        stop the writer once the batches queued so far are written
+        :param timeout: seconds to wait for the writer
+        """
+        if self._thread and self._thread.is_alive():
+            try:
+                self.queue.put(None, timeout=timeout)
+            except queue.Full:
+                logger.error("ingest queue did not drain, stopping without writing queued batches")
+                return
+            self._thread.join(timeout)
+        if not (self._thread and self._thread.is_alive()):
+            self._release()
+
+    def submit(self, usages, subject=None):
+        """
+        queue a batch of usage records
+        :param usages: list of ResourceUsage records
+        :param subject: name of the submitter
+        :return: batch id
+        :raises QueueFull: when the queue holds the maximum number of batches
+        """
+        if self.queue.full():
+            raise QueueFull()
+        bid = uuid.uuid4().hex
+        if self.spool:
+            self._spool(bid, usages, subject)
+        self._queued(bid, subject, len(usages), datetime.utcnow())
+        try:
+            self.queue.put_nowait((bid, usages))
+        except queue.Full:
+            self._finish(bid, 'rejected')
+            self._unspool(bid)
+            raise QueueFull()
+        return bid
+
+    def _store(self, bid, **values):
+        # transactions of their own on the writer, the session of the writer thread may be in the middle of one
+        table = UsageBatch.__table__
+        try:
+            with engines['writer'].begin() as connection:
+                result = connection.execute(table.update().where(table.c.batch == bid).values(**values))
+                if result.rowcount == 0:
+                    connection.execute(table.insert().values(batch=bid, **values))
+        except SQLAlchemyError:
+            logger.exception("could not store the status of batch {0}".format(bid))
+
+    def _queued(self, bid, subject, records, submitted):
+        self._store(bid, status='queued', subject=subject, records=records, submitted=submitted, accepted=None,
+                    rejected=None, duplicates=None, finished=None)
+
+    def status(self, bid):
+        """
+        status of a batch queued by any worker
+        :param bid: batch id
+        :return: dict or None when the batch is unknown
+        """
+        table = UsageBatch.__table__
+        # read from the writer, a replica may not have the batch yet
+        with engines['writer'].connect() as connection:
+            row = connection.execute(select(list(UsageBatch.columns())).where(table.c.batch == bid)).first()
+        if row is None:
+            return None
+        batch = UsageBatch.dump_row(row)
+        batch['id'] = batch.pop('batch')
+        return batch
+
+    def _path(self, bid):
+        return os.path.join(self.directory, '{0}.json'.format(bid))
+
+    def _spool(self, bid, usages, subject):
+        path = self._path(bid)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(encoding.dumps(dict(subject=subject, usages=usages)).encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+
+    def _unspool(self, bid):
+        if self.spool:
+            try:
+                os.remove(self._path(bid))
+            except OSError:
+                logger.warning("could not remove spooled batch {0}".format(bid))
+
+    def _fail(self, bid):
+        # kept for inspection, moved back into the spool directory they are ingested by the next writer that starts
+        if self.spool:
+            failed = os.path.join(self.spool, 'failed')
+            try:
+                os.makedirs(failed, exist_ok=True)
+                os.rename(self._path(bid), os.path.join(failed, '{0}.json'.format(bid)))
+            except OSError:
+                logger.warning("could not move failed batch {0}".format(bid))
+
+    def _finish(self, bid, status, accepted=None, rejected=None, duplicates=None):
+        self._store(bid, status=status, accepted=accepted, rejected=rejected, duplicates=duplicates,
+                    finished=datetime.utcnow())
+
+    def _prune(self):
+        table = UsageBatch.__table__
+        try:
+            with engines['writer'].begin() as connection:
+                oldest = connection.execute(select([table.c.finished]).where(table.c.finished.isnot(None))
+                                            .order_by(table.c.finished.desc()).offset(self.history).limit(1)).scalar()
+                if oldest is not None:
+                    connection.execute(table.delete().where(table.c.finished <= oldest))
+        except SQLAlchemyError:
+            logger.exception("could not remove the status of old batches")
+
+    def _take(self, path):
+        # renames are atomic, of processes taking over the same file only one succeeds
+        target = os.path.join(self.directory, os.path.basename(path))
+        try:
+            os.rename(path, target)
+        except OSError:
+            return None
+        return target
+
+    def _take_over(self, directory):
+        try:
+            lockfile = open(os.path.join(directory, 'lock'))
+        except OSError:
+            return []
+        with lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                names = os.listdir(directory)
+            except OSError:
+                # locked by a live process or removed by another one taking it over
+                return []
+            paths = [self._take(os.path.join(directory, n)) for n in names if n.endswith('.json')]
+            shutil.rmtree(directory, ignore_errors=True)
+        return [p for p in paths if p]
+
+    def _recover(self):
+        if not self.spool:
+            return
+        paths = []
+        for name in os.listdir(self.spool):
+            path = os.path.join(self.spool, name)
+            if name.endswith('.json'):
+                paths.append(self._take(path))
+            elif os.path.isdir(path) and not name.startswith('.') and name != 'failed' and path != self.directory:
+                paths.extend(self._take_over(path))
+        for path in sorted((p for p in paths if p), key=os.path.getmtime):
+            bid = os.path.basename(path)[:-len('.json')]
+            try:
+                with open(path, 'rb') as f:
+                    spooled = json.loads(f.read().decode('utf-8'))
+                usages = spooled['usages']
+            except (OSError, ValueError, KeyError, TypeError):
+                logger.exception("could not read spooled batch {0}".format(bid))
+                self._fail(bid)
+                continue
+            logger.info("recovering spooled batch {0}".format(bid))
+            self._queued(bid, spooled.get('subject'), len(usages), datetime.utcfromtimestamp(os.path.getmtime(path)))
+            self._write([(bid, usages)])
+
+    def _run(self):
+        self._recover()
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                break
+            group = [item]
+            rows = len(item[1])
+            while rows < self.batch_rows:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                group.append(item)
+                rows += len(item[1])
+            self._write(group)
+
+    def _write(self, group):
+        try:
+            results = [(bid, insert_batch(usages)) for bid, usages in group]
+            db_session.commit()
+        except Exception:
+            db_session.rollback()
+            db_session.remove()
+            if len(group) > 1:
+                # isolate the failing batch
+                for item in group:
+                    self._write([item])
+                return
+            logger.exception("failed to ingest batch {0}".format(group[0][0]))
+            self._finish(group[0][0], 'failed')
+            self._fail(group[0][0])
+            return
+        db_session.remove()
+        for bid, (accepted, rejected, duplicates) in results:
+            self._finish(bid, 'done', accepted, rejected, duplicates)
+            self._unspool(bid)
+        self._prune()
+
+
+ingest_queue = None
+
+
+def init_queue(ingest_config):
+    """
+    start the ingest queue when asynchronous ingestion is enabled
+    :param ingest_config: ingest section of the configuration
+    :return: IngestQueue or None
+    """
+    global ingest_queue
+    if ingest_queue:
+        ingest_queue.stop(5)
+        ingest_queue = None
+    if not ingest_config.get('async'):
+        return None
+    bind = db_session.get_bind()
+    if bind.dialect.name == 'sqlite' and bind.url.database in (None, '', ':memory:'):
+        logger.error("asynchronous ingestion needs a file or server database, ingesting synchronously")
+        return None
+    ingest_queue = IngestQueue(ingest_config.queue_size, ingest_config.get('spool'), ingest_config.batch_rows)
+    ingest_queue.start()
+    return ingest_queue
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2019, Pim Witlox. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+import logging
+
+from connexion import NoContent
+
+from api.acl import acl
+from api.admin import is_admin
+from api.validation import stats as validation
+from db.handler import pool_stats
+
+logger = logging.getLogger('api.metrics')
+
+
+def get_metrics():
+    """
+    runtime metrics (admins)
+    :return: dict of metrics per component
+    """
+    if not is_admin():
+        return NoContent, 401
+    return dict(acl=acl.stats(), validation=validation.stats(), database=pool_stats()), 200
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2019, Pim Witlox. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+from flask import Response, stream_with_context
+
+from api import encoding
+
+page_size = 1000
+
+
+def paginate(query, column, limit=None, after=None):
+    """
+    keyset pagination on a unique, increasing column
+    :param query: query to paginate
+    :param column: key column, usually the id
+    :param limit: maximum number of rows
+    :param after: only rows with a key larger than after
+    :return: ordered and limited query
+    """
+    if after is not None:
+        query = query.filter(column > after)
+    query = query.order_by(column)
+    if limit:
+        query = query.limit(limit)
+    return query
+
+
+def page_headers(items, limit, key='id'):
+    """
+    headers pointing to the next page, only when the page is full
+    :param items: dumped items of this page
+    :param limit: page size requested
+    :param key: key of the cursor in the dumped items
+    :return: dict of headers
+    """
+    if limit and len(items) == limit:
+        return {'X-Next-After': str(items[-1][key])}
+    return {}
+
+
+def stream_json_lines(items):
+    """
+    stream items as JSON lines (application/x-ndjson), one object per line
+    :param items: iterable of dicts, preferably fed from a server side cursor (Query.yield_per)
+    :return: streaming response
+    """
+    def generate():
+        for item in items:
+            yield encoding.dumps(item) + '\n'
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
@@ -22,28 +22,60 @@
 import logging
 
 from connexion import NoContent
-from dateutil import parser
-from flask import session
+from flask import request, session
+from sqlalchemy import and_
 from sqlalchemy.exc import SQLAlchemyError
 
-from api.admin import is_admin, user_is_group_admin
-from api.group import get_groups
-from db.group import Group, Member
+from api.acl import acl
+from api.admin import admins_only, is_admin, principal, cached_principal
+from api.etag import conditional
+from api.group import filter_groups
+from api import ingest, streaming
+from api.ingest import QueueFull, ingest_usages, parse_timestamp
+from api.paging import paginate, page_headers, page_size, stream_json_lines
+from db.group import Group, group_resources
 from db.handler import db_session
-from db.resource import Resource, ResourceUsage
+from db.resource import Resource, ResourceUsage, usage_partitions
 from db.user import User
 
 logger = logging.getLogger('api.resource')
 
 
-def get_resources():
+def load_resource_group_ids(rid):
+    """
+    ids of the groups associated with a resource
+    :param rid: resource id
+    :return: set of group ids
+    """
+    query = db_session.query(group_resources.c.group_id).filter(group_resources.c.resource_id == rid)
+    return frozenset(gid for (gid,) in query.all())
+
+
+def resource_group_ids(rid):
+    """
+    ids of the groups associated with a resource (cached)
+    :param rid: resource id
+    :return: set of group ids
+    """
+    return acl.get(('resource', rid), load_resource_group_ids, rid)
+
+
+@conditional('resources', authorize=admins_only)
+def get_resources(limit=None, after=None, stream=False):
     """
     list all resources (admins)
+    :param limit: page size
+    :param after: only resources with an id larger than after
+    :param stream: stream as JSON lines
     :return: list of resource
     """
     if not is_admin():
         return NoContent, 401
-    return [r.dump() for r in db_session.query(Resource).all()], 200
+    query = paginate(db_session.query(Resource), Resource.id, limit, after)
+    if stream:
+        return stream_json_lines(r.dump() for r in query.yield_per(page_size))
+    resources = [r.dump() for r in query.all()]
+    return resources, 200, page_headers(resources, limit)
 
 
 def add_resource(name):
@@ -73,18 +105,10 @@ def get_resource_groups(rid):
     """
     if not is_admin():
         return NoContent, 401
-
-    def evaluate_resource_groups(resource, gid):
-        for group in resource.groups:
-            if gid == group.id:
-                return True
-        return False
-
-    r = db_session.query(Resource).filter(Resource.id == rid).one_or_none()
-    if not r:
+    if not db_session.query(Resource.id).filter(Resource.id == rid).scalar():
         return NoContent, 404
-    groups, code = get_groups(True)
-    return [group for group in groups if evaluate_resource_groups(r, group['id'])], 200
+    query = filter_groups(db_session.query(Group), active=True, resource=rid).order_by(Group.id)
+    return [g.dump() for g in query.all()], 200
 
 
 def update_resource(rid, resource_update):
@@ -127,6 +151,7 @@ def add_resource_group(rid, name):
     try:
         r.groups.append(g)
         db_session.commit()
+        acl.invalidate(('resource', rid))
         return NoContent, 201
     except SQLAlchemyError:
         logger.exception("error while updating group")
@@ -151,6 +176,7 @@ def remove_resource_group(rid, name):
     try:
         r.groups.remove(g)
         db_session.commit()
+        acl.invalidate(('resource', rid))
         return NoContent, 201
     except SQLAlchemyError:
         logger.exception("error while updating group")
@@ -159,62 +185,158 @@ def remove_resource_group(rid, name):
 
 def add_resource_usage(usages):
     """
-    add resource usage records
+    add resource usage records, with asynchronous ingestion the records are queued
     :param usages: list of ResourceUsage
-    :return: success or failure
+    :return: counts of accepted, rejected and duplicate records, or the queued batch
     """
     if not is_admin():
         if 'service' not in session:
             return NoContent, 401
-    if not is_admin():
         invalid = [u for u in usages if u['r'] != session['username']]
         if len(invalid) > 0:
             return 'Invalid records found, can only insert your own', 500
-        for usage in usages:
-            usage['resource'] = usage['r']
-            usage['user'] = usage['u']
-            usage.pop('r', None)
-            usage.pop('u', None)
-            db_session.add(ResourceUsage(**usage))
-        return NoContent, 201
+    if ingest.ingest_queue:
+        try:
+            bid = ingest.ingest_queue.submit(usages, session.get('username'))
+        except QueueFull:
+            logger.warning("ingest queue full, rejecting batch of {0} records".format(len(usages)))
+            return 'Ingest queue full, retry later', 429, {'Retry-After': '1'}
+        except OSError:
+            logger.exception("error while spooling resource usage")
+            return NoContent, 500
+        return ingest.ingest_queue.status(bid), 202
+    try:
+        accepted, rejected, duplicates = ingest_usages(usages)
+    except SQLAlchemyError:
+        logger.exception("error while adding resource usage")
+        return NoContent, 500
+    return dict(accepted=accepted, rejected=rejected, duplicates=duplicates), 201
+
+
+class ForeignUsage(Exception):
+    pass
+
+
+def own_usages(usages, name):
     for usage in usages:
-        usage['resource'] = usage['r']
-        usage['user'] = usage['u']
-        usage['start'] = parser.parse(usage['start'])
-        usage['end'] = parser.parse(usage['end'])
-        usage.pop('r', None)
-        usage.pop('u', None)
-        db_session.add(ResourceUsage(**usage))
-    return NoContent, 201
+        if isinstance(usage, dict) and usage.get('r') != name:
+            raise ForeignUsage()
+        yield usage
+
+
+def add_resource_usage_stream():
+    """
+    add resource usage records posted as newline delimited JSON or msgpack, records are read from the request stream
+    and inserted in chunks as they arrive, always synchronously, also when asynchronous ingestion is enabled
+    :return: counts of accepted, rejected and duplicate records
+    """
+    if not is_admin() and 'service' not in session:
+        return NoContent, 401
+    read = streaming.reader(request.mimetype)
+    if read is None:
+        return 'Unsupported content type', 415
+    usages = read(request.stream)
+    if not is_admin():
+        usages = own_usages(usages, session['username'])
+    try:
+        accepted, rejected, duplicates = ingest_usages(usages)
+    except ForeignUsage:
+        return 'Invalid records found, can only insert your own', 500
+    except SQLAlchemyError:
+        logger.exception("error while adding resource usage")
+        return NoContent, 500
+    return dict(accepted=accepted, rejected=rejected, duplicates=duplicates), 201
+
+
+def get_usage_batch(bid):
+    """
+    status of an asynchronously ingested usage batch (admins and the submitter)
+    :param bid: batch id
+    :return: batch status
+    """
+    batch = ingest.ingest_queue.status(bid) if ingest.ingest_queue else None
+    if batch is None:
+        return NoContent, 404
+    if not is_admin() and batch['subject'] != session.get('username'):
+        return NoContent, 401
+    return batch, 200
+
+
+def authorize_usage(r, u=None):
+    """
+    check access to the usage of a resource: admins see all usage, users their own and group admins the usage of
+    the members of their groups associated with the resource
+    :param r: resource name
+    :param u: user (dom_name), for non admins this defaults to themselves
+    :return: (resource, user, error status or None)
+    """
+    resource = db_session.query(Resource).filter(Resource.name == r).one_or_none()
+    if not is_admin():
+        p = principal()
+        u = u or p.name
+        if not resource or not p.uid:
+            return resource, u, 401
+        if u != p.name:
+            target = cached_principal(u)
+            if not any(p.is_group_admin(gid) and target.is_member(gid) for gid in resource_group_ids(resource.id)):
+                return resource, u, 401
+    if not resource:
+        return resource, u, 404
+    if u and not db_session.query(User.id).filter(User.dom_name == u).scalar():
+        return resource, u, 404
+    return resource, u, None
 
 
+def usage_access(r, u=None, **kwargs):
+    """
+    authorization of the usage handlers, see api.etag.conditional
+    :param r: resource name
+    :param u: user (dom_name)
+    :return: error status or None
+    """
+    return authorize_usage(r, u)[2]
+
+
+def usage_window(start=None, end=None):
+    """
+    parse the boundaries of a usage query
+    :param start: start date-time
+    :param end: end date-time
+    :return: (start, end) as naive UTC datetimes or None
+    :raises ValueError: invalid date-time
+    """
+    return (parse_timestamp(start) if start else None,
+            parse_timestamp(end) if end else None)
+
+
+@conditional('resource_usage', 'resources', 'group_resources', authorize=usage_access)
 def get_resource_usage(r, u=None, start=None, end=None):
     """
     get resource usage for a resource for a given user
-    :param u: user
+    :param u: user, all users if not given (admins and group admins)
     :param r: resource
-    :param start: start time
-    :param end: end time
+    :param start: only usage starting at or after start
+    :param end: only usage ending at or before end
     :return: list of ResourceUsage
     """
-    resource = db_session.query(Resource).filter(Resource.name == r).one_or_none()
-    user = db_session.query(User).filter(User.dom_name == u).one_or_none()
-    if not is_admin():
-        if not resource or not user:
-            return NoContent, 401
-        allowed = False
-        if u and session['username'] is not u:
-            for g in resource.groups:
-                if db_session.query(Member).filter(Member.group_id ==  g.id and Member.user_id == user.id).one_or_none():
-                    if user_is_group_admin(u, g.name):
-                        allowed = True
-        if not allowed:
-            return NoContent, 401
-    if not resource or not user:
-        return NoContent, 404
-    usages = db_session.query(ResourceUsage).filter(ResourceUsage.resouce == r and
-                                                    ResourceUsage.user == u and
-                                                    ResourceUsage.start == start and
-                                                    ResourceUsage.end == end).all()
+    resource, u, status = authorize_usage(r, u)
+    if status:
+        return NoContent, status
+    try:
+        start, end = usage_window(start, end)
+    except ValueError:
+        return 'Invalid start or end', 400
+
+    def where(table):
+        clauses = [table.c.resource == r]
+        if u:
+            clauses.append(table.c.user == u)
+        if start:
+            clauses.append(table.c.start >= start)
+        if end:
+            clauses.append(table.c.end <= end)
+        return and_(*clauses)
 
-    return [u.dump() for u in usages], 200
+    keys = ResourceUsage.serializer().keys
+    query = usage_partitions.select(db_session, lambda table: [table.c[k] for k in keys], start, end, where, order_by='start')
+    return [ResourceUsage.dump_row(row) for row in db_session.execute(query)], 200
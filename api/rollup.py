@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2019, Pim Witlox. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+
+import logging
+import sqlite3
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, bindparam, case, func, literal_column, select, text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+
+from db.handler import insert_statement, mark_changed
+from db.resource import HourlyUsage, DailyUsage, RollupWatermark, UsagePartition, metrics, usage_partitions
+
+logger = logging.getLogger('api.rollup')
+
+rollups = (HourlyUsage, DailyUsage)
+
+
+def truncate(when, period):
+    """
+    start of the hour or day of a timestamp
+    :param when: datetime
+    :param period: hour or day
+    :return: datetime
+    """
+    if period == 'hour':
+        return datetime(when.year, when.month, when.day, when.hour)
+    return datetime(when.year, when.month, when.day)
+
+
+def aggregate(rows, period, totals=None):
+    """
+    aggregate usage rows per resource, user and bucket
+    :param rows: iterable of usage rows (dicts or result rows)
+    :param period: hour or day
+    :param totals: totals to add to
+    :return: dict of (resource, user, bucket) to [count, cpu, gpu, mem, disk]
+    """
+    if totals is None:
+        totals = {}
+    for row in rows:
+        key = (row['resource'], row['user'], truncate(row['start'], period))
+        total = totals.get(key)
+        if total is None:
+            total = totals[key] = [0] + [None] * len(metrics)
+        total[0] += 1
+        for i, metric in enumerate(metrics, 1):
+            value = row[metric]
+            if value is not None:
+                total[i] = float(value) if total[i] is None else total[i] + float(value)
+    return totals
+
+
+def _increments(table, added):
+    values = dict(count=table.c.count + added('count'))
+    for metric in metrics:
+        value = added(metric)
+        values[metric] = case([(value.is_(None), table.c[metric])], else_=func.coalesce(table.c[metric], 0) + value)
+    return values
+
+
+def _update_statement(table):
+    values = _increments(table, lambda c: bindparam('b_{0}'.format(c), type_=table.c[c].type))
+    return table.update().where(and_(table.c.resource == bindparam('b_resource'),
+                                     table.c.user == bindparam('b_user'),
+                                     table.c.bucket == bindparam('b_bucket'))).values(**values)
+
+
+def _sqlite_upsert(table, dialect):
+    # SQLAlchemy 1.3 has no SQLite upsert construct, the statement is rendered with the types of the columns
+    quote = dialect.identifier_preparer.quote
+    columns = ['resource', 'user', 'bucket', 'count'] + list(metrics)
+    values = _increments(table, lambda c: literal_column('excluded.{0}'.format(quote(c))))
+    updates = ', '.join('{0} = {1}'.format(quote(c), values[c].compile(dialect=dialect,
+                                                                      compile_kwargs=dict(literal_binds=True)))
+                        for c in columns[3:])
+    statement = 'INSERT INTO {0} ({1}) VALUES ({2}) ON CONFLICT ({3}) DO UPDATE SET {4}'.format(
+        quote(table.name), ', '.join(quote(c) for c in columns), ', '.join(':{0}'.format(c) for c in columns),
+        ', '.join(quote(c) for c in columns[:3]), updates)
+    return text(statement).bindparams(*[bindparam(c, type_=table.c[c].type) for c in columns])
+
+
+def upsert_statement(table, dialect):
+    """
+    insert of rollup buckets adding to the buckets that exist, in one statement per bucket
+    :param table: rollup table
+    :param dialect: database dialect
+    :return: statement or None when the database has no upsert
+    """
+    if dialect.name == 'postgresql':
+        statement = postgresql_insert(table)
+        return statement.on_conflict_do_update(index_elements=[table.c.resource, table.c.user, table.c.bucket],
+                                               set_=_increments(table, lambda c: statement.excluded[c]))
+    if dialect.name == 'mysql':
+        statement = mysql_insert(table)
+        return statement.on_duplicate_key_update(**_increments(table, lambda c: statement.inserted[c]))
+    if dialect.name == 'sqlite' and sqlite3.sqlite_version_info >= (3, 24, 0):
+        return _sqlite_upsert(table, dialect)
+    return None
+
+
+def apply_totals(session, model, totals):
+    """
+    add totals to a rollup table as an upsert, so workers never collide on the bucket key: a single upsert per bucket
+    where the database has one, else missing buckets are inserted empty, skipping the ones that exist or another worker
+    inserts concurrently, and then every bucket is incremented
+    :param session: database session
+    :param model: rollup model
+    :param totals: result of aggregate
+    """
+    if not totals:
+        return
+    table = model.__table__
+    dialect = session.get_bind().dialect
+    # a fixed order, so concurrent transactions lock the buckets in the same order
+    keys = sorted(totals)
+    upsert = upsert_statement(table, dialect)
+    if upsert is not None:
+        rows = []
+        for key in keys:
+            row = dict(resource=key[0], user=key[1], bucket=key[2], count=totals[key][0])
+            row.update(zip(metrics, totals[key][1:]))
+            rows.append(row)
+        session.execute(upsert, rows)
+        mark_changed(session, table.name)
+        return
+    session.execute(insert_statement(table, dialect.name),
+                    [dict(resource=k[0], user=k[1], bucket=k[2], count=0) for k in keys])
+    updates = []
+    for key in keys:
+        row = dict(b_resource=key[0], b_user=key[1], b_bucket=key[2], b_count=totals[key][0])
+        row.update(('b_{0}'.format(m), v) for m, v in zip(metrics, totals[key][1:]))
+        updates.append(row)
+    session.execute(_update_statement(table), updates)
+
+
+def update_rollups(session, rows):
+    """
+    add freshly inserted usage rows to the rollups, within the transaction of the insert
+    :param session: database session
+    :param rows: list of row dicts
+    """
+    for model in rollups:
+        apply_totals(session, model, aggregate(rows, model.period))
+
+
+def refresh_rollups(session, rows):
+    """
+    recompute the rollup buckets touched by usage rows from the raw usage, within the transaction of the insert
+    used when another transaction stored some of the rows concurrently, so which ones were inserted is unknown
+    :param session: database session
+    :param rows: list of row dicts
+    """
+    if not rows:
+        return
+    start, end = window(min(r['start'] for r in rows), max(r['start'] for r in rows) + timedelta(microseconds=1))
+    totals = raw_totals(session, start, end, set(r['resource'] for r in rows), set(r['user'] for r in rows))
+    for model in rollups:
+        table = model.__table__
+        touched = set(aggregate(rows, model.period))
+        total = dict((k, v) for k, v in totals[model].items() if k in touched)
+        session.execute(table.delete().where(and_(table.c.resource == bindparam('b_resource'),
+                                                  table.c.user == bindparam('b_user'),
+                                                  table.c.bucket == bindparam('b_bucket'))),
+                        [dict(b_resource=k[0], b_user=k[1], b_bucket=k[2]) for k in touched])
+        apply_totals(session, model, total)
+
+
+def window(start=None, end=None):
+    """
+    widen a window to whole days, so it covers complete hourly and daily buckets
+    :return: (start, end) or None for open ends
+    """
+    if start:
+        start = truncate(start, 'day')
+    if end and end != truncate(end, 'day'):
+        end = truncate(end, 'day') + timedelta(days=1)
+    return start, end
+
+
+def raw_totals(session, start=None, end=None, resources=None, users=None):
+    """
+    aggregate the raw usage starting in a window per rollup
+    :param resources: only usage of these resources
+    :param users: only usage of these users
+    :return: dict of model to totals
+    """
+    def where(table):
+        clauses = []
+        if resources:
+            clauses.append(table.c.resource.in_(resources))
+        if users:
+            clauses.append(table.c.user.in_(users))
+        if start:
+            clauses.append(table.c.start >= start)
+        if end:
+            clauses.append(table.c.start < end)
+        return and_(*clauses)
+
+    def columns(table):
+        return [table.c.resource, table.c.user, table.c.start] + [table.c[m] for m in metrics]
+
+    totals = dict((model, {}) for model in rollups)
+    for row in session.execute(usage_partitions.select(session, columns, start, end, where)):
+        for model in rollups:
+            aggregate((row,), model.period, totals[model])
+    return totals
+
+
+def watermarks(session):
+    """
+    start of the usage each rollup holds completely, summaries of earlier usage are answered from the raw usage
+    :param session: database session
+    :return: dict of rollup table name to datetime, None (or missing) when the rollup holds all usage
+    """
+    return dict(session.query(RollupWatermark.name, RollupWatermark.start).all())
+
+
+def seed_watermarks(session):
+    """
+    record the watermarks of the rollups once per database: the rollups of a database that holds usage already, for
+    instance one upgraded from a version without rollups, are complete from the day after the latest usage on, until
+    rollup-usage rebuilds them
+    :param session: database session
+    """
+    existing = set(n for (n,) in session.query(RollupWatermark.name))
+    missing = [model.__tablename__ for model in rollups if model.__tablename__ not in existing]
+    if not missing:
+        return
+    usage = usage_partitions.select(session, lambda table: [table.c.start]).alias('usage')
+    latest = session.execute(select([func.max(usage.c.start)])).scalar()
+    start = truncate(latest, 'day') + timedelta(days=1) if latest else None
+    try:
+        session.execute(insert_statement(RollupWatermark.__table__, session.get_bind().dialect.name),
+                        [dict(name=name, start=start) for name in missing])
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    if start:
+        logger.warning("usage rollups are complete from {0} on, run rollup-usage to include earlier usage".format(start))
+
+
+def _bucket_filter(table, start, end):
+    clauses = []
+    if start:
+        clauses.append(table.c.bucket >= start)
+    if end:
+        clauses.append(table.c.bucket < end)
+    return and_(*clauses)
+
+
+def rebuild_rollups(session, start=None, end=None):
+    """
+    recompute the rollups of a window (widened to whole days) from the raw usage
+    :param session: database session
+    :param start: window start or None
+    :param end: window end or None
+    :return: dict of rollup table name to number of buckets
+    """
+    start, end = window(start, end)
+    totals = raw_totals(session, start, end)
+    marks = RollupWatermark.__table__
+    # a window covering the watermark completes the rollups from its start on
+    covered = [marks.c.start.isnot(None)]
+    if start:
+        covered.append(marks.c.start >= start)
+    if end:
+        covered.append(marks.c.start <= end)
+    try:
+        for model, total in totals.items():
+            table = model.__table__
+            session.execute(table.delete().where(_bucket_filter(table, start, end)))
+            apply_totals(session, model, total)
+            session.execute(marks.update().where(and_(marks.c.name == table.name, *covered)).values(start=start))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return dict((model.__tablename__, len(total)) for model, total in totals.items())
+
+
+def archive_partition(session, name):
+    """
+    archive a usage partition and rebuild the rollups of its period, archived usage is not counted by the raw usage
+    queries so the rollups drop it as well
+    :param session: database session
+    :param name: partition table name
+    :return: archived yes/no
+    """
+    if not usage_partitions.archive(session, name):
+        return False
+    partition = session.query(UsagePartition).filter(UsagePartition.name == name).one()
+    rebuild_rollups(session, partition.start, partition.end)
+    return True
+
+
+def check_rollups(session, start=None, end=None, tolerance=1e-6):
+    """
+    compare the rollups of a window (widened to whole days) with the raw usage
+    :param session: database session
+    :param start: window start or None
+    :param end: window end or None
+    :param tolerance: allowed relative difference of metric sums
+    :return: list of differences, empty if consistent
+    """
+    start, end = window(start, end)
+    differences = []
+    for model, expected in raw_totals(session, start, end).items():
+        table = model.__table__
+        query = select([table.c.resource, table.c.user, table.c.bucket, table.c.count] + [table.c[m] for m in metrics])
+        found = dict((tuple(row[:3]), [row[3]] + [float(v) if v is not None else None for v in row[4:]])
+                     for row in session.execute(query.where(_bucket_filter(table, start, end))))
+        for key in set(expected) | set(found):
+            if not _equal(expected.get(key), found.get(key), tolerance):
+                differences.append(dict(table=model.__tablename__, resource=key[0], user=key[1], bucket=key[2],
+                                        expected=expected.get(key), found=found.get(key)))
+    return differences
+
+
+def _equal(a, b, tolerance):
+    if a is None or b is None:
+        return a is b
+    if a[0] != b[0]:
+        return False
+    for x, y in zip(a[1:], b[1:]):
+        if x is None or y is None:
+            if x is not y:
+                return False
+        elif abs(x - y) > tolerance * max(abs(x), abs(y), 1):
+            return False
+    return True
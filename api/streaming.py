@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2019, Pim Witlox. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+
+import importlib.util
+import logging
+import zlib
+
+import flask
+from connexion.apis.flask_api import FlaskApi
+from connexion.lifecycle import ConnexionRequest
+from werkzeug.datastructures import ImmutableMultiDict
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+
+from api import encoding
+
+logger = logging.getLogger('api.streaming')
+
+read_size = 65536
+
+
+def _zstd():
+    import zstandard
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+decompressors = {
+    'gzip': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    'x-gzip': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    'deflate': lambda: zlib.decompressobj(),
+    'zstd': _zstd,
+}
+
+# encodings of which a body may hold several concatenated members (gzip) or frames (zstd)
+concatenated = ('gzip', 'x-gzip', 'zstd')
+
+
+class DecompressingStream(object):
+    """
+    file like object decompressing a request body while it is read
+    :raises BadRequest: corrupt body
+    :raises RequestEntityTooLarge: decompressed body larger than limit
+    """
+
+    def __init__(self, stream, content_encoding, limit=None):
+        self.stream = stream
+        self.factory = decompressors[content_encoding]
+        self.decompressor = self.factory()
+        self.concatenated = content_encoding in concatenated
+        self.limit = limit
+        self.size = 0
+        # decompressed data, consumed up to position, appended to in place so reading a whole body stays linear
+        self.buffer = bytearray()
+        self.position = 0
+        self.eof = False
+
+    def _next(self):
+        # a new member or frame follows the one that ended, anything else is trailing garbage
+        if not self.concatenated:
+            raise ValueError('data after the end of the compressed body')
+        self.decompressor = self.factory()
+
+    def _decompress(self, data):
+        if getattr(self.decompressor, 'eof', False):
+            self._next()
+        result = self.decompressor.decompress(data)
+        while getattr(self.decompressor, 'eof', False) and self.decompressor.unused_data:
+            rest = self.decompressor.unused_data
+            self._next()
+            result += self.decompressor.decompress(rest)
+        return result
+
+    def _fill(self):
+        data = self.stream.read(read_size)
+        try:
+            if not data:
+                self.eof = True
+                flush = getattr(self.decompressor, 'flush', None)
+                data = flush() if flush else b''
+            else:
+                data = self._decompress(data)
+        except Exception as e:
+            logger.debug("could not decompress request body ({0})".format(e))
+            raise BadRequest('Invalid compressed request body')
+        self.size += len(data)
+        if self.limit and self.size > self.limit:
+            raise RequestEntityTooLarge()
+        if self.position > len(self.buffer) // 2:
+            # trim the consumed front once it outweighs the unread rest
+            del self.buffer[:self.position]
+            self.position = 0
+        self.buffer += data
+
+    def _take(self, end):
+        data = bytes(self.buffer[self.position:end])
+        self.position = end
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while not self.eof:
+                self._fill()
+            return self._take(len(self.buffer))
+        while not self.eof and len(self.buffer) - self.position < size:
+            self._fill()
+        return self._take(min(self.position + size, len(self.buffer)))
+
+    def readline(self, size=-1):
+        start = self.position
+        while True:
+            end = self.buffer.find(b'\n', start)
+            if end >= 0:
+                end += 1
+                break
+            if self.eof or (size is not None and 0 <= size <= len(self.buffer) - self.position):
+                end = len(self.buffer)
+                break
+            start = len(self.buffer) - self.position
+            self._fill()
+            start += self.position
+        if size is not None and size >= 0:
+            end = min(end, self.position + size)
+        return self._take(end)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+class DecompressMiddleware(object):
+    """
+    WSGI middleware decompressing request bodies sent with a gzip, deflate or zstd (when zstandard is installed)
+    Content-Encoding, the body is decompressed while the application reads it
+    """
+
+    def __init__(self, app, limit=None):
+        self.app = app
+        self.limit = limit
+
+    def __call__(self, environ, start_response):
+        content_encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if content_encoding and content_encoding != 'identity':
+            try:
+                stream = DecompressingStream(environ['wsgi.input'], content_encoding, self.limit)
+            except (KeyError, ImportError):
+                return UnsupportedMediaType('Unsupported Content-Encoding {0}'.format(content_encoding))(
+                    environ, start_response)
+            environ['wsgi.input'] = stream
+            # the decompressed length is unknown, the application reads until the end of the stream
+            environ['wsgi.input_terminated'] = True
+            environ.pop('CONTENT_LENGTH', None)
+            del environ['HTTP_CONTENT_ENCODING']
+        return self.app(environ, start_response)
+
+
+def read_ndjson(stream):
+    """
+    records of a newline delimited JSON body, lines that are not valid JSON are yielded as None
+    :param stream: file like object
+    :return: generator of records
+    """
+    loads = encoding.encoder.loads
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield loads(line)
+        except ValueError:
+            yield None
+
+
+def read_msgpack(stream):
+    """
+    records of a msgpack body, a sequence of maps or arrays of maps
+    :param stream: file like object
+    :return: generator of records
+    :raises BadRequest: corrupt body
+    """
+    import msgpack
+    unpacker = msgpack.Unpacker(stream, raw=False, timestamp=3)
+    try:
+        for record in unpacker:
+            if isinstance(record, list):
+                for item in record:
+                    yield item
+            else:
+                yield record
+    except (ValueError, msgpack.UnpackException) as e:
+        logger.debug("could not unpack request body ({0})".format(e))
+        raise BadRequest('Invalid msgpack request body')
+
+
+readers = {
+    'application/x-ndjson': read_ndjson,
+    'application/jsonl': read_ndjson,
+    'application/msgpack': read_msgpack,
+    'application/x-msgpack': read_msgpack,
+}
+
+
+def reader(mimetype):
+    """
+    record reader for a streamed body type
+    :param mimetype: content type of the request
+    :return: function of a stream returning a generator of records, None if unsupported or not installed
+    """
+    read = readers.get(mimetype)
+    if read is read_msgpack:
+        if importlib.util.find_spec('msgpack') is None:
+            logger.warning("msgpack is not installed, cannot read {0} bodies".format(mimetype))
+            return None
+    return read
+
+
+class StreamingApi(FlaskApi):
+    """
+    flask api leaving streamed request bodies (see readers) unread, so handlers consume them from flask.request.stream
+    """
+
+    @classmethod
+    def get_request(cls, *args, **params):
+        flask_request = flask.request
+        if flask_request.mimetype not in readers:
+            return super(StreamingApi, cls).get_request(*args, **params)
+        context_dict = {}
+        setattr(flask._request_ctx_stack.top, 'connexion_context', context_dict)
+        return ConnexionRequest(
+            flask_request.url,
+            flask_request.method,
+            headers=flask_request.headers,
+            form=ImmutableMultiDict(),
+            query=flask_request.args,
+            body=b'',
+            json_getter=lambda: None,
+            files=ImmutableMultiDict(),
+            path_params=params,
+            context=context_dict,
+            cookies=flask_request.cookies,
+        )
+
+
+def init_streaming(app, ingest_config):
+    """
+    decompress request bodies and stream usage bodies, call before adding the api
+    :param app: connexion app
+    :param ingest_config: ingest section of the configuration
+    """
+    app.api_cls = StreamingApi
+    app.app.wsgi_app = DecompressMiddleware(app.app.wsgi_app, ingest_config.get('max_body_size') or None)
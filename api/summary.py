@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2019, Pim Witlox. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+
+import logging
+from itertools import groupby
+
+from connexion import NoContent
+from sqlalchemy import and_, func, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from api.admin import is_admin
+from api.resource import authorize_usage, usage_window
+from api.rollup import truncate, watermarks
+from db.group import Group, Member, group_resources
+from db.handler import db_session
+from db.resource import Resource, DailyUsage, HourlyUsage, metrics, usage_partitions
+from db.user import User
+
+logger = logging.getLogger('api.summary')
+
+dimensions = ('resource', 'user', 'group')
+# bucket formats per dialect, buckets are returned as ISO-8601 strings
+bucket_formats = {
+    'sqlite': {'hour': '%Y-%m-%dT%H:00:00', 'day': '%Y-%m-%dT00:00:00', 'month': '%Y-%m-01T00:00:00'},
+    'mysql': {'hour': '%Y-%m-%dT%H:00:00', 'day': '%Y-%m-%dT00:00:00', 'month': '%Y-%m-01T00:00:00'},
+    'postgresql': {'hour': 'YYYY-MM-DD"T"HH24:00:00', 'day': 'YYYY-MM-DD"T"00:00:00', 'month': 'YYYY-MM-01"T"00:00:00'},
+}
+
+
+def bucket_column(column, bucket, dialect):
+    """
+    truncate a timestamp column to the start of its bucket
+    :param column: timestamp column
+    :param bucket: hour, day or month
+    :param dialect: name of the database dialect
+    :return: column expression
+    """
+    formats = bucket_formats.get(dialect, bucket_formats['sqlite'])
+    if dialect == 'postgresql':
+        return func.to_char(column, formats[bucket])
+    if dialect == 'mysql':
+        return func.date_format(column, formats[bucket])
+    return func.strftime(formats[bucket], column)
+
+
+def percentile(values, p):
+    """
+    percentile with linear interpolation between the closest ranks
+    :param values: sorted list of numbers
+    :param p: percentile between 0 and 100
+    :return: float or None for no values
+    """
+    if not values:
+        return None
+    k = (len(values) - 1) * p / 100.0
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return float(values[f]) + (float(values[c]) - float(values[f])) * (k - f)
+
+
+def raw_usage(r, u, start, end):
+    """
+    usage rows of the partitions overlapping the window
+    :return: selectable with resource, user, start and the metrics
+    """
+    def where(table):
+        clauses = []
+        if r:
+            clauses.append(table.c.resource == r)
+        if u:
+            clauses.append(table.c.user == u)
+        if start:
+            clauses.append(table.c.start >= start)
+        if end:
+            clauses.append(table.c.end <= end)
+        return and_(*clauses)
+
+    def columns(table):
+        return [table.c.resource, table.c.user, table.c.start] + [table.c[m] for m in metrics]
+
+    return usage_partitions.select(db_session, columns, start, end, where).alias('usage')
+
+
+def rollup_for(group_by, bucket, start, end, percentiles):
+    """
+    pick the rollup that answers a summary, rollups hold usage by start so they only apply to windows without an end
+    that start on a bucket boundary and not before the watermark of the rollup, percentiles need the raw usage
+    :return: rollup model or None
+    """
+    if end or percentiles:
+        return None
+    marks = None
+    for model in (DailyUsage, HourlyUsage):
+        if bucket == 'hour' and model.period != 'hour':
+            continue
+        if start and start != truncate(start, model.period):
+            continue
+        if marks is None:
+            marks = watermarks(db_session)
+        mark = marks.get(model.__tablename__)
+        if not mark or (start and start >= mark):
+            return model
+    return None
+
+
+def rollup_usage(model, r, u, start):
+    """
+    rollup rows of the window
+    :return: selectable with resource, user, bucket, count and the metrics
+    """
+    table = model.__table__
+    query = select([table])
+    if r:
+        query = query.where(table.c.resource == r)
+    if u:
+        query = query.where(table.c.user == u)
+    if start:
+        query = query.where(table.c.bucket >= start)
+    return query.alias('usage')
+
+
+def summary_query(usage, time, group_by, bucket):
+    """
+    join usage for grouping by the requested dimensions
+    :param usage: usage selectable with resource and user columns
+    :param time: column to bucket
+    :return: (usage joined for grouping, list of key columns)
+    """
+    source = usage
+    keys = []
+    for dimension in group_by:
+        if dimension == 'group':
+            # usage is attributed to every group of the user that is associated with the resource
+            source = source.join(User, User.dom_name == usage.c.user)\
+                .join(Member, Member.user_id == User.id)\
+                .join(Group, Group.id == Member.group_id)\
+                .join(group_resources, group_resources.c.group_id == Group.id)\
+                .join(Resource, and_(Resource.id == group_resources.c.resource_id, Resource.name == usage.c.resource))
+            keys.append(Group.name.label('group'))
+        else:
+            keys.append(usage.c[dimension])
+    if bucket:
+        keys.append(bucket_column(time, bucket, db_session.get_bind().dialect.name).label('bucket'))
+    return source, keys
+
+
+def get_usage_summary(r=None, u=None, start=None, end=None, group_by=None, bucket=None, percentiles=None):
+    """
+    aggregate resource usage per resource, user and/or group and time bucket
+    sums and counts are computed by the database from the rollups when possible, else from the raw usage
+    percentiles are computed in one pass over the metric columns
+    :param r: resource, required for non admins
+    :param u: user, defaults to yourself for non admins
+    :param start: only usage starting at or after start
+    :param end: only usage ending at or before end
+    :param group_by: list of resource, user and group
+    :param bucket: hour, day or month
+    :param percentiles: list of percentiles (0-100) to compute per metric
+    :return: list of summaries
+    """
+    if r or not is_admin():
+        _, u, status = authorize_usage(r, u)
+        if status:
+            return NoContent, status
+    try:
+        start, end = usage_window(start, end)
+    except ValueError:
+        return 'Invalid start or end', 400
+    group_by = [d for d in dimensions if d in (group_by or [])]
+    percentiles = percentiles or []
+    if any(p < 0 or p > 100 for p in percentiles):
+        return 'Invalid percentile', 400
+    try:
+        model = rollup_for(group_by, bucket, start, end, percentiles)
+        if model:
+            usage = rollup_usage(model, r, u, start)
+            source, keys = summary_query(usage, usage.c.bucket, group_by, bucket)
+            count = func.sum(usage.c.count)
+        else:
+            usage = raw_usage(r, u, start, end)
+            source, keys = summary_query(usage, usage.c.start, group_by, bucket)
+            count = func.count()
+        names = [k.name for k in keys]
+        aggregates = [count.label('count')] + [func.sum(usage.c[m]).label(m) for m in metrics]
+        query = select(keys + aggregates).select_from(source)
+        if keys:
+            query = query.group_by(*keys).order_by(*keys)
+        summaries = []
+        for row in db_session.execute(query):
+            summary = dict((n, row[n]) for n in names)
+            summary['count'] = int(row['count'] or 0)
+            for m in metrics:
+                summary[m] = float(row[m]) if row[m] is not None else None
+            summaries.append(summary)
+        if percentiles and summaries:
+            add_percentiles(summaries, usage, source, keys, names, percentiles)
+    except SQLAlchemyError:
+        logger.exception("error while summarizing resource usage")
+        return NoContent, 500
+    return summaries, 200
+
+
+def add_percentiles(summaries, usage, source, keys, names, percentiles):
+    """
+    add the percentiles of every metric to the summaries, metric values are fetched ordered by group
+    """
+    query = select(keys + [usage.c[m] for m in metrics]).select_from(source)
+    if keys:
+        query = query.order_by(*keys)
+    indexed = dict((tuple(s[n] for n in names), s) for s in summaries)
+    for key, rows in groupby(db_session.execute(query), lambda row: tuple(row[n] for n in names)):
+        columns = list(zip(*[[row[m] for m in metrics] for row in rows]))
+        summary = indexed[key]
+        summary['percentiles'] = {}
+        for m, values in zip(metrics, columns):
+            values = sorted(v for v in values if v is not None)
+            summary['percentiles'][m] = dict(('{0:g}'.format(p), percentile(values, p)) for p in percentiles)
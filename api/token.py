@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2019, Pim Witlox. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+import fcntl
+import hashlib
+import heapq
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from multiprocessing.managers import BaseManager
+from os.path import exists, expandvars, expanduser
+from time import sleep, time
+
+from sqlalchemy import select, func
+
+from db.token import Token
+
+logger = logging.getLogger('api.token')
+
+
+class TokenStore(ABC):
+    """
+    registry of issued tokens, indexed by token and by subject (user or service name)
+    """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+
+    def expires(self, expires=None):
+        if expires is None:
+            return int(time()) + self.ttl
+        return int(expires)
+
+    @abstractmethod
+    def add(self, subject, token, expires=None):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def subject(self, token):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def tokens(self, subject):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def remove(self, token):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def remove_subject(self, subject):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def purge(self, now=None):
+        raise NotImplementedError()
+
+    def __contains__(self, token):
+        return self.subject(token) is not None
+
+    @abstractmethod
+    def __len__(self):
+        raise NotImplementedError()
+
+
+class MemoryTokenStore(TokenStore):
+    """
+    in-process token store, only valid for a single worker process
+    tokens are evicted in order of expiry, so expired tokens are purged in bulk
+    """
+
+    def __init__(self, ttl=3600):
+        super(MemoryTokenStore, self).__init__(ttl)
+        self._tokens = {}
+        self._subjects = {}
+        self._expiry = []
+        self._lock = threading.RLock()
+
+    def add(self, subject, token, expires=None):
+        """
+        register a token for a subject, a subject can hold several tokens
+        :param subject: name of user or service
+        :param token: JWT token
+        :param expires: expiry timestamp, defaults to now + ttl
+        """
+        expires = self.expires(expires)
+        with self._lock:
+            self.purge()
+            self._tokens[token] = (subject, expires)
+            self._subjects.setdefault(subject, set()).add(token)
+            heapq.heappush(self._expiry, (expires, token))
+
+    def subject(self, token):
+        """
+        look up the subject of a token
+        :param token: JWT token
+        :return: subject or None if unknown or expired
+        """
+        with self._lock:
+            self.purge()
+            entry = self._tokens.get(token)
+        if entry:
+            return entry[0]
+        return None
+
+    def tokens(self, subject):
+        """
+        all live tokens of a subject
+        :param subject: name of user or service
+        :return: set of tokens
+        """
+        with self._lock:
+            self.purge()
+            return set(self._subjects.get(subject, ()))
+
+    def remove(self, token):
+        """
+        remove a single token
+        :param token: JWT token
+        :return: subject of the token or None
+        """
+        with self._lock:
+            entry = self._tokens.pop(token, None)
+            if not entry:
+                return None
+            subject = entry[0]
+            tokens = self._subjects.get(subject)
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self._subjects[subject]
+            return subject
+
+    def remove_subject(self, subject):
+        """
+        remove all tokens of a subject
+        :param subject: name of user or service
+        :return: number of tokens removed
+        """
+        with self._lock:
+            tokens = self._subjects.pop(subject, set())
+            for token in tokens:
+                self._tokens.pop(token, None)
+            return len(tokens)
+
+    def purge(self, now=None):
+        """
+        evict all tokens that expired before now, the expiry heap keeps this proportional to the evicted tokens
+        stale heap entries (removed or re-added tokens) are skipped
+        :param now: timestamp, defaults to current time
+        :return: number of tokens evicted
+        """
+        if now is None:
+            now = int(time())
+        evicted = 0
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                expires, token = heapq.heappop(self._expiry)
+                entry = self._tokens.get(token)
+                if entry and entry[1] == expires:
+                    self.remove(token)
+                    evicted += 1
+            # rebuild the heap if removals left it mostly stale
+            if len(self._expiry) > 2 * len(self._tokens) + 64:
+                self._expiry = [(e, t) for t, (s, e) in self._tokens.items()]
+                heapq.heapify(self._expiry)
+        if evicted:
+            logger.debug("purged {0} expired tokens".format(evicted))
+        return evicted
+
+    def __len__(self):
+        with self._lock:
+            return len(self._tokens)
+
+
+class DatabaseTokenStore(TokenStore):
+    """
+    token store in the tokens table, shared by all workers using the same database
+    tokens are looked up by their sha256 digest, expired tokens are purged at most once per purge interval
+    """
+
+    def __init__(self, engine, ttl=3600, purge_interval=60):
+        super(DatabaseTokenStore, self).__init__(ttl)
+        self.engine = engine
+        self.table = Token.__table__
+        self.purge_interval = purge_interval
+        self._purged = 0
+        self.table.create(engine, checkfirst=True)
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def _maybe_purge(self):
+        now = int(time())
+        if now - self._purged >= self.purge_interval:
+            self._purged = now
+            self.purge(now)
+
+    def add(self, subject, token, expires=None):
+        self._maybe_purge()
+        digest = self.digest(token)
+        with self.engine.begin() as connection:
+            connection.execute(self.table.delete().where(self.table.c.digest == digest))
+            connection.execute(self.table.insert().values(digest=digest,
+                                                          token=token,
+                                                          subject=subject,
+                                                          expires=self.expires(expires)))
+
+    def subject(self, token):
+        self._maybe_purge()
+        query = select([self.table.c.subject]).where(self.table.c.digest == self.digest(token))
+        query = query.where(self.table.c.expires > int(time()))
+        with self.engine.connect() as connection:
+            return connection.execute(query).scalar()
+
+    def tokens(self, subject):
+        query = select([self.table.c.token]).where(self.table.c.subject == subject)
+        query = query.where(self.table.c.expires > int(time()))
+        with self.engine.connect() as connection:
+            return set(r[0] for r in connection.execute(query))
+
+    def remove(self, token):
+        digest = self.digest(token)
+        with self.engine.begin() as connection:
+            subject = connection.execute(select([self.table.c.subject]).where(self.table.c.digest == digest)).scalar()
+            connection.execute(self.table.delete().where(self.table.c.digest == digest))
+        return subject
+
+    def remove_subject(self, subject):
+        with self.engine.begin() as connection:
+            return connection.execute(self.table.delete().where(self.table.c.subject == subject)).rowcount
+
+    def purge(self, now=None):
+        if now is None:
+            now = int(time())
+        with self.engine.begin() as connection:
+            evicted = connection.execute(self.table.delete().where(self.table.c.expires <= now)).rowcount
+        if evicted:
+            logger.debug("purged {0} expired tokens".format(evicted))
+        return evicted
+
+    def __len__(self):
+        query = select([func.count()]).select_from(self.table).where(self.table.c.expires > int(time()))
+        with self.engine.connect() as connection:
+            return connection.execute(query).scalar()
+
+
+_exposed = ('add', 'subject', 'tokens', 'remove', 'remove_subject', 'purge', '__len__')
+_served = None
+
+
+def _served_store():
+    return _served
+
+
+class TokenServer(BaseManager):
+    pass
+
+
+class TokenClient(BaseManager):
+    pass
+
+
+TokenServer.register('tokens', callable=_served_store, exposed=_exposed)
+TokenClient.register('tokens', exposed=_exposed)
+
+
+class SocketTokenStore(TokenStore):
+    """
+    token store shared by all workers on the same host over a unix socket
+    the worker holding the lock file next to the socket serves a MemoryTokenStore from a background thread, the others
+    connect to it
+    """
+
+    # seconds waiting for the serving worker to bind the socket
+    connect_timeout = 5
+
+    def __init__(self, address, authkey, ttl=3600):
+        super(SocketTokenStore, self).__init__(ttl)
+        self.address = expandvars(expanduser(address))
+        self.authkey = authkey
+        self._proxy = None
+        self._lockfile = None
+
+    def _serve(self):
+        global _served
+        _served = MemoryTokenStore(self.ttl)
+        server = TokenServer(address=self.address, authkey=self.authkey).get_server()
+        thread = threading.Thread(target=server.serve_forever, name='token-server')
+        thread.daemon = True
+        thread.start()
+        logger.info("serving tokens on {0}".format(self.address))
+
+    def _lead(self, stale):
+        """
+        serve the tokens when no other worker does, only the worker holding the lock serves or removes the socket
+        :param stale: the socket refused the connection, so its server ended
+        :return: serving yes/no
+        """
+        if self._lockfile is None:
+            lockfile = open(self.address + '.lock', 'a')
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lockfile.close()
+                return False
+            self._lockfile = lockfile
+        if stale and exists(self.address):
+            logger.warning("removing stale token socket {0}".format(self.address))
+            os.remove(self.address)
+        self._serve()
+        return True
+
+    def _connect(self):
+        client = TokenClient(address=self.address, authkey=self.authkey)
+        deadline = time() + self.connect_timeout
+        while True:
+            try:
+                client.connect()
+                return client.tokens()
+            except (ConnectionRefusedError, FileNotFoundError) as e:
+                if time() > deadline:
+                    raise
+                if not self._lead(isinstance(e, ConnectionRefusedError)):
+                    # served by another worker that is still binding the socket
+                    sleep(0.05)
+
+    def _call(self, method, *args):
+        if not self._proxy:
+            self._proxy = self._connect()
+        try:
+            return getattr(self._proxy, method)(*args)
+        except (EOFError, ConnectionError):
+            logger.warning("lost connection to token socket {0}, reconnecting".format(self.address))
+            self._proxy = self._connect()
+            return getattr(self._proxy, method)(*args)
+
+    def add(self, subject, token, expires=None):
+        return self._call('add', subject, token, self.expires(expires))
+
+    def subject(self, token):
+        return self._call('subject', token)
+
+    def tokens(self, subject):
+        return self._call('tokens', subject)
+
+    def remove(self, token):
+        return self._call('remove', token)
+
+    def remove_subject(self, subject):
+        return self._call('remove_subject', subject)
+
+    def purge(self, now=None):
+        return self._call('purge', now)
+
+    def __len__(self):
+        return self._call('__len__')
+
+
+class ClaimsCache(object):
+    """
+    bounded LRU of verified token claims, entries are valid until the exp claim of the token
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self._claims = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token, now=None):
+        """
+        get the cached claims of a token
+        :param token: JWT token
+        :param now: timestamp, defaults to current time
+        :return: claims or None if not cached or expired
+        """
+        if now is None:
+            now = time()
+        with self._lock:
+            claims = self._claims.get(token)
+            if claims is None:
+                return None
+            if claims.get('exp', 0) <= now:
+                del self._claims[token]
+                return None
+            self._claims.move_to_end(token)
+            return claims
+
+    def put(self, token, claims):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._claims[token] = claims
+            self._claims.move_to_end(token)
+            while len(self._claims) > self.size:
+                self._claims.popitem(last=False)
+
+    def remove(self, token):
+        with self._lock:
+            self._claims.pop(token, None)
+
+    def __len__(self):
+        return len(self._claims)
+
+
+def create_store(token_config, engine=None, secret=None):
+    """
+    create the token store configured in the token section
+    :param token_config: token section of the configuration
+    :param engine: database engine, required for the database store
+    :param secret: secret the tokens are signed with, the socket store derives its authentication key from it
+    :return: TokenStore
+    :raises ValueError: socket store without a secret
+    """
+    ttl = token_config.lifetime
+    store = token_config.store
+    if store == 'database':
+        return DatabaseTokenStore(engine, ttl)
+    if store == 'socket':
+        if not secret:
+            raise ValueError("the socket token store needs a token or general secret")
+        return SocketTokenStore(token_config.socket, hashlib.sha256(secret.encode('utf-8')).digest(), ttl)
+    if store != 'memory':
+        logger.error("unknown token store {0}, using memory".format(store))
+    return MemoryTokenStore(ttl)
@@ -23,9 +23,13 @@ import logging
 
 from connexion import NoContent
 from flask import session
+from sqlalchemy import select
 from sqlalchemy.exc import SQLAlchemyError
 
-from api.admin import is_admin
+from api.acl import acl
+from api.admin import admins_only, is_admin, principal, cached_principal
+from api.etag import conditional
+from api.paging import paginate, page_headers, stream_json_lines
 from db.group import Member, Group
 from db.handler import db_session
 from db.user import User
@@ -34,33 +38,72 @@ from db.user import User
 logger = logging.getLogger('api.user')
 
 
+def iter_users_with_groups(query):
+    """
+    dump users with their groups, loaded in a single joined query and serialized from the rows without loading objects
+    :param query: query on User, may be limited
+    :return: generator of user with groups
+    """
+    users = query.subquery()
+    columns = [users.c[c.name] for c in User.columns()]
+    n = len(columns)
+    ident = User.serializer().keys.index('id')
+    rows = db_session.execute(select(columns + list(Group.columns()))
+                              .select_from(users.outerjoin(Member, Member.user_id == users.c.id)
+                                           .outerjoin(Group, Group.id == Member.group_id))
+                              .order_by(users.c.id)
+                              .execution_options(stream_results=True))
+    current = None
+    for row in rows:
+        if current is None or current['id'] != row[ident]:
+            if current is not None:
+                yield current
+            current = User.dump_row(row[:n])
+            current['groups'] = []
+        if row[n] is not None:
+            current['groups'].append(Group.dump_row(row[n:]))
+    if current is not None:
+        yield current
+
+
+def dump_users_with_groups(query):
+    """
+    dump users with their groups, loaded in a single joined query
+    :param query: query on User, may be limited
+    :return: list of user with groups
+    """
+    return list(iter_users_with_groups(query))
+
+
 def get_user_with_groups(uid):
     """
     get user by id with groups
     :param uid: user id
     :return: user with groups
     """
-    u = db_session.query(User)
-    user = u.filter(User.id == uid).one_or_none()
-    if not user:
+    users = dump_users_with_groups(db_session.query(User).filter(User.id == uid))
+    if not users:
         logger.warning("user with id {0} not found".format(uid))
         return None
-    user = user.dump()
-    user['groups'] = []
-    for member in db_session.query(Member).filter(Member.user_id == uid).all():
-        group = db_session.query(Group).filter(Group.id == member.group_id).one().dump()
-        user['groups'].append(group)
-    return user
+    return users[0]
 
 
-def get_users():
+@conditional('users', 'groups', 'members', authorize=admins_only)
+def get_users(limit=None, after=None, stream=False):
     """
     get all users (admins)
+    :param limit: page size
+    :param after: only users with an id larger than after
+    :param stream: stream as JSON lines
     :return: list of user
     """
     if not is_admin():
         return NoContent, 401
-    return [get_user_with_groups(u.id) for u in db_session.query(User).all() if u]
+    query = paginate(db_session.query(User), User.id, limit, after)
+    if stream:
+        return stream_json_lines(iter_users_with_groups(query))
+    users = dump_users_with_groups(query)
+    return users, 200, page_headers(users, limit)
 
 
 def add_user(u):
@@ -79,6 +122,7 @@ def add_user(u):
         db_session.add(u)
         db_session.commit()
         db_session.refresh(u)
+        acl.invalidate(('user', u.dom_name))
         return u.dump(), 201
     except SQLAlchemyError:
         logger.exception("error while creating account")
@@ -96,6 +140,7 @@ def remove_user(name):
     try:
         db_session.query(User).filter(User.dom_name == name).delete()
         db_session.commit()
+        acl.invalidate(('user', name))
         return NoContent, 200
     except SQLAlchemyError:
         logger.exception("error while creating account")
@@ -126,15 +171,12 @@ def find_user(name):
             return NoContent, 404
         return get_user_with_groups(u.id), 200
     if 'username' in session:
-        user = db_session.query(User).filter(User.dom_name == session['username']).one_or_none()
-        if not user:
-            return NoContent, 401
-        u = db_session.query(User).filter(User.dom_name == name).one_or_none()
-        if not u:
+        p = principal()
+        target = cached_principal(name)
+        if not p.uid or not target.uid:
             return NoContent, 401
-        for admin in db_session.query(Member).filter(Member.user_id == user.id and Member.admin).all():
-            if db_session.query(Member).filter(Member.group_id == admin.group_id and Member.user_id == u.id).one_or_none():
-                return get_user_with_groups(u.id), 200
+        if any(p.is_group_admin(gid) for gid in target.groups):
+            return get_user_with_groups(target.uid), 200
         return NoContent, 401
     return NoContent, 401
 
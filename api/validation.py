@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2019, Pim Witlox. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+
+import logging
+import threading
+from collections import deque
+from time import perf_counter
+
+from connexion.decorators.validation import RequestBodyValidator
+from flask import session
+from jsonschema import ValidationError, draft4_format_checker
+
+logger = logging.getLogger('api.validation')
+
+# keywords the compiled validators implement (or that do not constrain), schemas using others are validated by jsonschema
+keywords = {'type', 'required', 'properties', 'items', 'enum', 'format', 'description', 'title', 'example', 'definitions',
+            'maxLength'}
+_types = {
+    'object': lambda v: type(v) is dict,
+    'array': lambda v: type(v) is list,
+    'string': lambda v: isinstance(v, str),
+    'boolean': lambda v: type(v) is bool,
+    'integer': lambda v: (type(v) is int) or (type(v) is float and v.is_integer()),
+    'number': lambda v: type(v) in (int, float),
+    'null': lambda v: v is None,
+}
+_missing = object()
+
+
+class CompiledValidator(object):
+    """
+    validator generated once from a JSON schema, arrays are checked with one compiled function per item
+    """
+
+    def __init__(self, check):
+        self.check = check
+
+    def validate(self, data):
+        self.check(data, deque())
+
+
+def compile_schema(schema):
+    """
+    compile a (resolved) JSON schema into a check function
+    :param schema: dict
+    :return: function(value, path) raising ValidationError, or None if the schema uses unsupported keywords
+    """
+    if not isinstance(schema, dict) or any(k not in keywords and not k.startswith('x-') for k in schema):
+        return None
+    if schema.get('x-nullable'):
+        return None
+    checks = []
+    kind = schema.get('type')
+    if kind is not None:
+        if kind not in _types:
+            return None
+        is_type = _types[kind]
+
+        def check_type(value, path):
+            if not is_type(value):
+                raise ValidationError("{0!r} is not of type '{1}'".format(value, kind), path=path)
+        checks.append(check_type)
+    if 'enum' in schema:
+        enum = schema['enum']
+
+        def check_enum(value, path):
+            if value not in enum:
+                raise ValidationError("{0!r} is not one of {1!r}".format(value, enum), path=path)
+        checks.append(check_enum)
+    if 'format' in schema and schema['format'] in draft4_format_checker.checkers:
+        fmt = schema['format']
+
+        def check_format(value, path):
+            if not draft4_format_checker.conforms(value, fmt):
+                raise ValidationError("{0!r} is not a '{1}'".format(value, fmt), path=path)
+        checks.append(check_format)
+    if 'maxLength' in schema:
+        length = schema['maxLength']
+
+        def check_length(value, path):
+            if type(value) is str and len(value) > length:
+                raise ValidationError("{0!r} is too long".format(value), path=path)
+        checks.append(check_length)
+    if 'required' in schema or 'properties' in schema:
+        required = tuple(schema.get('required', ()))
+        properties = []
+        for name, subschema in schema.get('properties', {}).items():
+            check = compile_schema(subschema)
+            if check is None:
+                return None
+            properties.append((name, check))
+        properties = tuple(properties)
+
+        def check_object(value, path):
+            if type(value) is not dict:
+                return
+            for name in required:
+                if name not in value:
+                    raise ValidationError("'{0}' is a required property".format(name), path=path)
+            for name, check in properties:
+                item = value.get(name, _missing)
+                if item is not _missing:
+                    path.append(name)
+                    check(item, path)
+                    path.pop()
+        checks.append(check_object)
+    if 'items' in schema:
+        check_item = compile_schema(schema['items'])
+        if check_item is None:
+            return None
+
+        def check_items(value, path):
+            if type(value) is not list:
+                return
+            for i, item in enumerate(value):
+                path.append(i)
+                check_item(item, path)
+                path.pop()
+        checks.append(check_items)
+    checks = tuple(checks)
+    if len(checks) == 1:
+        return checks[0]
+
+    def check_all(value, path):
+        for check in checks:
+            check(value, path)
+    return check_all
+
+
+class ValidationStats(object):
+    """
+    time spent validating request bodies
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.requests = 0
+        self.skipped = 0
+        self.seconds = 0.0
+
+    def add(self, seconds, skipped=False):
+        with self._lock:
+            self.requests += 1
+            self.seconds += seconds
+            if skipped:
+                self.skipped += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(requests=self.requests, skipped=self.skipped, seconds=self.seconds,
+                        compiled=compiled, trusted_services=sorted(trusted_services))
+
+
+stats = ValidationStats()
+compiled = False
+trusted_services = set()
+
+
+def init_validation(validation_config):
+    """
+    configure request body validation, call before adding the api
+    :param validation_config: validation section of the configuration
+    """
+    global compiled, trusted_services
+    compiled = validation_config.compiled
+    trusted_services = set(s.strip() for s in (validation_config.get('trusted_services') or '').split(',') if s.strip())
+    stats.clear()
+
+
+def is_trusted():
+    return 'service' in session and session.get('username') in trusted_services
+
+
+class BodyValidator(RequestBodyValidator):
+    """
+    request body validator using compiled validators when enabled, array items posted by trusted services are not
+    validated (the handlers still reject invalid records), the time spent is recorded in stats
+    """
+
+    def __init__(self, schema, consumes, api, *args, **kwargs):
+        super(BodyValidator, self).__init__(schema, consumes, api, *args, **kwargs)
+        self.compiled = None
+        if compiled:
+            check = compile_schema(schema)
+            if check is None:
+                logger.debug("schema uses unsupported keywords, validating with jsonschema")
+            else:
+                self.compiled = CompiledValidator(check)
+                self.validator = self.compiled
+        self.array = schema.get('type') == 'array'
+
+    def validate_schema(self, data, url):
+        start = perf_counter()
+        skipped = False
+        try:
+            if self.array and type(data) is list and trusted_services and is_trusted():
+                skipped = True
+                return None
+            return super(BodyValidator, self).validate_schema(data, url)
+        finally:
+            stats.add(perf_counter() - start, skipped)
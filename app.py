@@ -38,6 +38,7 @@ from sqlalchemy.exc import SQLAlchemyError
 from config import Config
 from db.group import Group
 from db.handler import init_db
+from db.resource import Metric, usage_partitions
 from db.service import Service
 
 logger = logging.getLogger()
@@ -46,12 +47,26 @@ click_log.basic_config(logger)
 config = None
 
 
+def init_database(application_config):
+    """
+    connect to the database with the usage storage options of the database section
+    :param application_config: Config
+    :return: database session
+    """
+    from api.rollup import seed_watermarks
+    Metric.storage = application_config.database().get('usage_metrics', 'numeric')
+    session = init_db(application_config.database().connection, options=application_config.database())
+    usage_partitions.configure(application_config.database().get('usage_partitions'))
+    seed_watermarks(session)
+    return session
+
+
 def application(application_config, gevent=False, ui=False, debug=False):
     global config
-    port = int(application_config.general().get('port'))
+    port = application_config.general().port
     logger.debug("initializing database")
     config = application_config
-    session = init_db(application_config.database().get('connection'))
+    session = init_database(application_config)
     if ui:
         logger.warning("enabling UI")
     options = {"swagger_ui": ui}
@@ -61,7 +76,7 @@ def application(application_config, gevent=False, ui=False, debug=False):
     else:
         logger.info("direct request")
         app = connexion.FlaskApp(__name__, port=port, debug=debug, specification_dir='swagger/', options=options)
-    app.app.secret_key = application_config.general().get('secret')
+    app.app.secret_key = application_config.general().secret
     # primary authentication tables
     try:
         s = session.query(Service)
@@ -80,8 +95,22 @@ def application(application_config, gevent=False, ui=False, debug=False):
     except SQLAlchemyError:
         logger.exception('failed to add admin group')
     logger.info("configuring api")
-    app.add_api('api.yaml')
-    if application_config.general().get('CORS'):
+    from api.validation import BodyValidator, init_validation
+    from api.streaming import init_streaming
+    init_validation(application_config.validation())
+    init_streaming(app, application_config.ingest())
+    api = app.add_api('api.yaml', validator_map={'body': BodyValidator})
+    from api.auth import init_tokens
+    from api.acl import init_acl
+    from api.encoding import init_encoder
+    from api.compression import init_compression
+    init_encoder(api, application_config.general().get('json', 'auto'))
+    init_compression(app, application_config.general())
+    from api.ingest import init_queue
+    init_tokens(session.get_bind())
+    init_queue(application_config.ingest())
+    init_acl(application_config.cache().acl_ttl)
+    if application_config.general().cors:
         CORS(app.app)
     return app
 
@@ -118,8 +147,8 @@ def cli(ctx, config_file):
     if config_file.logging().get('log_file'):
         handler = RotatingFileHandler(config_file.logging().get('log_file'),
                                       mode='a',
-                                      maxBytes=int(config_file.logging().get('max_bytes')),
-                                      backupCount=int(config_file.logging().get('backup_count')))
+                                      maxBytes=config_file.logging().max_bytes,
+                                      backupCount=config_file.logging().backup_count)
         handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s [%(funcName)s] %(message)s"))
         logger.addHandler(handler)
 
@@ -144,6 +173,7 @@ def start(ctx, gevent, ui, debug, force):
         runtime_config['pid'] = os.getpid()
         with open(runtime, 'wb') as f:
             pickle.dump(runtime_config, f)
+        signal.signal(signal.SIGHUP, lambda sig, frame: application_config.reload())
         if gevent:
             app.run()
         else:
@@ -208,5 +238,132 @@ def info(ctx):
         logger.info("*" * 33)
 
 
+@cli.command(help='list or archive usage partitions')
+@click.option('-b', '--before', help='archive partitions ending before this date (YYYY-MM-DD)')
+@click.option('-n', '--name', multiple=True, help='archive a partition by name')
+@click.pass_context
+def archive_usage(ctx, before, name):
+    """
+    archive resource usage partitions, archived partitions are kept as tables but no longer queried or written to and
+    the rollups of their period are rebuilt without them
+    without options the partitions are listed
+    """
+    from datetime import datetime
+    from api.rollup import archive_partition
+    from db.resource import UsagePartition
+    session = init_database(ctx.obj['CONFIG'])
+    names = list(name)
+    if before:
+        until = datetime.strptime(before, '%Y-%m-%d')
+        query = session.query(UsagePartition.name).filter(UsagePartition.archived.is_(False))
+        names.extend(n for (n,) in query.filter(UsagePartition.end <= until).all())
+    if not names:
+        for partition in session.query(UsagePartition).order_by(UsagePartition.start).all():
+            logger.info("{0} : {1} - {2}{3}".format(partition.name, partition.start, partition.end,
+                                                   ' (archived)' if partition.archived else ''))
+    for n in names:
+        if archive_partition(session, n):
+            logger.info("archived {0} and rebuilt the rollups of its period".format(n))
+        else:
+            logger.error("unknown partition {0}".format(n))
+
+
+@cli.command(help='rebuild or check the usage rollups')
+@click.option('-s', '--start', help='window start (YYYY-MM-DD), widened to whole days')
+@click.option('-e', '--end', help='window end (YYYY-MM-DD, exclusive), widened to whole days')
+@click.option('--check', is_flag=True, help='compare the rollups with the raw usage instead of rebuilding')
+@click.pass_context
+def rollup_usage(ctx, start, end, check):
+    """
+    backfill the hourly and daily usage rollups from the raw usage, or report where they differ
+    """
+    from datetime import datetime
+    from api.rollup import check_rollups, rebuild_rollups
+    session = init_database(ctx.obj['CONFIG'])
+    start = datetime.strptime(start, '%Y-%m-%d') if start else None
+    end = datetime.strptime(end, '%Y-%m-%d') if end else None
+    if check:
+        differences = check_rollups(session, start, end)
+        for d in differences:
+            logger.warning("{table} {resource} {user} {bucket}: expected {expected}, found {found}".format(**d))
+        logger.info("{0} differences found".format(len(differences)))
+    else:
+        for table, buckets in rebuild_rollups(session, start, end).items():
+            logger.info("rebuilt {0} buckets in {1}".format(buckets, table))
+
+
+@cli.command(help='export usage')
+@click.option('-r', '--resource', help='only usage of this resource')
+@click.option('-u', '--user', help='only usage of this user')
+@click.option('-s', '--start', help='only usage starting at or after start (YYYY-MM-DD)')
+@click.option('-e', '--end', help='only usage ending at or before end (YYYY-MM-DD)')
+@click.option('-f', '--format', 'fmt', type=click.Choice(['csv', 'jsonl', 'columnar']), default='csv', help='export format')
+@click.option('-o', '--output', default='-', help='output file, default is stdout')
+@click.pass_context
+def export_usage(ctx, resource, user, start, end, fmt, output):
+    """
+    export usage ordered by start, rows are streamed from the database so memory use does not depend on the window
+    """
+    from datetime import datetime
+    from api.export import export_query, export_usage as export
+    session = init_database(ctx.obj['CONFIG'])
+    start = datetime.strptime(start, '%Y-%m-%d') if start else None
+    end = datetime.strptime(end, '%Y-%m-%d') if end else None
+    mode = 'wb' if fmt == 'columnar' else 'w'
+    with click.open_file(output, mode) as f:
+        for chunk in export(session, export_query(resource, user, start, end), fmt):
+            f.write(chunk)
+
+
+@cli.command(help='convert stored usage metrics to the configured storage')
+@click.option('-s', '--source', type=click.Choice(Metric.storages), required=True, help='current storage of the metrics')
+@click.pass_context
+def migrate_metrics(ctx, source):
+    """
+    convert the usage metrics of all usage tables from the source storage to the one in the database section
+    """
+    from db.resource import migrate_metrics as migrate
+    session = init_database(ctx.obj['CONFIG'])
+    if source == Metric.storage:
+        logger.warning("metrics are already stored as {0}".format(source))
+        return
+    for table in migrate(session, source, Metric.storage):
+        logger.info("converted {0} from {1} to {2}".format(table, source, Metric.storage))
+
+
+@cli.command(help='add indexes missing from tables created by earlier versions')
+@click.pass_context
+def add_indexes(ctx):
+    """
+    create the indexes added to the group and usage tables since they were created, existing indexes are kept
+    """
+    from db.group import Group, group_resources
+    from db.handler import create_missing_indexes
+    from db.resource import usage_tables
+    session = init_database(ctx.obj['CONFIG'])
+    created = create_missing_indexes(session, [Group.__table__, group_resources] + usage_tables(session))
+    for name in created:
+        logger.info("created index {0}".format(name))
+    logger.info("{0} indexes created".format(len(created)))
+
+
+@cli.command(help='add the natural key to existing usage tables, removing duplicate usage')
+@click.pass_context
+def dedupe_usage(ctx):
+    """
+    add the record column and the unique key on resource, user, start, end and record to usage tables created by
+    earlier versions, duplicate rows are removed and the rollups of the affected tables rebuilt
+    """
+    from api.rollup import rebuild_rollups
+    from db.resource import add_usage_key
+    session = init_database(ctx.obj['CONFIG'])
+    removed = add_usage_key(session)
+    for table, count in removed.items():
+        logger.info("removed {0} duplicates from {1}".format(count, table))
+    if any(removed.values()):
+        for table, buckets in rebuild_rollups(session).items():
+            logger.info("rebuilt {0} buckets in {1}".format(buckets, table))
+
+
 if __name__ == '__main__':
     cli()
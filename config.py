@@ -23,11 +23,25 @@ import configparser
 import logging
 import random
 
+from collections.abc import Mapping
 from pathlib import Path
 from os.path import exists, dirname, expandvars, expanduser
 
 allowed_chars = u'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
 
+# options that are not plain strings, all other options are kept as string
+option_types = {
+    'general': {'cors': bool, 'port': int, 'compression': bool, 'compression_level': int, 'compression_min_size': int},
+    'logging': {'max_bytes': int, 'backup_count': int},
+    'token': {'lifetime': int, 'stateless': bool, 'cache_size': int},
+    'authentication': {'port': int, 'ssl': bool},
+    'database': {'pool_size': int, 'max_overflow': int, 'pool_recycle': int, 'pool_pre_ping': bool,
+                 'statement_timeout': int, 'busy_timeout': int},
+    'cache': {'acl_ttl': int},
+    'validation': {'compiled': bool},
+    'ingest': {'async': bool, 'queue_size': int, 'batch_rows': int, 'max_body_size': int},
+}
+
 
 class DefaultConfig(object):
 
@@ -38,6 +52,10 @@ class DefaultConfig(object):
         config.set('general', 'CORS', 'False')
         config.set('general', 'secret', ''.join(random.choice(allowed_chars) for c in range(14)))
         config.set('general', 'port', '8080')
+        config.set('general', 'json', 'auto')
+        config.set('general', 'compression', 'True')
+        config.set('general', 'compression_level', '6')
+        config.set('general', 'compression_min_size', '1024')
         config.set('general', 'run_time', expandvars(expanduser('~/.acpy/run_time.data')))
 
         config.add_section('logging')
@@ -54,9 +72,35 @@ class DefaultConfig(object):
         config.set('token', 'secret', ''.join(random.choice(allowed_chars) for c in range(14)))
         config.set('token', 'lifetime', '3600')
         config.set('token', 'algorithm', 'HS256')
+        config.set('token', 'store', 'memory')
+        config.set('token', 'socket', expandvars(expanduser('~/.acpy/tokens.sock')))
+        config.set('token', 'stateless', 'False')
+        config.set('token', 'cache_size', '1024')
 
         config.add_section('database')
         config.set('database', 'connection', 'sqlite://')
+        config.set('database', 'usage_partitions', 'none')
+        config.set('database', 'usage_metrics', 'numeric')
+        config.set('database', 'pool_size', '5')
+        config.set('database', 'max_overflow', '10')
+        config.set('database', 'pool_recycle', '-1')
+        config.set('database', 'pool_pre_ping', 'False')
+        config.set('database', 'statement_timeout', '0')
+        config.set('database', 'busy_timeout', '5000')
+
+        config.add_section('cache')
+        config.set('cache', 'acl_ttl', '60')
+
+        config.add_section('ingest')
+        config.set('ingest', 'async', 'False')
+        config.set('ingest', 'queue_size', '100')
+        config.set('ingest', 'batch_rows', '50000')
+        config.set('ingest', 'spool', expandvars(expanduser('~/.acpy/spool')))
+        config.set('ingest', 'max_body_size', '1073741824')
+
+        config.add_section('validation')
+        config.set('validation', 'compiled', 'False')
+        config.set('validation', 'trusted_services', '')
 
         config.add_section('authentication')
         config.set('authentication', 'host', 'localhost')
@@ -71,16 +115,66 @@ class DefaultConfig(object):
         return config
 
 
+class Section(Mapping):
+    """
+    immutable, typed snapshot of a config section, options are available as attributes and by key
+    """
+
+    def __init__(self, name, values):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_values', dict(values))
+
+    def __getitem__(self, option):
+        return self._values[option]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getattr__(self, option):
+        try:
+            return self._values[option]
+        except KeyError:
+            raise AttributeError("section {0} has no option {1}".format(self._name, option))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("config sections are immutable, use Config.update")
+
+    def __repr__(self):
+        return "Section({0}, {1})".format(self._name, self._values)
+
+
 class Config(object):
 
     logger = logging.getLogger(__name__)
 
     def __init__(self, config_file=None, create=True):
-        self.config = DefaultConfig().create()
+        self.config_file = expandvars(expanduser(config_file)) if config_file else None
+        self.defaults = DefaultConfig().create()
+        self.config = self._read()
         if create:
-            self.write(expandvars(expanduser(config_file)))
-        if config_file and exists(expandvars(expanduser(config_file))):
-            self.config.read(expandvars(expanduser(config_file)))
+            self.write(self.config_file)
+        self.sections = self._snapshot(self.config)
+
+    def _read(self):
+        config = configparser.ConfigParser()
+        config.read_dict(self.defaults)
+        if self.config_file and exists(self.config_file):
+            config.read(self.config_file)
+        return config
+
+    def _snapshot(self, config):
+        return dict((section, Section(section, self._fetch(section, config))) for section in config.sections())
+
+    def reload(self):
+        """
+        re-read the config file and atomically replace the snapshot, options set by update are discarded
+        """
+        self.logger.info("reloading config from {0}".format(self.config_file))
+        config = self._read()
+        self.config, self.sections = config, self._snapshot(config)
 
     def write(self, path):
         if not exists(path):
@@ -92,34 +186,54 @@ class Config(object):
         else:
             self.logger.debug("already found config at {0}, using it".format(path))
 
-    def _fetch(self, section):
+    def _fetch(self, section, config=None):
+        if config is None:
+            config = self.config
         result = {}
-        options = self.config.options(section)
-        for option in options:
+        types = option_types.get(section, {})
+        for option in config.options(section):
             try:
-                result[option] = self.config.get(section, option)
-            except configparser.Error as e:
+                if types.get(option) is bool:
+                    result[option] = config.getboolean(section, option)
+                elif types.get(option) is int:
+                    result[option] = config.getint(section, option)
+                else:
+                    result[option] = config.get(section, option)
+            except (configparser.Error, ValueError) as e:
                 self.logger.error("exception reading config on {0} ({1})".format(option, e))
                 result[option] = None
         return result
 
+    def _section(self, section):
+        return self.sections.get(section) or Section(section, {})
+
     def general(self):
-        return self._fetch('general')
+        return self._section('general')
 
     def logging(self):
-        return self._fetch('logging')
+        return self._section('logging')
 
     def admin(self):
-        return self._fetch('admin')
+        return self._section('admin')
 
     def token(self):
-        return self._fetch('token')
+        return self._section('token')
 
     def database(self):
-        return self._fetch('database')
+        return self._section('database')
 
     def authentication(self):
-        return self._fetch('authentication')
+        return self._section('authentication')
+
+    def ingest(self):
+        return self._section('ingest')
+
+    def validation(self):
+        return self._section('validation')
+
+    def cache(self):
+        return self._section('cache')
 
     def update(self, section, option, value):
         self.config.set(section, option, value)
+        self.sections = self._snapshot(self.config)
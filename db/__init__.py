@@ -25,3 +25,4 @@ import db.resource
 import db.user
 import db.group
 import db.service
+import db.token
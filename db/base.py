@@ -19,12 +19,66 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
-from sqlalchemy import Column, Integer
+from operator import attrgetter, itemgetter
+
+from sqlalchemy import Column, Integer, inspect
+
+
+class Serializer(object):
+    """
+    serializer of a mapped class, generated once from the column attributes of the mapper
+    loaded values are read from the instance dict, expired or deferred ones through the attributes
+    """
+
+    def __init__(self, cls):
+        attributes = inspect(cls).column_attrs
+        self.keys = tuple(a.key for a in attributes)
+        self.columns = tuple(a.columns[0] for a in attributes)
+        self.loaded = itemgetter(*self.keys)
+        self.values = attrgetter(*self.keys)
+        if len(self.keys) == 1:
+            self.loaded = self._single(self.loaded)
+            self.values = self._single(self.values)
+
+    @staticmethod
+    def _single(getter):
+        return lambda obj: (getter(obj),)
+
+    def dump(self, obj):
+        try:
+            return dict(zip(self.keys, self.loaded(obj.__dict__)))
+        except KeyError:
+            return dict(zip(self.keys, self.values(obj)))
 
 
 class AccountingBase(object):
     id = Column(Integer, primary_key=True)
 
+    @classmethod
+    def serializer(cls):
+        serializer = cls.__dict__.get('_serializer')
+        if serializer is None:
+            serializer = Serializer(cls)
+            cls._serializer = serializer
+        return serializer
+
+    @classmethod
+    def columns(cls):
+        """
+        columns in the order of dump_row, select these to serialize Core rows without loading objects
+        :return: tuple of columns
+        """
+        return cls.serializer().columns
+
+    @classmethod
+    def dump_row(cls, row):
+        """
+        serialize a Core row selected with columns()
+        :param row: row or tuple
+        :return: dict
+        """
+        return dict(zip(cls.serializer().keys, row))
+
     def dump(self):
-        return dict([(k, v) for k, v in vars(self).items() if not k.startswith("_")])
+        return self.serializer().dump(self)
 
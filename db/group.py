@@ -19,7 +19,7 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
-from sqlalchemy import Column, String, Boolean, Integer, ForeignKey, Table
+from sqlalchemy import Column, String, Boolean, Integer, ForeignKey, Table, Index
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import relationship
 
@@ -30,16 +30,18 @@ from db.user import User
 group_resources = Table('group_resources',
                         Base.metadata,
                         Column('group_id', Integer, ForeignKey('groups.id')),
-                        Column('resource_id', Integer, ForeignKey('resources.id')))
+                        Column('resource_id', Integer, ForeignKey('resources.id')),
+                        Index('ix_group_resources_resource_group', 'resource_id', 'group_id'),
+                        Index('ix_group_resources_group', 'group_id'))
 
 
 class Group(Base):
     __tablename__ = 'groups'
     name = Column(String(100), unique=True)
 
-    user_id = Column(Integer, ForeignKey(User.id))
+    user_id = Column(Integer, ForeignKey(User.id), index=True)
 
-    active = Column(Boolean)
+    active = Column(Boolean, index=True)
 
     user = relationship('User', foreign_keys='Group.user_id')
 
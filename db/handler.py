@@ -19,22 +19,332 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
-from sqlalchemy import create_engine
+import logging
+import threading
+from time import time
+
+from sqlalchemy import BigInteger, Column, String, bindparam, create_engine, event, inspect, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
 
 from db.base import AccountingBase
 
+logger = logging.getLogger('db.handler')
+
+
+class RoutingSession(Session):
+    """
+    session that reads from the reader engine until the transaction writes, from then on it uses the writer engine
+    without a reader engine every statement uses the bound engine
+    """
+
+    def __init__(self, reader=None, **kwargs):
+        super(RoutingSession, self).__init__(**kwargs)
+        self.reader = reader
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        writer = super(RoutingSession, self).get_bind(mapper, clause, **kwargs)
+        if isinstance(clause, UpdateBase):
+            _changed(self, clause.table)
+        if self.reader is None or self.info.get('writing'):
+            return writer
+        if self._flushing or isinstance(clause, UpdateBase) or (mapper is None and clause is None):
+            self.info['writing'] = True
+            return writer
+        if clause is not None and not clause.is_selectable:
+            # textual statements and DDL may write
+            self.info['writing'] = True
+            return writer
+        return self.reader
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def _end_writing(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('writing', None)
+        # changes of a transaction that did not commit
+        session.info.pop('changed', None)
+        session.info.pop('versions', None)
+
+
 Base = declarative_base(cls=AccountingBase)
-db_session = None
+db_session = scoped_session(sessionmaker(class_=RoutingSession, autocommit=False, autoflush=False))
+Base.query = db_session.query_property()
+engines = {}
+
+
+class TableVersion(Base):
+    __tablename__ = 'table_versions'
+
+    name = Column(String(100), nullable=False, unique=True)
+    version = Column(BigInteger, nullable=False)
+
+
+class TableVersions(object):
+    """
+    change counters per table, persisted in table_versions and incremented by the transaction writing to the table, so
+    they are shared by processes and survive restarts
+    tables can share a counter by setting version_key in their info, for instance the usage partitions
+    reads are lookups in a snapshot, which follows the commits of this process and is re-read with refresh
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.versions = {}
+
+    def get(self, name):
+        return self.versions.get(name, 0)
+
+    def update(self, versions):
+        with self._lock:
+            for name, version in versions:
+                if version > self.versions.get(name, 0):
+                    self.versions[name] = version
+
+    def refresh(self, bind=None):
+        """
+        re-read all counters with one query, to see the changes of other processes
+        :param bind: engine or connection, the reader engine by default
+        """
+        bind = bind or engines.get('reader') or engines.get('writer')
+        if bind is not None:
+            self.update(bind.execute(select([TableVersion.name, TableVersion.version])).fetchall())
+
+    def reset(self):
+        with self._lock:
+            self.versions.clear()
+
+    def seed(self, session, names):
+        """
+        create the counters that do not exist yet, they start at the current time in milliseconds so the versions of
+        a recreated database do not repeat earlier ones
+        :param session: database session
+        :param names: table names
+        """
+        existing = set(n for (n,) in session.execute(select([TableVersion.name])))
+        missing = [dict(name=n, version=int(time() * 1000)) for n in sorted(set(names) - existing)]
+        if missing:
+            try:
+                session.execute(TableVersion.__table__.insert(), missing)
+                session.commit()
+            except IntegrityError:
+                # seeded by another process
+                session.rollback()
+
+    def increment(self, session, names):
+        """
+        increment counters within the transaction of a session, the new versions are applied to the snapshot once the
+        transaction commits
+        :param session: database session
+        :param names: table names
+        """
+        table = TableVersion.__table__
+        statement = table.update().where(table.c.name == bindparam('b_name')).values(version=table.c.version + 1)
+        # a fixed order, so concurrent transactions lock the rows in the same order
+        names = sorted(names)
+        for name in names:
+            if session.execute(statement, dict(b_name=name)).rowcount == 0:
+                try:
+                    with session.begin_nested():
+                        session.execute(table.insert(), dict(name=name, version=int(time() * 1000)))
+                except IntegrityError:
+                    session.execute(statement, dict(b_name=name))
+        query = select([table.c.name, table.c.version]).where(table.c.name.in_(names))
+        session.info['versions'] = session.execute(query).fetchall()
+
+
+table_versions = TableVersions()
+
+
+def mark_changed(session, *names):
+    """
+    count a change of tables written with textual SQL, which is not tracked
+    :param session: database session
+    :param names: table names
+    """
+    changed = session.info.get('changed')
+    if changed is None:
+        changed = session.info['changed'] = set()
+    changed.update(n for n in names if n != TableVersion.__tablename__)
+
+
+def _changed(session, table):
+    mark_changed(session, table.info.get('version_key', table.name))
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _flushed(session, flush_context):
+    deleted = session.deleted
+    for obj in session.new | session.dirty | deleted:
+        state = inspect(obj)
+        for table in state.mapper.tables:
+            _changed(session, table)
+        for relationship in state.mapper.relationships:
+            if relationship.secondary is None:
+                continue
+            if obj in deleted or state.attrs[relationship.key].history.has_changes():
+                _changed(session, relationship.secondary)
+
+
+@event.listens_for(RoutingSession, 'before_commit')
+def _committing(session):
+    if session.transaction is not None and session.transaction.nested:
+        # savepoint, the changes count once the outer transaction commits
+        return
+    session.flush()
+    changed = session.info.pop('changed', None)
+    if changed:
+        table_versions.increment(session, changed)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _committed(session):
+    if session.transaction is not None and session.transaction.nested:
+        return
+    versions = session.info.pop('versions', None)
+    if versions:
+        table_versions.update(versions)
+
+
+def _option(options, name, default=None):
+    value = options.get(name) if options else None
+    return default if value in (None, '') else value
+
+
+def _sqlite_pragmas(busy_timeout):
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout={0:d}'.format(busy_timeout))
+        cursor.close()
+    return connect
+
+
+def _mysql_timeout(statement_timeout):
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('SET SESSION max_execution_time={0:d}'.format(statement_timeout))
+        cursor.close()
+    return connect
+
+
+def create_engines(uri, options=None):
+    """
+    create the engines for a database
+    file based SQLite databases get WAL journaling, synchronous=NORMAL, a busy timeout, a single writer connection and a
+    pool of reader connections, other databases a connection pool configured by the options
+    :param uri: database uri
+    :param options: mapping with pool_size, max_overflow, pool_recycle, pool_pre_ping, statement_timeout (ms) and
+                    busy_timeout (ms)
+    :return: (writer, reader) engines, reader is None when all statements use the writer
+    """
+    url = make_url(uri)
+    pool_size = int(_option(options, 'pool_size', 5))
+    busy_timeout = int(_option(options, 'busy_timeout', 5000))
+    statement_timeout = int(_option(options, 'statement_timeout', 0))
+    if url.get_backend_name() == 'sqlite':
+        if not url.database or url.database == ':memory:':
+            return create_engine(uri, convert_unicode=True), None
+        connect_args = {'check_same_thread': False, 'timeout': busy_timeout / 1000.0}
+        writer = create_engine(uri, convert_unicode=True, connect_args=connect_args, poolclass=QueuePool,
+                               pool_size=1, max_overflow=0, pool_timeout=max(busy_timeout / 1000.0, 1))
+        reader = create_engine(uri, convert_unicode=True, connect_args=connect_args, poolclass=QueuePool,
+                               pool_size=pool_size, max_overflow=int(_option(options, 'max_overflow', 10)))
+        for engine in (writer, reader):
+            event.listen(engine, 'connect', _sqlite_pragmas(busy_timeout))
+        return writer, reader
+    kwargs = dict(pool_size=pool_size,
+                  max_overflow=int(_option(options, 'max_overflow', 10)),
+                  pool_recycle=int(_option(options, 'pool_recycle', -1)),
+                  pool_pre_ping=bool(_option(options, 'pool_pre_ping', False)))
+    if statement_timeout and url.get_backend_name() == 'postgresql':
+        kwargs['connect_args'] = {'options': '-c statement_timeout={0:d}'.format(statement_timeout)}
+    writer = create_engine(uri, convert_unicode=True, **kwargs)
+    if statement_timeout and url.get_backend_name() == 'mysql':
+        event.listen(writer, 'connect', _mysql_timeout(statement_timeout))
+    return writer, None
+
+
+def pool_stats():
+    """
+    utilisation of the connection pools
+    :return: dict of engine name to pool counters
+    """
+    stats = {}
+    for name, engine in engines.items():
+        if engine is None:
+            continue
+        pool = engine.pool
+        stats[name] = dict(pool=pool.__class__.__name__, status=pool.status())
+        if isinstance(pool, QueuePool):
+            stats[name].update(size=pool.size(), checked_in=pool.checkedin(), checked_out=pool.checkedout(),
+                               overflow=pool.overflow())
+    return stats
+
+
+def insert_statement(table, dialect):
+    """
+    insert skipping rows that conflict with a unique key of the table, like the natural key of the usage
+    :param table: table
+    :param dialect: name of the database dialect
+    :return: insert statement
+    """
+    if dialect == 'postgresql':
+        return postgresql_insert(table).on_conflict_do_nothing()
+    if dialect == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    if dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    return table.insert()
+
+
+def create_missing_indexes(session, tables):
+    """
+    create the indexes declared on tables that were created before the indexes were added, unique indexes are left
+    out because existing rows may violate them
+    :param session: database session
+    :param tables: list of Table
+    :return: list of created index names
+    """
+    connection = session.connection()
+    inspector = inspect(connection)
+    created = []
+    for table in tables:
+        if not connection.dialect.has_table(connection, table.name):
+            continue
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if index.unique or index.name in existing:
+                continue
+            index.create(connection)
+            created.append(index.name)
+    session.commit()
+    return created
 
 
-def init_db(uri, persist=True):
-    global db_session
-    engine = create_engine(uri, convert_unicode=True)
-    db_session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
-    Base.query = db_session.query_property()
+def init_db(uri, persist=True, options=None):
+    """
+    connect the session to a database and create the tables
+    :param uri: database uri
+    :param persist: keep existing tables, drop them otherwise
+    :param options: engine options, see create_engines
+    :return: db_session
+    """
+    writer, reader = create_engines(uri, options)
+    db_session.remove()
+    db_session.configure(bind=writer, reader=reader)
+    engines.clear()
+    engines.update(writer=writer, reader=reader)
     if not persist:
-        Base.metadata.drop_all(engine)
-    Base.metadata.create_all(bind=engine)
+        Base.metadata.drop_all(writer)
+    Base.metadata.create_all(bind=writer)
+    table_versions.reset()
+    table_versions.seed(db_session, Base.metadata.tables)
+    table_versions.refresh(writer)
     return db_session
@@ -19,11 +19,78 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
-from sqlalchemy import Column, String, Boolean, DateTime, Numeric
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, String, Boolean, DateTime, Integer, BigInteger, Float, Numeric, Index, Table, MetaData, \
+    UniqueConstraint, event, inspect, select, union_all
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import relationship
 
 from db.group import group_resources
-from db.handler import Base
+from db.handler import Base, RoutingSession, mark_changed
+
+logger = logging.getLogger('db.resource')
+
+metrics = ('cpu', 'gpu', 'mem', 'disk')
+# base units of the integer storage: CPU and GPU hours in milliseconds, memory and disk GB's in bytes
+metric_scales = dict(cpu=3600000, gpu=3600000, mem=1000000000, disk=1000000000)
+
+
+class Metric(TypeDecorator):
+    """
+    usage metric, floats in API units at the boundary, stored as numeric, float or integer base units
+    the storage is chosen once per engine, set Metric.storage before creating it
+    """
+    impl = Numeric
+    storages = ('numeric', 'float', 'integer')
+    storage = 'numeric'
+
+    def __init__(self, scale=1, storage=None):
+        super(Metric, self).__init__()
+        self.scale = scale
+        self.fixed = storage
+
+    @property
+    def mode(self):
+        return self.fixed or Metric.storage
+
+    def load_dialect_impl(self, dialect):
+        if self.mode == 'integer':
+            return dialect.type_descriptor(BigInteger())
+        if self.mode == 'float':
+            return dialect.type_descriptor(Float(precision=53))
+        return dialect.type_descriptor(Numeric(asdecimal=False))
+
+    def bind_processor(self, dialect):
+        impl = self.load_dialect_impl(dialect).bind_processor(dialect)
+        if self.mode != 'integer':
+            return impl
+        scale = self.scale
+
+        def process(value):
+            if value is None:
+                return None
+            return int(round(float(value) * scale))
+        return process
+
+    def result_processor(self, dialect, coltype):
+        impl = self.load_dialect_impl(dialect).result_processor(dialect, coltype)
+        if self.mode != 'integer':
+            return impl
+        scale = self.scale
+
+        def process(value):
+            if value is None:
+                return None
+            return value / scale
+        return process
+
+    def copy(self, **kw):
+        return Metric(self.scale, self.fixed)
 
 
 class Resource(Base):
@@ -36,12 +103,403 @@ class Resource(Base):
 
 class ResourceUsage(Base):
     __tablename__ = 'resource_usage'
+    __table_args__ = (
+        Index('ux_resource_usage_key', 'resource', 'user', 'start', 'end', 'record', unique=True),
+        Index('ix_resource_usage_user_start', 'user', 'start'),
+    )
 
     resource = Column(String(100))
     user = Column(String(255))
     start = Column(DateTime)
     end = Column(DateTime)
-    cpu = Column(Numeric)
-    gpu = Column(Numeric)
-    mem = Column(Numeric)
-    disk = Column(Numeric)
+    # client record id, part of the natural key so collectors can resend usage without creating duplicates
+    record = Column(String(100), nullable=False, default='', server_default='')
+    cpu = Column(Metric(metric_scales['cpu']))
+    gpu = Column(Metric(metric_scales['gpu']))
+    mem = Column(Metric(metric_scales['mem']))
+    disk = Column(Metric(metric_scales['disk']))
+
+
+class UsagePartition(Base):
+    __tablename__ = 'usage_partitions'
+    name = Column(String(100), unique=True)
+    start = Column(DateTime, index=True)
+    end = Column(DateTime, index=True)
+    archived = Column(Boolean, default=False, nullable=False)
+
+
+class UsageRollup(object):
+    """
+    usage aggregated per resource, user and bucket (start of the usage truncated to the period)
+    """
+    period = None
+
+    @declared_attr
+    def __table_args__(cls):
+        return (UniqueConstraint('resource', 'user', 'bucket', name='uq_{0}'.format(cls.__tablename__)),
+                Index('ix_{0}_user_bucket'.format(cls.__tablename__), 'user', 'bucket'))
+
+    resource = Column(String(100), nullable=False)
+    user = Column(String(255), nullable=False)
+    bucket = Column(DateTime, nullable=False, index=True)
+    count = Column(Integer, nullable=False)
+    cpu = Column(Metric(metric_scales['cpu']))
+    gpu = Column(Metric(metric_scales['gpu']))
+    mem = Column(Metric(metric_scales['mem']))
+    disk = Column(Metric(metric_scales['disk']))
+
+
+class HourlyUsage(UsageRollup, Base):
+    __tablename__ = 'usage_hourly'
+    period = 'hour'
+
+
+class DailyUsage(UsageRollup, Base):
+    __tablename__ = 'usage_daily'
+    period = 'day'
+
+
+class RollupWatermark(Base):
+    """
+    start of the usage a rollup holds completely, usage starting before it was stored before the rollup was
+    maintained, None when the rollup holds all usage
+    """
+    __tablename__ = 'usage_rollup_watermarks'
+    name = Column(String(100), unique=True)
+    start = Column(DateTime)
+
+
+class UsageBatch(Base):
+    """
+    status of an asynchronously ingested usage batch, shared by the worker processes
+    """
+    __tablename__ = 'usage_batches'
+    batch = Column(String(32), unique=True)
+    status = Column(String(20), nullable=False)
+    subject = Column(String(255))
+    records = Column(Integer)
+    accepted = Column(Integer)
+    rejected = Column(Integer)
+    duplicates = Column(Integer)
+    submitted = Column(DateTime)
+    finished = Column(DateTime, index=True)
+
+
+class UsagePartitions(object):
+    """
+    routes resource usage to a table per period (day, month or year) based on the start of the usage
+    the resource_usage table is always part of every query, it holds usage from before partitioning was enabled
+    usage for archived periods is not written, also not when another process archived the period
+    """
+
+    periods = ('day', 'month', 'year')
+
+    def __init__(self, period=None):
+        self._lock = threading.Lock()
+        self.configure(period)
+
+    def configure(self, period=None):
+        """
+        set the partition period and forget known partitions, call after (re)initializing the database
+        :param period: day, month, year or None to disable partitioning
+        """
+        if period not in self.periods + (None, 'none'):
+            logger.error("unknown usage partition period {0}, partitioning disabled".format(period))
+        with self._lock:
+            self.period = period
+            self.metadata = MetaData()
+            self._tables = {}
+            # partitions known to exist, added once the transaction creating them committed
+            self._created = set()
+            self._archived = set()
+
+    @property
+    def enabled(self):
+        return self.period in self.periods
+
+    def bounds(self, when):
+        """
+        period containing a timestamp
+        :param when: datetime
+        :return: (start, end) of the period
+        """
+        if self.period == 'day':
+            start = datetime(when.year, when.month, when.day)
+            return start, start + timedelta(days=1)
+        if self.period == 'year':
+            return datetime(when.year, 1, 1), datetime(when.year + 1, 1, 1)
+        start = datetime(when.year, when.month, 1)
+        if when.month == 12:
+            return start, datetime(when.year + 1, 1, 1)
+        return start, datetime(when.year, when.month + 1, 1)
+
+    def name(self, start):
+        if self.period == 'day':
+            return 'resource_usage_{0:%Y%m%d}'.format(start)
+        if self.period == 'year':
+            return 'resource_usage_{0:%Y}'.format(start)
+        return 'resource_usage_{0:%Y%m}'.format(start)
+
+    def table(self, name):
+        """
+        table object for a partition, with the columns and indexes of resource_usage
+        :param name: partition table name
+        :return: Table
+        """
+        table = self._tables.get(name)
+        if table is None:
+            with self._lock:
+                table = self.metadata.tables.get(name)
+                if table is None:
+                    table = Table(name, self.metadata, *[c.copy() for c in ResourceUsage.__table__.columns],
+                                  info=dict(version_key=ResourceUsage.__tablename__))
+                    Index('ux_{0}_key'.format(name), table.c.resource, table.c.user, table.c.start, table.c.end,
+                          table.c.record, unique=True)
+                    Index('ix_{0}_user_start'.format(name), table.c.user, table.c.start)
+                self._tables[name] = table
+        return table
+
+    def create(self, session, start):
+        """
+        create the partition for the period starting at start, if it does not exist yet
+        :param session: database session
+        :param start: start of the period
+        :return: Table or None if the partition is archived
+        """
+        name = self.name(start)
+        if name in self._archived:
+            return None
+        if name in self._created:
+            return self.table(name)
+        partition = session.query(UsagePartition).filter(UsagePartition.name == name).one_or_none()
+        if partition and partition.archived:
+            self._archived.add(name)
+            return None
+        table = self.table(name)
+        table.create(session.connection(), checkfirst=True)
+        if not partition:
+            start, end = self.bounds(start)
+            try:
+                with session.begin_nested():
+                    session.add(UsagePartition(name=name, start=start, end=end, archived=False))
+            except IntegrityError:
+                logger.debug("partition {0} registered by another worker".format(name))
+            logger.info("created usage partition {0}".format(name))
+        session.info.setdefault('partitions', set()).add(name)
+        return table
+
+    def committed(self, names):
+        """
+        remember partitions as created, once the transaction creating them committed
+        :param names: partition table names
+        """
+        with self._lock:
+            self._created |= set(names) - self._archived
+
+    def archived(self, session, names):
+        """
+        archived partitions among names, read from the registry as other processes archive partitions, the registry
+        rows are share locked until the transaction ends so they cannot be archived while it writes to them
+        :param session: database session
+        :param names: partition table names
+        :return: set of archived names
+        """
+        archived = set(names) & self._archived
+        unknown = set(names) - archived
+        if unknown:
+            query = session.query(UsagePartition.name, UsagePartition.archived)\
+                .filter(UsagePartition.name.in_(unknown)).with_for_update(read=True)
+            found = set(name for name, flag in query.all() if flag)
+            if found:
+                with self._lock:
+                    self._archived |= found
+                    self._created -= found
+                    for name in found:
+                        self._tables.pop(name, None)
+            archived |= found
+        return archived
+
+    def route(self, session, rows):
+        """
+        split usage rows over their partitions, creating partitions as needed
+        :param session: database session
+        :param rows: list of row dicts
+        :return: dict of Table to list of rows, the rows of archived periods under None
+        """
+        if not self.enabled:
+            return {ResourceUsage.__table__: rows}
+        starts = [self.bounds(row['start'])[0] for row in rows]
+        periods = set(starts)
+        archived = self.archived(session, [self.name(start) for start in periods])
+        tables = dict((start, None if self.name(start) in archived else self.create(session, start))
+                      for start in periods)
+        routed = {}
+        for start, row in zip(starts, rows):
+            routed.setdefault(tables[start], []).append(row)
+        return routed
+
+    def tables(self, session, start=None, end=None):
+        """
+        tables holding usage that starts between start and end
+        :param session: database session
+        :param start: window start or None
+        :param end: window end or None
+        :return: list of Table, resource_usage first
+        """
+        tables = [ResourceUsage.__table__]
+        query = session.query(UsagePartition.name).filter(UsagePartition.archived.is_(False))
+        if start:
+            query = query.filter(UsagePartition.end > start)
+        if end:
+            query = query.filter(UsagePartition.start <= end)
+        for (name,) in query.order_by(UsagePartition.start).all():
+            tables.append(self.table(name))
+        return tables
+
+    def select(self, session, columns, start=None, end=None, where=None, order_by=None):
+        """
+        select usage over all partitions overlapping a window
+        :param session: database session
+        :param columns: function of a table returning the columns to select
+        :param start: window start or None
+        :param end: window end or None
+        :param where: function of a table returning a filter clause or None
+        :param order_by: name of the column to order by or None
+        :return: selectable
+        """
+        selects = []
+        for table in self.tables(session, start, end):
+            query = select(columns(table))
+            if where is not None:
+                query = query.where(where(table))
+            selects.append(query)
+        query = selects[0] if len(selects) == 1 else union_all(*selects)
+        if order_by:
+            query = query.order_by(query.c[order_by])
+        return query
+
+    def archive(self, session, name):
+        """
+        archive a partition, it is no longer queried or written to, the table itself is kept
+        :param session: database session
+        :param name: partition table name
+        :return: archived yes/no
+        """
+        partition = session.query(UsagePartition).filter(UsagePartition.name == name).one_or_none()
+        if not partition:
+            return False
+        partition.archived = True
+        session.commit()
+        with self._lock:
+            self._archived.add(name)
+            self._created.discard(name)
+            self._tables.pop(name, None)
+        return True
+
+
+usage_partitions = UsagePartitions()
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _partitions_committed(session):
+    if session.transaction is not None and session.transaction.nested:
+        return
+    usage_partitions.committed(session.info.pop('partitions', ()))
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def _partitions_ended(session, transaction):
+    if transaction.parent is None:
+        # partitions of a transaction that rolled back may not exist, DDL is transactional on PostgreSQL
+        session.info.pop('partitions', None)
+
+
+def usage_tables(session):
+    """
+    all tables holding usage metrics: resource_usage, the rollups and every registered partition (archived or not)
+    :param session: database session
+    :return: list of Table
+    """
+    tables = [ResourceUsage.__table__, HourlyUsage.__table__, DailyUsage.__table__]
+    for (name,) in session.query(UsagePartition.name).order_by(UsagePartition.start).all():
+        tables.append(usage_partitions.table(name))
+    return tables
+
+
+def migrate_metrics(session, source, target):
+    """
+    convert the stored usage metrics from one storage to another with set based statements, in one transaction
+    sqlite columns hold any number so only the values are converted, other databases also change the column type
+    :param session: database session
+    :param source: current storage (numeric, float or integer)
+    :param target: new storage
+    :return: list of converted table names
+    """
+    connection = session.connection()
+    dialect = connection.dialect
+    quote = dialect.identifier_preparer.quote
+    converted = []
+    for table in usage_tables(session):
+        if not dialect.has_table(connection, table.name):
+            continue
+        for metric in metrics:
+            scale = table.c[metric].type.scale
+            column = quote(metric)
+            if target == 'integer' and source != 'integer':
+                value = 'ROUND({0} * {1})'.format(column, scale)
+            elif source == 'integer' and target != 'integer':
+                value = '{0} * 1.0 / {1}'.format(column, scale)
+            else:
+                value = column
+            impl = Metric(scale, target).dialect_impl(dialect)
+            if dialect.name == 'postgresql':
+                session.execute('ALTER TABLE {0} ALTER COLUMN {1} TYPE {2} USING {3}'.format(
+                    quote(table.name), column, dialect.type_compiler.process(impl), value))
+                continue
+            if value != column:
+                session.execute('UPDATE {0} SET {1} = {2}'.format(quote(table.name), column, value))
+            if dialect.name != 'sqlite':
+                session.execute('ALTER TABLE {0} MODIFY {1} {2}'.format(
+                    quote(table.name), column, dialect.type_compiler.process(impl)))
+        converted.append(table.name)
+    session.commit()
+    return converted
+
+
+def add_usage_key(session):
+    """
+    add the record column and the unique natural key to usage tables created before they existed
+    duplicate rows (same resource, user, start, end and record) are removed, keeping the first inserted one
+    :param session: database session
+    :return: dict of table name to number of removed duplicates
+    """
+    connection = session.connection()
+    dialect = connection.dialect
+    quote = dialect.identifier_preparer.quote
+    inspector = inspect(connection)
+    removed = {}
+    tables = [ResourceUsage.__table__]
+    tables.extend(usage_partitions.table(n) for (n,) in session.query(UsagePartition.name).order_by(UsagePartition.start))
+    for table in tables:
+        if not dialect.has_table(connection, table.name):
+            continue
+        if 'record' not in [c['name'] for c in inspector.get_columns(table.name)]:
+            session.execute("ALTER TABLE {0} ADD COLUMN {1} VARCHAR(100) NOT NULL DEFAULT ''".format(
+                quote(table.name), quote('record')))
+        key = [quote(c) for c in ('resource', 'user', 'start', 'end', 'record')]
+        # the derived table lets mysql select from the table it deletes from
+        result = session.execute('DELETE FROM {0} WHERE {1} NOT IN (SELECT id FROM (SELECT MIN({1}) AS id FROM {0} '
+                                 'GROUP BY {2}) AS keep)'.format(quote(table.name), quote('id'), ', '.join(key)))
+        removed[table.name] = max(result.rowcount, 0)
+        if removed[table.name]:
+            mark_changed(session, ResourceUsage.__tablename__)
+        indexes = [i['name'] for i in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.unique and index.name not in indexes:
+                index.create(connection)
+        old = 'ix_{0}_resource_user_start'.format(table.name)
+        if old in indexes:
+            # covered by the natural key
+            Index(old, table.c.resource, table.c.user, table.c.start).drop(connection)
+    session.commit()
+    return removed
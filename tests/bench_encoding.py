@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2019, Pim Witlox. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+
+"""
+benchmark of the JSON encoders of api.encoding on usage rows, not part of the test run
+
+    PYTHONPATH=. python tests/bench_encoding.py [--rows 100000] [--repeat 3]
+
+the encoder picked by json = auto should be the fastest one installed
+"""
+
+import argparse
+from datetime import datetime, timedelta
+from decimal import Decimal
+from timeit import repeat
+
+from flask import Flask, json
+
+from api.encoding import encoders
+
+app = Flask(__name__)
+
+
+def usage_rows(count, decimal=True):
+    start = datetime(2019, 10, 1)
+    number = Decimal if decimal else float
+    return [dict(id=i, resource='resource_{0}'.format(i % 10), user='user_{0}'.format(i % 1000),
+                 start=start + timedelta(minutes=i), end=start + timedelta(minutes=i + 30),
+                 cpu=number('1.5'), gpu=None, mem=number('0.25'), disk=number('12.125'))
+            for i in range(count)]
+
+
+def connexion_default(rows):
+    # what connexion did before api.encoding, flask.json with indent=2
+    with app.app_context():
+        return json.dumps(rows, indent=2)
+
+
+def candidates():
+    yield 'connexion default (indent=2)', connexion_default
+    for name, cls in encoders:
+        try:
+            yield name, cls().dumps
+        except ImportError:
+            print("  {0:<30} not installed".format(name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    for decimal in (True, False):
+        rows = usage_rows(args.rows, decimal)
+        print("{0} usage rows, {1} metrics".format(args.rows, 'Decimal' if decimal else 'float'))
+        for name, dumps in candidates():
+            seconds = min(repeat(lambda: dumps(rows), number=1, repeat=args.repeat))
+            print("  {0:<30} {1:.3f}s".format(name, seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -66,7 +66,7 @@ def test_add_list_remove_as_admin(client):
     from api.auth import tokens
 
     user_token = generate_token('test_user')
-    tokens['test_user'] = user_token
+    tokens.add('test_user', user_token)
     with client.session_transaction() as session:
         session['username'] = 'test_user'
 
@@ -77,7 +77,7 @@ def test_add_list_remove_as_admin(client):
     lg = client.post('/api/v1/logout', headers={'X-TOKEN': user_token})
     assert 200 == lg.status_code
 
-    tokens.pop('test_user', None)
+    tokens.remove_subject('test_user')
     with client.session_transaction() as session:
         if 'username' in session:
             del(session['username'])
@@ -111,3 +111,43 @@ def test_add_list_remove_service(client):
 
     lg = client.post('/api/v1/logout', headers=generate_token_headers(dict(), token))
     assert 200 == lg.status_code
+
+
+def test_permission_checks_share_one_query(client):
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from api.admin import is_admin, is_group_admin, user_is_group_admin
+
+    lg = client.post("/api/v1/login?username={0}&password={1}".format(access, encoded_secret))
+    assert 200 == lg.status_code
+    token = json.loads(lg.data)
+    lg = client.post('/api/v1/users', json={'dom_name': 'test_principal', 'full_name': 'test user'}, headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+    lg = client.post('/api/v1/groups', json={'name': 'test_principal_group', 'dom_name': 'test_principal', 'active': True}, headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+    group = json.loads(lg.data)
+    lg = client.put("/api/v1/groups/{0}?u=test_principal&admin=True".format(group['id']), headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+    lg = client.post('/api/v1/logout', headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(Engine, 'before_cursor_execute', count)
+    try:
+        with client.application.test_request_context():
+            from flask import session
+            session['username'] = 'test_principal'
+            assert not is_admin()
+            assert is_group_admin(group['id'])
+            assert is_group_admin('test_principal_group')
+            assert user_is_group_admin('test_principal', 'test_principal_group')
+            assert not is_group_admin('admins')
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count)
+    # the table versions are read once per request
+    assert 1 == len([s for s in statements if 'FROM table_versions' in s])
+    assert 1 == len([s for s in statements if 'FROM table_versions' not in s])
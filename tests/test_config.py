@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2019, Pim Witlox. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+import pytest
+
+from config import Config
+
+
+def test_typed_sections():
+    config = Config(create=False)
+    assert 8080 == config.general().port
+    assert config.general().cors is False
+    assert 3600 == config.token().lifetime
+    assert config.authentication().ssl is True
+    assert 'HS256' == config.token().get('algorithm')
+    with pytest.raises(AttributeError):
+        config.token().lifetime = 60
+
+
+def test_update_and_reload(tmpdir):
+    path = str(tmpdir.join('api.config'))
+    config = Config(path)
+    config.update('token', 'lifetime', '60')
+    token = config.token()
+    assert 60 == token.lifetime
+    config.reload()
+    assert 3600 == config.token().lifetime
+    assert 60 == token.lifetime
+    with open(path, 'a') as cf:
+        cf.write('\n[custom]\nttl = 5\n')
+    config.reload()
+    assert '5' == config.sections['custom']['ttl']
@@ -114,7 +114,7 @@ def test_retrieve_group_users_as_user(client):
     from api.auth import tokens
 
     user_token = generate_token(user_name)
-    tokens[user_name] = user_token
+    tokens.add(user_name, user_token)
     with client.session_transaction() as session:
         session['username'] = user_name
 
@@ -126,7 +126,104 @@ def test_retrieve_group_users_as_user(client):
     lg = client.get("/api/v1/groups/{0}".format(me['groups'][0]['id']), headers={'X-TOKEN': user_token})
     assert 200 == lg.status_code
 
-    tokens.pop(user_name, None)
+    tokens.remove_subject(user_name)
     with client.session_transaction() as session:
         if 'username' in session:
             del(session['username'])
+
+
+def test_membership_cache_invalidated_on_remove(client):
+    lg = client.post("/api/v1/login?username={0}&password={1}".format(access, encoded_secret))
+    assert 200 == lg.status_code
+    token = json.loads(lg.data)
+
+    dom_name = 'test_pi_3'
+    group_name = 'test_group_3'
+    user_name = 'test_user_3'
+    lg = client.post('/api/v1/users', json={'dom_name': dom_name, 'full_name': 'test pi'}, headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+    lg = client.post('/api/v1/groups', json={'name': group_name, 'dom_name': dom_name, 'active': True}, headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+    group_id = json.loads(lg.data)['id']
+    lg = client.post('/api/v1/users', json={'dom_name': user_name, 'full_name': 'test user'}, headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+    lg = client.put("/api/v1/groups/{0}?u={1}&admin=False".format(group_id, user_name), headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+    lg = client.post('/api/v1/logout', headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+
+    from api.acl import acl
+    from api.auth import generate_token
+    from api.auth import tokens
+
+    user_token = generate_token(user_name)
+    tokens.add(user_name, user_token)
+    with client.session_transaction() as session:
+        session['username'] = user_name
+
+    hits = acl.hits
+    lg = client.get("/api/v1/groups/{0}".format(group_id), headers={'X-TOKEN': user_token})
+    assert 200 == lg.status_code
+    lg = client.get("/api/v1/groups/{0}".format(group_id), headers={'X-TOKEN': user_token})
+    assert 200 == lg.status_code
+    assert acl.hits > hits
+
+    with client.session_transaction() as session:
+        session['admin'] = 1
+    lg = client.delete("/api/v1/groups/{0}?u={1}".format(group_id, user_name), headers={'X-TOKEN': user_token})
+    assert 200 == lg.status_code
+    with client.session_transaction() as session:
+        del(session['admin'])
+
+    lg = client.get("/api/v1/groups/{0}".format(group_id), headers={'X-TOKEN': user_token})
+    assert 401 == lg.status_code
+
+    tokens.remove_subject(user_name)
+    with client.session_transaction() as session:
+        if 'username' in session:
+            del(session['username'])
+
+
+def test_filter_groups(client):
+    lg = client.post("/api/v1/login?username={0}&password={1}".format(access, encoded_secret))
+    assert 200 == lg.status_code
+    token = json.loads(lg.data)
+
+    dom_name = 'test_pi_4'
+    lg = client.post('/api/v1/users', json={'dom_name': dom_name, 'full_name': 'test pi'}, headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+    for name, active in [('filter_a_1', True), ('filter_a_2', False), ('filter_b%', True)]:
+        lg = client.post('/api/v1/groups', json={'name': name, 'dom_name': dom_name, 'active': active}, headers=generate_token_headers(dict(), token))
+        assert 201 == lg.status_code
+    lg = client.post('/api/v1/resources?name=test_filter_resource', headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+    resource = json.loads(lg.data)
+    lg = client.put("/api/v1/resource/{0}?name=filter_a_1".format(resource['id']), headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+
+    def names(query):
+        lg = client.get('/api/v1/groups?{0}'.format(query), headers=generate_token_headers(dict(), token))
+        assert 200 == lg.status_code
+        return sorted(g['name'] for g in json.loads(lg.data))
+
+    assert ['filter_a_1', 'filter_a_2', 'filter_b%'] == names('owner={0}'.format(dom_name))
+    assert ['filter_a_1', 'filter_b%'] == names('owner={0}&active=true'.format(dom_name))
+    assert ['filter_a_1', 'filter_a_2'] == names('prefix=filter_a')
+    assert ['filter_b%'] == names('prefix=filter_b%25')
+    assert ['filter_a_1'] == names('resource={0}'.format(resource['id']))
+
+    lg = client.post('/api/v1/logout', headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+
+
+def test_group_indexes_on_existing_database(client):
+    from sqlalchemy import text
+    from db.group import Group, group_resources
+    from db.handler import create_missing_indexes, db_session
+
+    for name in ('ix_groups_active', 'ix_groups_user_id', 'ix_group_resources_group'):
+        db_session.execute(text('DROP INDEX {0}'.format(name)))
+    db_session.commit()
+    assert ['ix_group_resources_group', 'ix_groups_active', 'ix_groups_user_id'] == \
+        sorted(create_missing_indexes(db_session, [Group.__table__, group_resources]))
+    assert [] == create_missing_indexes(db_session, [Group.__table__, group_resources])
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2019, Pim Witlox. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+import threading
+
+from sqlalchemy import text
+
+
+def test_sqlite_file_uses_wal_and_single_writer(tmp_path):
+    from db.handler import init_db, engines, pool_stats
+    from db.user import User
+
+    session = init_db('sqlite:///{0}'.format(tmp_path / 'pool.db'), options=dict(pool_size=3, busy_timeout=2000))
+    try:
+        assert 'wal' == session.execute(text('PRAGMA journal_mode')).scalar()
+        session.commit()
+        assert engines['writer'] is not engines['reader']
+        stats = pool_stats()
+        assert 1 == stats['writer']['size']
+        assert 3 == stats['reader']['size']
+
+        # reads use the reader until the transaction writes
+        assert engines['reader'] is session.get_bind(User, session.query(User).statement)
+        session.add(User(dom_name='test_pool_user', full_name='test pool'))
+        session.flush()
+        assert engines['writer'] is session.get_bind(User, session.query(User).statement)
+        session.commit()
+        assert engines['reader'] is session.get_bind(User, session.query(User).statement)
+        session.remove()
+
+        errors = []
+
+        def write(n):
+            try:
+                for i in range(20):
+                    session.add(User(dom_name='test_pool_{0}_{1}'.format(n, i), full_name='test pool'))
+                    session.commit()
+                    session.query(User).count()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                session.remove()
+
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert [] == errors
+        assert 81 == session.query(User).count()
+    finally:
+        session.remove()
+        init_db('sqlite://')
+
+
+def test_memory_database_has_no_reader():
+    from db.handler import init_db, engines
+
+    init_db('sqlite://')
+    assert engines['reader'] is None
+
+
+def test_table_versions_follow_commits():
+    from db.handler import init_db, table_versions
+    from db.group import Group
+    from db.resource import Resource, ResourceUsage
+    from db.user import User
+
+    session = init_db('sqlite://', persist=False)
+    before = dict((t, table_versions.get(t)) for t in ('users', 'groups', 'resources', 'group_resources', 'resource_usage'))
+
+    def changed():
+        return set(t for t, v in before.items() if table_versions.get(t) != v)
+
+    user = User(dom_name='test_versions', full_name='test versions')
+    session.add(user)
+    session.flush()
+    assert set() == changed()
+    session.commit()
+    assert {'users'} == changed()
+
+    group = Group(name='test_versions', active=True, user_id=user.id)
+    resource = Resource(name='test_versions', active=True)
+    session.add_all([group, resource])
+    session.flush()
+    session.rollback()
+    assert {'users'} == changed()
+
+    session.add_all([group, resource])
+    group.resources.append(resource)
+    session.commit()
+    assert {'users', 'groups', 'resources', 'group_resources'} == changed()
+
+    version = table_versions.get('resource_usage')
+    session.execute(ResourceUsage.__table__.insert(), [dict(resource='test_versions', user='test_versions')])
+    assert version == table_versions.get('resource_usage')
+    session.commit()
+    assert version + 1 == table_versions.get('resource_usage')
+    session.remove()
+
+
+def test_table_versions_are_persisted(tmp_path):
+    from db.handler import TableVersion, init_db, table_versions
+    from db.user import User
+
+    uri = 'sqlite:///{0}'.format(tmp_path / 'versions.db')
+    session = init_db(uri)
+    try:
+        seeded = table_versions.get('users')
+        assert seeded > 0
+        session.add(User(dom_name='test_persisted', full_name='test persisted'))
+        session.commit()
+        assert seeded + 1 == session.query(TableVersion.version).filter(TableVersion.name == 'users').scalar()
+        session.remove()
+
+        session = init_db(uri)
+        assert seeded + 1 == table_versions.get('users')
+
+        # another process changing the users
+        session.execute(TableVersion.__table__.update().where(TableVersion.name == 'users')
+                        .values(version=TableVersion.version + 1))
+        session.commit()
+        table_versions.reset()
+        table_versions.refresh()
+        assert seeded + 2 == table_versions.get('users')
+    finally:
+        session.remove()
+        init_db('sqlite://')
+
+
+def test_acl_cache_follows_table_versions():
+    from api.acl import ACLCache
+    from db.handler import init_db, table_versions
+    from db.group import Group
+
+    session = init_db('sqlite://')
+    cache = ACLCache(ttl=60)
+    loads = []
+
+    def load():
+        loads.append(1)
+        return len(loads)
+
+    assert 1 == cache.get(('admins',), load)
+    assert 1 == cache.get(('admins',), load)
+    table_versions.update([('members', table_versions.get('members') + 1)])
+    assert 2 == cache.get(('admins',), load)
+    session.add(Group(name='test_acl_versions', active=True))
+    session.commit()
+    assert 3 == cache.get(('admins',), load)
+    session.remove()
+
+
+def test_create_missing_indexes():
+    from db.handler import create_missing_indexes, init_db
+    from db.resource import ResourceUsage
+
+    session = init_db('sqlite://', persist=False)
+    try:
+        session.execute(text('DROP INDEX ix_resource_usage_user_start'))
+        session.commit()
+        assert ['ix_resource_usage_user_start'] == create_missing_indexes(session, [ResourceUsage.__table__])
+        assert [] == create_missing_indexes(session, [ResourceUsage.__table__])
+        indexes = [r[1] for r in session.execute(text('PRAGMA index_list(resource_usage)'))]
+        assert 'ix_resource_usage_user_start' in indexes
+    finally:
+        session.remove()
+        init_db('sqlite://', persist=False)
@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2019, Pim Witlox. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+from datetime import datetime
+
+import pytest
+
+
+def test_parse_timestamp():
+    from api.ingest import parse_timestamp
+
+    assert datetime(2019, 10, 1, 10, 0, 0) == parse_timestamp('2019-10-01T10:00:00')
+    assert datetime(2019, 10, 1, 10, 0, 0) == parse_timestamp('2019-10-01 10:00:00Z')
+    assert datetime(2019, 10, 1, 10, 0, 0, 123000) == parse_timestamp('2019-10-01T10:00:00.123Z')
+    assert datetime(2019, 10, 1, 8, 30, 0) == parse_timestamp('2019-10-01T10:00:00+01:30')
+    assert datetime(2019, 10, 1, 11, 0, 0) == parse_timestamp('2019-10-01T10:00:00-0100')
+    assert datetime(2019, 10, 1, 10, 0, 0) == parse_timestamp('Tue, 01 Oct 2019 10:00:00 GMT')
+    assert datetime(2019, 10, 1, 10, 0, 0) == parse_timestamp(datetime(2019, 10, 1, 10, 0, 0))
+    with pytest.raises(ValueError):
+        parse_timestamp('2019-13-01T10:00:00')
+
+
+def test_parse_iso_without_fromisoformat():
+    from api.ingest import _parse_iso
+
+    assert datetime(2019, 10, 1, 10, 0, 0, 123000) == _parse_iso('2019-10-01T10:00:00.123Z')
+    assert datetime(2019, 10, 1, 8, 30, 0) == _parse_iso('2019-10-01T10:00:00+01:30')
+    assert datetime(2019, 10, 1, 11, 0, 0) == _parse_iso('2019-10-01T10:00:00-01')
+    with pytest.raises(ValueError):
+        _parse_iso('2019-10-01T10:00:00 UTC')
+
+
+def test_ingest_into_monthly_partitions():
+    from sqlalchemy import inspect
+    from api.ingest import ingest_usages
+    from api.rollup import archive_partition, check_rollups
+    from db.handler import init_db
+    from db.resource import DailyUsage, usage_partitions
+
+    session = init_db('sqlite://', persist=False)
+    usage_partitions.configure('month')
+    try:
+        usages = [dict(r='partitioned', u='user', start='2019-{0:02d}-15T10:00:00Z'.format(m),
+                       end='2019-{0:02d}-15T11:00:00Z'.format(m), cpu=m) for m in (10, 11, 12)]
+        assert (3, 0, 0) == ingest_usages(usages)
+        tables = inspect(session.get_bind()).get_table_names()
+        assert {'resource_usage_201910', 'resource_usage_201911', 'resource_usage_201912'} <= set(tables)
+
+        window = (datetime(2019, 11, 1), datetime(2019, 11, 30))
+        assert ['resource_usage', 'resource_usage_201911'] == [t.name for t in usage_partitions.tables(session, *window)]
+        query = usage_partitions.select(session, lambda t: [t.c.cpu], order_by='cpu')
+        assert [10, 11, 12] == [int(r.cpu) for r in session.execute(query)]
+
+        assert [] == check_rollups(session)
+        assert archive_partition(session, 'resource_usage_201910')
+        assert not archive_partition(session, 'resource_usage_201001')
+        # archived usage is dropped from the rollups as well
+        assert [] == check_rollups(session)
+        assert 2 == session.query(DailyUsage).count()
+        query = usage_partitions.select(session, lambda t: [t.c.cpu], order_by='cpu')
+        assert [11, 12] == [int(r.cpu) for r in session.execute(query)]
+        # late usage for an archived period is rejected
+        assert (1, 1, 0) == ingest_usages([dict(r='partitioned', u='user', start='2019-{0:02d}-16T10:00:00Z'.format(m),
+                                             end='2019-{0:02d}-16T11:00:00Z'.format(m), cpu=m - 10) for m in (10, 11)])
+        query = usage_partitions.select(session, lambda t: [t.c.cpu], order_by='cpu')
+        assert [1, 11, 12] == [int(r.cpu) for r in session.execute(query)]
+        assert [] == check_rollups(session)
+    finally:
+        usage_partitions.configure(None)
+
+
+def test_ingest_after_archive_by_another_process(tmp_path):
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.orm import sessionmaker
+    from api.ingest import ingest_usages
+    from db.handler import init_db
+    from db.resource import UsagePartitions, usage_partitions
+
+    uri = 'sqlite:///{0}'.format(tmp_path / 'usage.db')
+    session = init_db(uri)
+    usage_partitions.configure('month')
+    other = create_engine(uri)
+    try:
+        usages = [dict(r='partitioned', u='user', start='2019-10-{0:02d}T10:00:00Z'.format(d),
+                       end='2019-10-{0:02d}T11:00:00Z'.format(d), cpu=d) for d in (15, 16)]
+        assert (1, 0, 0) == ingest_usages(usages[:1])
+        # the partition is cached by this process when another one archives it
+        archiver = sessionmaker(bind=other)()
+        assert UsagePartitions('month').archive(archiver, 'resource_usage_201910')
+        archiver.close()
+        assert (0, 1, 0) == ingest_usages(usages[1:])
+        assert 1 == session.execute(text('SELECT count(*) FROM resource_usage_201910')).scalar()
+        assert 0 == session.execute(text('SELECT count(*) FROM resource_usage')).scalar()
+    finally:
+        usage_partitions.configure(None)
+        other.dispose()
+        session.remove()
+
+
+def test_ingest_after_rollback_into_new_partition(tmp_path, monkeypatch):
+    from sqlalchemy import text
+    from api import ingest
+    from db.handler import init_db
+    from db.resource import UsagePartition, usage_partitions
+
+    def broken(session, rows):
+        raise RuntimeError('rollups gone')
+
+    session = init_db('sqlite:///{0}'.format(tmp_path / 'usage.db'))
+    usage_partitions.configure('month')
+    usages = [dict(r='partitioned', u='user', start='2019-10-15T10:00:00Z', end='2019-10-15T11:00:00Z', cpu=1)]
+    try:
+        monkeypatch.setattr(ingest, 'update_rollups', broken)
+        with pytest.raises(RuntimeError):
+            ingest.ingest_usages(usages)
+        monkeypatch.undo()
+        # pysqlite commits the DDL and the savepoint anyway, undo them as transactional DDL (PostgreSQL) does
+        session.execute(text('DROP TABLE IF EXISTS resource_usage_201910'))
+        session.query(UsagePartition).delete()
+        session.commit()
+        # the partition created by the transaction that rolled back is created again
+        assert (1, 0, 0) == ingest.ingest_usages(usages)
+        assert ['resource_usage', 'resource_usage_201910'] == [t.name for t in usage_partitions.tables(session)]
+    finally:
+        usage_partitions.configure(None)
+        session.remove()
+
+def test_rollups_follow_ingest():
+    from api.ingest import ingest_usages
+    from api.rollup import check_rollups, rebuild_rollups
+    from db.handler import init_db
+    from db.resource import HourlyUsage, DailyUsage, ResourceUsage
+
+    session = init_db('sqlite://', persist=False)
+    usages = [dict(r='rolled', u='user', start='2019-10-01T{0:02d}:30:00Z'.format(h), end='2019-10-01T{0:02d}:45:00Z'.format(h),
+                   cpu=h) for h in range(10, 14)]
+    assert (4, 0, 0) == ingest_usages(usages)
+    # the resent record is skipped and not counted twice in the rollups
+    assert (1, 0, 1) == ingest_usages(usages[:1] + [dict(r='rolled', u='user', start='2019-10-02T00:00:00Z', end='2019-10-02T01:00:00Z')])
+    assert 5 == session.query(HourlyUsage).count()
+    daily = session.query(DailyUsage).order_by(DailyUsage.bucket).all()
+    assert [(4, 46), (1, None)] == [(d.count, d.cpu and int(d.cpu)) for d in daily]
+    assert [] == check_rollups(session)
+    assert (1, 0, 0) == ingest_usages([dict(usages[0], record='second')])
+    assert 5 == session.query(ResourceUsage).filter(ResourceUsage.start < datetime(2019, 10, 2)).count()
+    assert [] == check_rollups(session)
+
+    session.query(ResourceUsage).filter(ResourceUsage.cpu == 13).delete()
+    session.commit()
+    differences = check_rollups(session, datetime(2019, 10, 1), datetime(2019, 10, 2))
+    assert {'usage_hourly', 'usage_daily'} == set(d['table'] for d in differences)
+    assert dict(usage_hourly=3, usage_daily=1) == rebuild_rollups(session, datetime(2019, 10, 1, 12), datetime(2019, 10, 1, 13))
+    assert [] == check_rollups(session)
+
+
+def test_resent_usage_is_not_rescanned(monkeypatch):
+    from api import ingest
+    from api.rollup import check_rollups
+    from db.handler import init_db
+
+    def rescan(session, rows):
+        raise AssertionError('raw usage rescanned')
+
+    session = init_db('sqlite://', persist=False)
+    usages = [dict(r='resent', u='user', start='2019-10-01T{0:02d}:00:00Z'.format(h), end='2019-10-01T{0:02d}:30:00Z'.format(h),
+                   cpu=h) for h in range(10, 14)]
+    assert (2, 0, 0) == ingest.ingest_usages(usages[:2])
+    monkeypatch.setattr(ingest, 'refresh_rollups', rescan)
+    # stored rows and rows repeated within the batch are skipped, only the new ones are added to the rollups
+    assert (2, 0, 3) == ingest.ingest_usages(usages + usages[3:])
+    assert [] == check_rollups(session)
+
+def test_rollup_watermarks_of_upgraded_database():
+    from api.ingest import ingest_usages
+    from api.rollup import rebuild_rollups, seed_watermarks, watermarks
+    from api.summary import rollup_for
+    from db.handler import init_db
+    from db.resource import DailyUsage, HourlyUsage
+
+    session = init_db('sqlite://', persist=False)
+    seed_watermarks(session)
+    assert dict(usage_hourly=None, usage_daily=None) == watermarks(session)
+
+    # a database holding usage before it had rollups
+    session = init_db('sqlite://', persist=False)
+    usages = [dict(r='upgraded', u='user', start='2019-10-01T10:00:00Z', end='2019-10-01T11:00:00Z', cpu=1)]
+    assert (1, 0, 0) == ingest_usages(usages)
+    session.query(HourlyUsage).delete()
+    session.query(DailyUsage).delete()
+    session.commit()
+    seed_watermarks(session)
+    mark = datetime(2019, 10, 2)
+    assert dict(usage_hourly=mark, usage_daily=mark) == watermarks(session)
+    # summaries of earlier usage are answered from the raw usage
+    assert rollup_for([], None, None, None, []) is None
+    assert rollup_for([], None, datetime(2019, 10, 1), None, []) is None
+    assert DailyUsage is rollup_for([], None, mark, None, [])
+    rebuild_rollups(session, datetime(2019, 10, 1), datetime(2019, 10, 2))
+    assert dict(usage_hourly=datetime(2019, 10, 1), usage_daily=datetime(2019, 10, 1)) == watermarks(session)
+    rebuild_rollups(session)
+    assert dict(usage_hourly=None, usage_daily=None) == watermarks(session)
+    assert DailyUsage is rollup_for([], None, None, None, [])
+
+def test_rollups_are_upserted():
+    from api.rollup import aggregate, apply_totals
+    from db.handler import init_db
+    from db.resource import HourlyUsage
+
+    session = init_db('sqlite://', persist=False)
+    rows = [dict(resource='upserted', user='user', start=datetime(2019, 10, 1, h), cpu=1, gpu=None, mem=None, disk=None)
+            for h in (10, 11)]
+    # a bucket inserted by another worker in the meantime is incremented, not inserted twice
+    session.add(HourlyUsage(resource='upserted', user='user', bucket=datetime(2019, 10, 1, 10), count=1, cpu=2))
+    session.flush()
+    apply_totals(session, HourlyUsage, aggregate(rows, 'hour'))
+    session.commit()
+    hourly = session.query(HourlyUsage).order_by(HourlyUsage.bucket).all()
+    assert [(2, 3), (1, 1)] == [(h.count, int(h.cpu)) for h in hourly]
+    assert [None, None] == [h.gpu for h in hourly]
+
+def test_migrate_metrics_to_integer(tmp_path):
+    from sqlalchemy import text
+    from api.ingest import ingest_usages
+    from db.handler import init_db
+    from db.resource import DailyUsage, Metric, ResourceUsage, migrate_metrics
+
+    uri = 'sqlite:///{0}'.format(tmp_path / 'usage.db')
+    session = init_db(uri)
+    usages = [dict(r='migrated', u='user', start='2019-10-01T10:00:00Z', end='2019-10-01T11:00:00Z', cpu=1.5, mem=0.25),
+              dict(r='migrated', u='user', start='2019-10-01T12:00:00Z', end='2019-10-01T13:00:00Z', cpu=2)]
+    assert (2, 0, 0) == ingest_usages(usages)
+    assert ['resource_usage', 'usage_hourly', 'usage_daily'] == migrate_metrics(session, 'numeric', 'integer')
+    session.remove()
+    try:
+        Metric.storage = 'integer'
+        session = init_db(uri)
+        assert [5400000, 7200000] == [r[0] for r in session.execute(text('SELECT cpu FROM resource_usage ORDER BY id'))]
+        assert [1.5, 2.0] == [u.cpu for u in session.query(ResourceUsage).order_by(ResourceUsage.id)]
+        assert 0.25 == session.query(ResourceUsage.mem).filter(ResourceUsage.cpu == 1.5).scalar()
+        assert (2, 0, 1) == ingest_usages([dict(u, record='second') for u in usages] + usages[:1])
+        assert (4, 7.0) == session.query(DailyUsage.count, DailyUsage.cpu).one()
+    finally:
+        session.remove()
+        Metric.storage = 'numeric'
+        init_db('sqlite://')
+
+
+def test_ingest_queue_spools_and_recovers(tmp_path):
+    import os
+    import time
+    from api.ingest import IngestQueue, QueueFull
+    from db.handler import init_db
+    from db.resource import ResourceUsage
+
+    def written(ingest_queue, bid):
+        for _ in range(100):
+            if (ingest_queue.status(bid) or {}).get('status') == 'done':
+                break
+            time.sleep(0.05)
+        return dict((k, v) for k, v in ingest_queue.status(bid).items()
+                    if k in ('status', 'accepted', 'rejected', 'duplicates'))
+
+    session = init_db('sqlite:///{0}'.format(tmp_path / 'queue.db'))
+    spool = str(tmp_path / 'spool')
+    usages = [dict(r='queued', u='user', start='2019-10-01T10:00:00Z', end='2019-10-01T11:00:00Z', cpu=1),
+              dict(r='queued', u='user', start='2019-10-01T10:00:00Z')]
+    try:
+        # not started, the batch stays in the spool directory of the queue
+        stopped = IngestQueue(size=1, spool=spool)
+        first = stopped.submit(usages, 'collector')
+        assert 'queued' == stopped.status(first)['status']
+        with pytest.raises(QueueFull):
+            stopped.submit(usages)
+        assert '{0}.json'.format(first) in os.listdir(stopped.directory)
+
+        # the directory of a live queue is not taken over
+        ingest_queue = IngestQueue(size=2, spool=spool)
+        ingest_queue.start()
+        second = ingest_queue.submit(usages, 'collector')
+        assert dict(status='done', accepted=1, rejected=1, duplicates=0) == written(ingest_queue, second)
+        ingest_queue.stop(5)
+        # the status is shared, another queue sees the batch waiting
+        assert 'queued' == ingest_queue.status(first)['status']
+        assert '{0}.json'.format(first) in os.listdir(stopped.directory)
+
+        # once its process ends
+        stopped.stop()
+        ingest_queue = IngestQueue(size=2, spool=spool)
+        ingest_queue.start()
+        assert dict(status='done', accepted=0, rejected=1, duplicates=1) == written(ingest_queue, first)
+        # the submitter can still see it
+        assert 'collector' == ingest_queue.status(first)['subject']
+        ingest_queue.stop(5)
+        assert not os.path.exists(stopped.directory)
+        assert ['lock'] == os.listdir(ingest_queue.directory)
+        assert 1 == session.query(ResourceUsage).filter(ResourceUsage.resource == 'queued').count()
+    finally:
+        session.remove()
+        init_db('sqlite://')
+
+
+def test_ingest_queue_keeps_failed_batches(tmp_path, monkeypatch):
+    import os
+    import shutil
+    import time
+    from api import ingest
+    from db.handler import init_db
+
+    session = init_db('sqlite:///{0}'.format(tmp_path / 'queue.db'))
+    spool = str(tmp_path / 'spool')
+    usages = [dict(r='failing', u='user', start='2019-10-01T10:00:00Z', end='2019-10-01T11:00:00Z', cpu=1)]
+
+    def broken(usages):
+        raise RuntimeError('database gone')
+
+    try:
+        monkeypatch.setattr(ingest, 'insert_batch', broken)
+        ingest_queue = ingest.IngestQueue(size=2, spool=spool)
+        ingest_queue.start()
+        bid = ingest_queue.submit(usages, 'collector')
+        for _ in range(100):
+            if ingest_queue.status(bid)['status'] == 'failed':
+                break
+            time.sleep(0.05)
+        ingest_queue.stop(5)
+        assert 'failed' == ingest_queue.status(bid)['status']
+        assert ['{0}.json'.format(bid)] == os.listdir(os.path.join(spool, 'failed'))
+        assert ['lock'] == os.listdir(ingest_queue.directory)
+
+        # moved back into the spool it is retried
+        monkeypatch.undo()
+        shutil.move(os.path.join(spool, 'failed', '{0}.json'.format(bid)), spool)
+        ingest_queue = ingest.IngestQueue(size=2, spool=spool)
+        ingest_queue.start()
+        ingest_queue.stop(5)
+        assert 'done' == ingest_queue.status(bid)['status']
+        assert 'collector' == ingest_queue.status(bid)['subject']
+        assert [] == os.listdir(os.path.join(spool, 'failed'))
+    finally:
+        session.remove()
+        init_db('sqlite://')
+
+
+def test_ingest_queue_shares_batch_status(tmp_path):
+    import time
+    from api.ingest import IngestQueue
+    from db.handler import init_db
+
+    session = init_db('sqlite:///{0}'.format(tmp_path / 'queue.db'))
+    usages = [dict(r='shared', u='user', start='2019-10-01T10:00:00Z', end='2019-10-01T11:00:00Z', cpu=1)]
+    try:
+        accepting = IngestQueue(size=2, spool=str(tmp_path / 'spool'))
+        # the queue of another worker
+        other = IngestQueue(size=2)
+        accepting.start()
+        bid = accepting.submit(usages, 'collector')
+        for _ in range(100):
+            if other.status(bid)['status'] == 'done':
+                break
+            time.sleep(0.05)
+        accepting.stop(5)
+        batch = other.status(bid)
+        assert dict(id=bid, status='done', subject='collector', records=1, accepted=1, rejected=0, duplicates=0) == \
+            dict((k, batch[k]) for k in ('id', 'status', 'subject', 'records', 'accepted', 'rejected', 'duplicates'))
+        assert other.status('unknown') is None
+
+        # the status of the oldest finished batches is removed
+        accepting = IngestQueue(size=2, history=1)
+        accepting.start()
+        last = accepting.submit(usages, 'collector')
+        accepting.stop(5)
+        assert other.status(bid) is None
+        assert 'done' == other.status(last)['status']
+    finally:
+        session.remove()
+        init_db('sqlite://')
+
+
+def test_add_usage_key_to_existing_tables(tmp_path):
+    from sqlalchemy import text
+    from api.ingest import ingest_usages
+    from db.handler import init_db
+    from db.resource import add_usage_key
+
+    session = init_db('sqlite:///{0}'.format(tmp_path / 'legacy.db'))
+    try:
+        session.execute(text('DROP TABLE resource_usage'))
+        session.execute(text('CREATE TABLE resource_usage (id INTEGER PRIMARY KEY, resource VARCHAR(100), '
+                             'user VARCHAR(255), start DATETIME, "end" DATETIME, cpu NUMERIC, gpu NUMERIC, '
+                             'mem NUMERIC, disk NUMERIC)'))
+        session.execute(text('CREATE INDEX ix_resource_usage_resource_user_start ON resource_usage (resource, user, start)'))
+        for _ in range(3):
+            session.execute(text("INSERT INTO resource_usage (resource, user, start, \"end\", cpu) VALUES "
+                                 "('legacy', 'user', '2019-10-01 10:00:00.000000', '2019-10-01 11:00:00.000000', 1)"))
+        session.commit()
+
+        assert dict(resource_usage=2) == add_usage_key(session)
+        assert dict(resource_usage=0) == add_usage_key(session)
+        indexes = [r[1] for r in session.execute(text('PRAGMA index_list(resource_usage)'))]
+        assert 'ux_resource_usage_key' in indexes
+        assert 'ix_resource_usage_resource_user_start' not in indexes
+        assert (0, 0, 1) == ingest_usages([dict(r='legacy', u='user', start='2019-10-01T10:00:00Z',
+                                                end='2019-10-01T11:00:00Z', cpu=1)])
+        assert [(1, '')] == [tuple(r) for r in session.execute(text('SELECT id, record FROM resource_usage'))]
+    finally:
+        session.remove()
+        init_db('sqlite://')
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2019, Pim Witlox. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+import time
+
+import pytest
+from flask import json
+
+from config import Config
+from app import application
+from tests import access, secret, encoded_secret, generate_token_headers
+
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    path = tmp_path_factory.mktemp('ingest')
+    config = Config(create=False)
+    config.update('admin', 'access', access)
+    config.update('admin', 'secret', secret)
+    config.update('database', 'connection', 'sqlite:///{0}'.format(path / 'usage.db'))
+    config.update('ingest', 'async', 'True')
+    config.update('ingest', 'queue_size', '1')
+    config.update('ingest', 'spool', str(path / 'spool'))
+    ars = application(config)
+    with ars.app.test_client() as c:
+        yield c
+    from api.ingest import init_queue
+    config.update('ingest', 'async', 'False')
+    init_queue(config.ingest())
+
+
+def test_queue_usage_batch(client):
+    from api import ingest
+
+    lg = client.post("/api/v1/login?username={0}&password={1}".format(access, encoded_secret))
+    assert 200 == lg.status_code
+    token = json.loads(lg.data)
+
+    usages = [dict(r='test_queued_resource', u='test_queued_user', start='2019-10-01T10:00:00Z', end='2019-10-01T11:00:00Z', cpu=1)]
+    lg = client.post('/api/v1/usage', json=usages, headers=generate_token_headers(dict(), token))
+    assert 202 == lg.status_code
+    batch = json.loads(lg.data)
+    assert 'queued' == batch['status']
+    for _ in range(100):
+        lg = client.get('/api/v1/usage/batches/{0}'.format(batch['id']), headers=generate_token_headers(dict(), token))
+        assert 200 == lg.status_code
+        if json.loads(lg.data)['status'] == 'done':
+            break
+        time.sleep(0.05)
+    assert 1 == json.loads(lg.data)['accepted']
+    lg = client.get('/api/v1/usage/batches/unknown', headers=generate_token_headers(dict(), token))
+    assert 404 == lg.status_code
+
+    # stop the writer so the queue fills up
+    ingest.ingest_queue.stop(5)
+    lg = client.post('/api/v1/usage', json=usages, headers=generate_token_headers(dict(), token))
+    assert 202 == lg.status_code
+    lg = client.post('/api/v1/usage', json=usages, headers=generate_token_headers(dict(), token))
+    assert 429 == lg.status_code
+    assert '1' == lg.headers['Retry-After']
+
+    lg = client.post('/api/v1/logout', headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
@@ -104,6 +104,306 @@ def test_add_resource_usage(client):
 
     lg = client.post('/api/v1/usage', json=usages, headers=generate_token_headers(dict(), token))
     assert 201 == lg.status_code
+    assert dict(accepted=2, rejected=0, duplicates=0) == json.loads(lg.data)
 
+    usages = [dict(r=resource, u=user, start='2019-10-01T10:00:00Z', end='2019-10-01T11:00:00Z', cpu=1),
+              dict(r=resource, u=user, start='2019-10-01T10:00:00Z', end='2019-10-01T09:00:00Z', cpu=1),
+              dict(r=resource, u=user, start='not a timestamp', end='2019-10-01T09:00:00Z', cpu=1)]
+    lg = client.post('/api/v1/usage', json=usages, headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+    assert dict(accepted=1, rejected=2, duplicates=0) == json.loads(lg.data)
+
+    usages[0]['record'] = 'retried'
+    lg = client.post('/api/v1/usage', json=usages[:1] * 2, headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+    assert dict(accepted=1, rejected=0, duplicates=1) == json.loads(lg.data)
+
+    lg = client.post('/api/v1/logout', headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+
+
+def test_get_resource_usage_in_range(client):
+    lg = client.post("/api/v1/login?username={0}&password={1}".format(access, encoded_secret))
+    assert 200 == lg.status_code
+    token = json.loads(lg.data)
+
+    resource = 'test_resource_3'
+    user = 'test_resource_user_3'
+    lg = client.post("/api/v1/resources?name={0}".format(resource), headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+    lg = client.post('/api/v1/users', json={'dom_name': user, 'full_name': 'test pi'}, headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+
+    usages = [dict(r=resource, u=user, start='2019-10-0{0}T10:00:00Z'.format(d), end='2019-10-0{0}T11:00:00Z'.format(d), cpu=d)
+              for d in range(1, 6)]
+    lg = client.post('/api/v1/usage', json=usages, headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+
+    lg = client.get('/api/v1/usage?r={0}&u={1}'.format(resource, user), headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+    assert 5 == len(json.loads(lg.data))
+    lg = client.get('/api/v1/usage?r={0}&u={1}&start=2019-10-02T00:00:00Z&end=2019-10-04T12:00:00Z'.format(resource, user),
+                    headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+    assert [2, 3, 4] == [float(u['cpu']) for u in json.loads(lg.data)]
+    lg = client.get('/api/v1/usage?r={0}&u=test_unknown_user'.format(resource), headers=generate_token_headers(dict(), token))
+    assert 404 == lg.status_code
+
+    lg = client.post('/api/v1/logout', headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+
+
+def test_get_usage_summary(client):
+    lg = client.post("/api/v1/login?username={0}&password={1}".format(access, encoded_secret))
+    assert 200 == lg.status_code
+    token = json.loads(lg.data)
+
+    resource = 'test_resource_4'
+    users = ['test_resource_user_4', 'test_resource_user_5']
+    group_name = 'test_resource_group_4'
+    lg = client.post("/api/v1/resources?name={0}".format(resource), headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+    rid = json.loads(lg.data)['id']
+    for user in users:
+        lg = client.post('/api/v1/users', json={'dom_name': user, 'full_name': 'test pi'}, headers=generate_token_headers(dict(), token))
+        assert 201 == lg.status_code
+    lg = client.post('/api/v1/groups', json={'name': group_name, 'dom_name': users[0], 'active': True}, headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+    lg = client.put("/api/v1/groups/{0}?u={1}&admin=False".format(json.loads(lg.data)['id'], users[1]), headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+    lg = client.put("/api/v1/resource/{0}?name={1}".format(rid, group_name), headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+
+    usages = [dict(r=resource, u=users[d % 2], start='2019-10-0{0}T10:00:00Z'.format(d), end='2019-10-0{0}T11:00:00Z'.format(d), cpu=d)
+              for d in range(1, 6)]
+    lg = client.post('/api/v1/usage', json=usages, headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+
+    lg = client.get('/api/v1/usage/summary?r={0}&group_by=user&percentiles=50,100'.format(resource),
+                    headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+    summaries = json.loads(lg.data)
+    assert [users[0], users[1]] == [s['user'] for s in summaries]
+    assert [2, 3] == [s['count'] for s in summaries]
+    assert [6.0, 9.0] == [s['cpu'] for s in summaries]
+    assert {'50': 3.0, '100': 4.0} == summaries[0]['percentiles']['cpu']
+
+    lg = client.get('/api/v1/usage/summary?r={0}&bucket=day&start=2019-10-02T00:00:00Z'.format(resource),
+                    headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+    summaries = json.loads(lg.data)
+    assert ['2019-10-0{0}T00:00:00'.format(d) for d in range(2, 6)] == [s['bucket'] for s in summaries]
+
+    # only the second user is a member of the group
+    lg = client.get('/api/v1/usage/summary?r={0}&group_by=group'.format(resource), headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+    assert [dict(group=group_name, count=3, cpu=9.0, gpu=None, mem=None, disk=None)] == json.loads(lg.data)
+
+    lg = client.get('/api/v1/usage/summary?r=test_unknown_resource', headers=generate_token_headers(dict(), token))
+    assert 404 == lg.status_code
+
+    lg = client.post('/api/v1/logout', headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+
+
+def test_export_resource_usage(client):
+    import io
+    from api.export import read_columnar
+
+    lg = client.post("/api/v1/login?username={0}&password={1}".format(access, encoded_secret))
+    assert 200 == lg.status_code
+    token = json.loads(lg.data)
+
+    resource = 'test_resource_5'
+    user = 'test_resource_user_6'
+    lg = client.post("/api/v1/resources?name={0}".format(resource), headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+    lg = client.post('/api/v1/users', json={'dom_name': user, 'full_name': 'test pi'}, headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+    usages = [dict(r=resource, u=user, start='2019-10-0{0}T10:00:00Z'.format(d), end='2019-10-0{0}T11:00:00Z'.format(d), cpu=d)
+              for d in range(1, 4)]
+    lg = client.post('/api/v1/usage', json=usages, headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+
+    lg = client.get('/api/v1/usage/export?r={0}'.format(resource), headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+    assert lg.mimetype == 'text/csv'
+    lines = lg.data.decode('utf-8').splitlines()
+    assert 'resource,user,start,end,cpu,gpu,mem,disk' == lines[0]
+    assert '{0},{1},2019-10-01T10:00:00,2019-10-01T11:00:00,1.0,,,'.format(resource, user) == lines[1]
+    assert 4 == len(lines)
+
+    lg = client.get('/api/v1/usage/export?r={0}&format=jsonl&start=2019-10-02T00:00:00Z'.format(resource),
+                    headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+    assert [2.0, 3.0] == [json.loads(line)['cpu'] for line in lg.data.decode('utf-8').splitlines()]
+
+    lg = client.get('/api/v1/usage/export?r={0}&format=columnar'.format(resource), headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+    rows = list(read_columnar(io.BytesIO(lg.data)))
+    assert [1.0, 2.0, 3.0] == [row['cpu'] for row in rows]
+    assert datetime(2019, 10, 3, 11) == rows[-1]['end']
+    assert rows[0]['gpu'] is None
+
+    lg = client.post('/api/v1/logout', headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+
+
+def test_add_compressed_and_streamed_resource_usage(client):
+    import gzip
+
+    lg = client.post("/api/v1/login?username={0}&password={1}".format(access, encoded_secret))
+    assert 200 == lg.status_code
+    token = json.loads(lg.data)
+    headers = generate_token_headers(dict(), token)
+
+    resource = 'test_resource_7'
+    lg = client.post("/api/v1/resources?name={0}".format(resource), headers=headers)
+    assert 201 == lg.status_code
+
+    usages = [dict(r=resource, u='test_user', start='2019-10-01T{0:02d}:00:00Z'.format(h),
+                   end='2019-10-01T{0:02d}:30:00Z'.format(h), cpu=h) for h in range(10)]
+    body = gzip.compress(json.dumps(usages[:5]).encode('utf-8'))
+    lg = client.post('/api/v1/usage', data=body, content_type='application/json',
+                     headers=dict(headers, **{'Content-Encoding': 'gzip'}))
+    assert 201 == lg.status_code
+    assert dict(accepted=5, rejected=0, duplicates=0) == json.loads(lg.data)
+
+    lines = [json.dumps(u) for u in usages[4:]] + ['', 'not json', json.dumps(dict(r=resource))]
+    body = gzip.compress('\n'.join(lines).encode('utf-8'))
+    lg = client.post('/api/v1/usage/stream', data=body, content_type='application/x-ndjson',
+                     headers=dict(headers, **{'Content-Encoding': 'gzip'}))
+    assert 201 == lg.status_code
+    assert dict(accepted=5, rejected=2, duplicates=1) == json.loads(lg.data)
+
+    lg = client.post('/api/v1/usage/stream', data=b'\x1f\x8b not gzip', content_type='application/x-ndjson',
+                     headers=dict(headers, **{'Content-Encoding': 'gzip'}))
+    assert 400 == lg.status_code
+    lg = client.post('/api/v1/usage', data=b'[]', content_type='application/json',
+                     headers=dict(headers, **{'Content-Encoding': 'compress'}))
+    assert 415 == lg.status_code
+
+    lg = client.get('/api/v1/usage?r={0}'.format(resource), headers=headers)
+    assert 200 == lg.status_code
+    assert list(range(10)) == [int(u['cpu']) for u in json.loads(lg.data)]
+
+    lg = client.post('/api/v1/logout', headers=headers)
+    assert 200 == lg.status_code
+
+
+
+def test_decompress_concatenated_members():
+    import gzip
+    import io
+    import zlib
+    from werkzeug.exceptions import BadRequest
+    from api.streaming import DecompressingStream
+
+    body = gzip.compress(b'first\n') + gzip.compress(b'second\n')
+    assert b'first\nsecond\n' == DecompressingStream(io.BytesIO(body), 'gzip').read()
+    # bodies of many chunks, read whole, by size and by line
+    lines = [json.dumps(dict(line=i)).encode('utf-8') + b'\n' for i in range(20000)]
+    body = gzip.compress(b''.join(lines))
+    assert b''.join(lines) == DecompressingStream(io.BytesIO(body), 'gzip').read()
+    stream = DecompressingStream(io.BytesIO(body), 'gzip')
+    assert lines[0] + lines[1][:5] == stream.read(len(lines[0]) + 5)
+    assert [lines[1][5:]] + lines[2:] == list(stream)
+    # deflate has no members, data after the end of the stream is an error
+    body = zlib.compress(b'first\n') + zlib.compress(b'second\n')
+    with pytest.raises(BadRequest):
+        DecompressingStream(io.BytesIO(body), 'deflate').read()
+
+
+def test_decompress_concatenated_zstd_frames():
+    zstandard = pytest.importorskip('zstandard')
+    import io
+    from api.streaming import DecompressingStream
+
+    compressor = zstandard.ZstdCompressor()
+    body = compressor.compress(b'first\n') + compressor.compress(b'second\n')
+    assert b'first\nsecond\n' == DecompressingStream(io.BytesIO(body), 'zstd').read()
+
+def test_add_msgpack_resource_usage(client):
+    msgpack = pytest.importorskip('msgpack')
+
+    lg = client.post("/api/v1/login?username={0}&password={1}".format(access, encoded_secret))
+    assert 200 == lg.status_code
+    token = json.loads(lg.data)
+    headers = generate_token_headers(dict(), token)
+
+    usages = [dict(r='test_resource_8', u='test_user', start='2019-10-01T{0:02d}:00:00Z'.format(h),
+                   end='2019-10-01T{0:02d}:30:00Z'.format(h), cpu=h) for h in range(4)]
+    body = msgpack.packb(usages[:2]) + b''.join(msgpack.packb(u) for u in usages[2:])
+    lg = client.post('/api/v1/usage/stream', data=body, content_type='application/msgpack', headers=headers)
+    assert 201 == lg.status_code
+    assert dict(accepted=4, rejected=0, duplicates=0) == json.loads(lg.data)
+
+    lg = client.post('/api/v1/logout', headers=headers)
+    assert 200 == lg.status_code
+
+
+def test_conditional_and_compressed_responses(client):
+    import gzip
+
+    lg = client.post("/api/v1/login?username={0}&password={1}".format(access, encoded_secret))
+    assert 200 == lg.status_code
+    token = json.loads(lg.data)
+    headers = generate_token_headers(dict(), token)
+
+    lg = client.get('/api/v1/resources', headers=headers)
+    assert 200 == lg.status_code
+    tag = lg.headers['ETag']
+    resources = json.loads(lg.data)
+    lg = client.get('/api/v1/resources', headers=dict(headers, **{'If-None-Match': tag}))
+    assert 304 == lg.status_code
+    assert tag == lg.headers['ETag']
+    assert b'' == lg.data
+    lg = client.get('/api/v1/resources?limit=1', headers=dict(headers, **{'If-None-Match': tag}))
+    assert 200 == lg.status_code
+
+    # small responses are not compressed
+    lg = client.get('/api/v1/resources?limit=1', headers=dict(headers, **{'Accept-Encoding': 'gzip'}))
+    assert 200 == lg.status_code
+    assert 'Content-Encoding' not in lg.headers
+
+    for i in range(20):
+        lg = client.post("/api/v1/resources?name=test_resource_9_{0}".format(i), headers=headers)
+        assert 201 == lg.status_code
+    lg = client.get('/api/v1/resources', headers=dict(headers, **{'If-None-Match': tag, 'Accept-Encoding': 'gzip'}))
+    assert 200 == lg.status_code
+    assert tag != lg.headers['ETag']
+    assert 'gzip' == lg.headers['Content-Encoding']
+    assert 'Accept-Encoding' in lg.headers['Vary']
+    assert len(resources) + 20 == len(json.loads(gzip.decompress(lg.data)))
+
+    lg = client.get('/api/v1/resources?stream=true', headers=dict(headers, **{'Accept-Encoding': 'gzip'}))
+    assert 200 == lg.status_code
+    assert 'gzip' == lg.headers['Content-Encoding']
+    assert len(resources) + 20 == len(gzip.decompress(lg.data).splitlines())
+
+    lg = client.post('/api/v1/logout', headers=headers)
+    assert 200 == lg.status_code
+
+
+def test_conditional_checks_authorization_first(client, monkeypatch):
+    import api.etag
+
+    lg = client.post("/api/v1/login?username={0}&password={1}".format(access, encoded_secret))
+    assert 200 == lg.status_code
+    token = json.loads(lg.data)
+    lg = client.post('/api/v1/services?name=test_etag_service', headers=generate_token_headers(dict(), token))
+    assert 201 == lg.status_code
+    service = json.loads(lg.data)
+    lg = client.post('/api/v1/logout', headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+
+    # a service is no admin, a tag it guessed right must not tell it whether the data changed
+    lg = client.post("/api/v1/login?username={0}&password={1}".format(service['access'], service['secret']))
+    assert 200 == lg.status_code
+    token = json.loads(lg.data)
+    monkeypatch.setattr(api.etag, 'current_etag', lambda tables: 'guessed')
+    for path in ('/api/v1/resources', '/api/v1/users', '/api/v1/groups', '/api/v1/usage?r=test_resource'):
+        lg = client.get(path, headers=generate_token_headers({'If-None-Match': 'W/"guessed"'}, token))
+        assert 401 == lg.status_code
     lg = client.post('/api/v1/logout', headers=generate_token_headers(dict(), token))
     assert 200 == lg.status_code
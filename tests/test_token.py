@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2019, Pim Witlox. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+from time import sleep, time
+
+import pytest
+
+from config import Config
+from app import application
+from tests import access, secret
+
+
+@pytest.fixture(scope='module', autouse=True)
+def client():
+    config = Config(create=False)
+    config.update('admin', 'access', access)
+    config.update('admin', 'secret', secret)
+    config.update('database', 'connection', 'sqlite://')
+    ars = application(config)
+    with ars.app.test_client() as c:
+        yield c
+
+
+def test_multiple_tokens_per_subject():
+    from api.token import MemoryTokenStore
+
+    store = MemoryTokenStore()
+    store.add('test_service', 'token_1')
+    store.add('test_service', 'token_2')
+    assert 'test_service' == store.subject('token_1')
+    assert 'test_service' == store.subject('token_2')
+    assert {'token_1', 'token_2'} == store.tokens('test_service')
+    assert 'test_service' == store.remove('token_1')
+    assert 'token_1' not in store
+    assert 'token_2' in store
+    assert 1 == store.remove_subject('test_service')
+    assert 0 == len(store)
+
+
+def test_incomplete_store_cannot_be_created():
+    from api.token import TokenStore
+
+    class PartialTokenStore(TokenStore):
+        def subject(self, token):
+            return None
+
+    with pytest.raises(TypeError):
+        PartialTokenStore()
+
+
+def test_expired_tokens_are_purged_in_bulk():
+    from api.token import MemoryTokenStore
+
+    store = MemoryTokenStore()
+    now = int(time())
+    for i in range(10):
+        store.add('test_user_{0}'.format(i), 'expired_{0}'.format(i), expires=now + 10 + i)
+    store.add('test_user_live', 'live', expires=now + 1000)
+    assert 10 == store.purge(now=now + 500)
+    assert 1 == len(store)
+    assert set() == store.tokens('test_user_0')
+    assert 'test_user_live' == store.subject('live')
+
+
+def test_readded_token_uses_latest_expiry():
+    from api.token import MemoryTokenStore
+
+    store = MemoryTokenStore()
+    now = int(time())
+    store.add('test_user', 'token', expires=now + 100)
+    store.remove('token')
+    store.add('test_user', 'token', expires=now + 1000)
+    assert 0 == store.purge(now=now + 500)
+    assert {'token'} == store.tokens('test_user')
+
+
+def test_database_store_shared_between_instances(tmpdir):
+    from sqlalchemy import create_engine
+    from api.token import DatabaseTokenStore
+
+    engine = create_engine('sqlite:///{0}'.format(tmpdir.join('tokens.db')))
+    store = DatabaseTokenStore(engine)
+    other = DatabaseTokenStore(engine)
+    now = int(time())
+    store.add('test_service', 'token_1')
+    store.add('test_service', 'token_2')
+    store.add('test_user', 'expired', expires=now + 10)
+    assert 'test_service' == other.subject('token_1')
+    assert {'token_1', 'token_2'} == other.tokens('test_service')
+    assert 1 == other.purge(now=now + 500)
+    assert 'expired' not in store
+    assert 'test_service' == other.remove('token_1')
+    assert 'token_1' not in store
+    assert 1 == store.remove_subject('test_service')
+    assert 0 == len(store)
+
+
+def test_socket_store_shared_between_instances(tmpdir):
+    from api.token import SocketTokenStore
+
+    address = str(tmpdir.join('tokens.sock'))
+    store = SocketTokenStore(address, b'secret')
+    store.add('test_service', 'token_1')
+    other = SocketTokenStore(address, b'secret')
+    assert 'test_service' == other.subject('token_1')
+    assert 'token_1' in other
+    other.remove('token_1')
+    assert store.subject('token_1') is None
+
+
+def test_socket_store_served_by_one_worker(tmpdir, monkeypatch):
+    import socket
+    import threading
+    from api.token import SocketTokenStore
+
+    address = str(tmpdir.join('tokens.sock'))
+    # left by a worker that ended
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(address)
+    stale.close()
+
+    served = []
+    serve = SocketTokenStore._serve
+
+    def slow_serve(self):
+        # workers starting together all find no server while the first one binds
+        served.append(self)
+        sleep(0.2)
+        serve(self)
+
+    monkeypatch.setattr(SocketTokenStore, '_serve', slow_serve)
+    stores = [SocketTokenStore(address, b'secret') for _ in range(4)]
+    threads = [threading.Thread(target=store.add, args=('test_service', 'token_{0}'.format(i)))
+               for i, store in enumerate(stores)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert 1 == len(served)
+    assert {'token_0', 'token_1', 'token_2', 'token_3'} == stores[0].tokens('test_service')
+
+def test_claims_cache_is_bounded_and_expires():
+    from api.token import ClaimsCache
+
+    cache = ClaimsCache(2)
+    now = int(time())
+    cache.put('token_1', dict(sub='test_user_1', exp=now + 100))
+    cache.put('token_2', dict(sub='test_user_2', exp=now + 100))
+    assert 'test_user_1' == cache.get('token_1')['sub']
+    cache.put('token_3', dict(sub='test_user_3', exp=now + 100))
+    assert cache.get('token_2') is None
+    assert 'test_user_1' == cache.get('token_1')['sub']
+    assert cache.get('token_3', now=now + 200) is None
+    assert 1 == len(cache)
+
+
+def test_stateless_token_validation(client):
+    import api.auth
+
+    api.auth.config.update('token', 'stateless', 'True')
+    try:
+        with client.application.test_request_context():
+            token = api.auth.issue_token('test_service', 42, 'service')
+            assert token not in api.auth.tokens
+            assert dict(sub='test_service', uid=42) == api.auth.user_by_token(token)
+            assert api.auth.claims_cache.get(token) is not None
+            assert 42 == api.auth.validate(token)
+    finally:
+        api.auth.config.update('token', 'stateless', 'False')
+
+
+def test_socket_store_needs_a_secret(tmpdir):
+    from api.token import SocketTokenStore, create_store
+    from config import Section
+
+    token_config = Section('token', dict(lifetime=3600, store='socket', socket=str(tmpdir.join('tokens.sock'))))
+    with pytest.raises(ValueError):
+        create_store(token_config, secret='')
+    store = create_store(token_config, secret='secret')
+    assert isinstance(store, SocketTokenStore)
+    assert store.authkey != create_store(token_config, secret='other').authkey
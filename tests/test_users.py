@@ -71,3 +71,122 @@ def test_add_list_remove_user(client):
 
     lg = client.post('/api/v1/logout', headers=generate_token_headers(dict(), token))
     assert 200 == lg.status_code
+
+
+def test_list_users_query_count_is_constant(client):
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    lg = client.post("/api/v1/login?username={0}&password={1}".format(access, encoded_secret))
+    assert 200 == lg.status_code
+    token = json.loads(lg.data)
+
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    def list_users():
+        del statements[:]
+        event.listen(Engine, 'before_cursor_execute', count)
+        try:
+            lg = client.get('/api/v1/users', headers=generate_token_headers(dict(), token))
+        finally:
+            event.remove(Engine, 'before_cursor_execute', count)
+        assert 200 == lg.status_code
+        return json.loads(lg.data), len(statements)
+
+    users, queries = list_users()
+    for i in range(5):
+        lg = client.post('/api/v1/users', json={'dom_name': 'test_user_n{0}'.format(i), 'full_name': 'test user'}, headers=generate_token_headers(dict(), token))
+        assert 201 == lg.status_code
+        lg = client.post('/api/v1/groups', json={'name': 'test_group_n{0}'.format(i), 'dom_name': 'test_user_n{0}'.format(i), 'active': True}, headers=generate_token_headers(dict(), token))
+        assert 201 == lg.status_code
+        group = json.loads(lg.data)
+        for j in range(i + 1):
+            lg = client.put("/api/v1/groups/{0}?u=test_user_n{1}&admin=False".format(group['id'], j), headers=generate_token_headers(dict(), token))
+            assert 201 == lg.status_code
+    more_users, more_queries = list_users()
+    assert len(more_users) == len(users) + 5
+    assert queries == more_queries
+    assert 5 == len([u for u in more_users if u['dom_name'] == 'test_user_n0'][0]['groups'])
+
+    lg = client.post('/api/v1/logout', headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+
+
+def test_paginate_and_stream_users(client):
+    lg = client.post("/api/v1/login?username={0}&password={1}".format(access, encoded_secret))
+    assert 200 == lg.status_code
+    token = json.loads(lg.data)
+
+    for i in range(5):
+        lg = client.post('/api/v1/users', json={'dom_name': 'test_user_p{0}'.format(i), 'full_name': 'test user'}, headers=generate_token_headers(dict(), token))
+        assert 201 == lg.status_code
+    lg = client.get('/api/v1/users', headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+    users = json.loads(lg.data)
+
+    paged = []
+    lg = client.get('/api/v1/users?limit=2', headers=generate_token_headers(dict(), token))
+    while True:
+        assert 200 == lg.status_code
+        page = json.loads(lg.data)
+        assert len(page) <= 2
+        paged.extend(page)
+        if 'X-Next-After' not in lg.headers:
+            break
+        lg = client.get('/api/v1/users?limit=2&after={0}'.format(lg.headers['X-Next-After']), headers=generate_token_headers(dict(), token))
+    assert users == paged
+
+    lg = client.get('/api/v1/users?stream=true', headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+    assert 'application/x-ndjson' == lg.mimetype
+    assert users == [json.loads(line) for line in lg.data.decode('utf-8').splitlines()]
+
+    lg = client.post('/api/v1/logout', headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+
+
+def test_dump_uses_mapped_columns_only(client):
+    from sqlalchemy import select
+    from db.group import Group
+    from db.handler import db_session
+    from db.user import User
+
+    user = User(dom_name='test_dump_user', full_name='test dump')
+    db_session.add(user)
+    db_session.commit()
+    # committed objects are expired, dump loads them again
+    dumped = user.dump()
+    assert dict(id=user.id, dom_name='test_dump_user', full_name='test dump') == dumped
+    group = Group(name='test_dump_group', user=user, active=True)
+    db_session.add(group)
+    db_session.commit()
+    assert ('id', 'name', 'user_id', 'active') == tuple(group.dump())
+    row = db_session.execute(select(User.columns()).where(User.id == user.id)).first()
+    assert dumped == User.dump_row(row)
+    db_session.delete(group)
+    db_session.delete(user)
+    db_session.commit()
+
+
+def test_responses_use_configured_encoder(client):
+    from datetime import datetime
+    from decimal import Decimal
+    from api import encoding
+
+    assert encoding.encoder.name in ('orjson', 'ujson', 'stdlib')
+    for name in ('auto', 'stdlib', 'orjson', 'ujson'):
+        encoder = encoding.create_encoder(name)
+        data = dict(start=datetime(2019, 10, 1, 10), cpu=Decimal('1.5'), mem=None)
+        assert dict(start='2019-10-01T10:00:00Z', cpu=1.5, mem=None) == json.loads(encoder.dumps(data))
+
+    lg = client.post("/api/v1/login?username={0}&password={1}".format(access, encoded_secret))
+    assert 200 == lg.status_code
+    token = json.loads(lg.data)
+    lg = client.get('/api/v1/users', headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+    assert lg.data.decode('utf-8') == encoding.dumps(json.loads(lg.data)) + '\n'
+    lg = client.post('/api/v1/logout', headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2019, Pim Witlox. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+import pytest
+from flask import json
+from jsonschema import Draft4Validator, ValidationError
+
+from config import Config
+from app import application
+from tests import access, secret, encoded_secret, generate_token_headers
+
+usage_schema = {
+    'type': 'array',
+    'items': {
+        'type': 'object',
+        'required': ['r', 'u', 'start', 'end'],
+        'properties': {
+            'r': {'type': 'string'},
+            'u': {'type': 'string'},
+            'start': {'type': 'string', 'format': 'date-time'},
+            'end': {'type': 'string', 'format': 'date-time'},
+            'cpu': {'type': 'number', 'format': 'double'},
+        }
+    }
+}
+
+
+@pytest.fixture(scope='module', autouse=True)
+def client():
+    config = Config(create=False)
+    config.update('admin', 'access', access)
+    config.update('admin', 'secret', secret)
+    config.update('database', 'connection', 'sqlite://')
+    config.update('validation', 'compiled', 'True')
+    config.update('validation', 'trusted_services', 'test_trusted')
+    ars = application(config)
+    with ars.app.test_client() as c:
+        yield c
+
+
+@pytest.mark.parametrize('data', [
+    [],
+    [dict(r='r', u='u', start='2019-10-01T10:00:00Z', end='2019-10-01T11:00:00Z', cpu=1)],
+    [dict(r='r', u='u', start='2019-10-01T10:00:00Z', end='2019-10-01T11:00:00Z', cpu=True)],
+    [dict(r='r', u='u', start='2019-10-01T10:00:00Z')],
+    [dict(r='r', u=1, start='2019-10-01T10:00:00Z', end='2019-10-01T11:00:00Z')],
+    ['not an object'],
+    {'r': 'r'},
+])
+def test_compiled_validator_agrees_with_jsonschema(data):
+    from api.validation import CompiledValidator, compile_schema
+
+    compiled = CompiledValidator(compile_schema(usage_schema))
+    expected = list(Draft4Validator(usage_schema).iter_errors(data))
+    if expected:
+        with pytest.raises(ValidationError):
+            compiled.validate(data)
+    else:
+        compiled.validate(data)
+
+
+def test_unsupported_schema_is_not_compiled():
+    from api.validation import compile_schema
+
+    assert compile_schema({'type': 'string', 'pattern': '^a'}) is None
+    assert compile_schema({'type': 'array', 'items': {'$ref': '#/definitions/ResourceUsage'}}) is None
+
+
+def test_trusted_service_skips_item_validation(client):
+    lg = client.post("/api/v1/login?username={0}&password={1}".format(access, encoded_secret))
+    assert 200 == lg.status_code
+    token = json.loads(lg.data)
+    services = {}
+    for name in ('test_trusted', 'test_untrusted'):
+        lg = client.post("/api/v1/resources?name={0}".format(name), headers=generate_token_headers(dict(), token))
+        assert 201 == lg.status_code
+        lg = client.post("/api/v1/services?name={0}".format(name), headers=generate_token_headers(dict(), token))
+        assert 201 == lg.status_code
+        services[name] = json.loads(lg.data)
+    lg = client.post('/api/v1/logout', headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+
+    for name, status in (('test_trusted', 201), ('test_untrusted', 400)):
+        service = services[name]
+        lg = client.post("/api/v1/login?username={0}&password={1}".format(service['access'], service['secret']))
+        assert 200 == lg.status_code
+        token = json.loads(lg.data)
+        usages = [dict(r=name, u='test_user', start='2019-10-01T10:00:00Z', end='2019-10-01T11:00:00Z', cpu=1),
+                  dict(r=name, u='test_user', start='2019-10-01T10:00:00Z', cpu='a lot')]
+        lg = client.post('/api/v1/usage', json=usages, headers=generate_token_headers(dict(), token))
+        assert status == lg.status_code
+        if status == 201:
+            assert dict(accepted=1, rejected=1, duplicates=0) == json.loads(lg.data)
+        lg = client.post('/api/v1/logout', headers=generate_token_headers(dict(), token))
+        assert 200 == lg.status_code
+
+    lg = client.post("/api/v1/login?username={0}&password={1}".format(access, encoded_secret))
+    assert 200 == lg.status_code
+    token = json.loads(lg.data)
+    lg = client.get('/api/v1/metrics', headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code
+    validation = json.loads(lg.data)['validation']
+    assert validation['compiled']
+    assert 1 == validation['skipped']
+    assert validation['requests'] >= 2
+    lg = client.post('/api/v1/logout', headers=generate_token_headers(dict(), token))
+    assert 200 == lg.status_code